@@ -1,26 +1,309 @@
 import csv
+import gzip
+import hashlib
+import io
+import json
+import os
+import re
+import secrets
+import numpy as np
+from itertools import islice
 from datetime import date
-from Patient import Patient
+from math import nan
+from Patient import PatientView
+try:
+    import zstandard
+except ImportError:
+    zstandard = None
+
+# Fields stored as float arrays; every other field is stored as categorical codes
+NUMERIC_FIELD = re.compile(r'_(loglikelihood|Prob)_[A-Z]+$')
+MISSING_CODE = -1
+# Rows parsed at a time, so the strings of a large file are never all in memory at once
+CHUNK_ROWS = 8192
+# With cache=True the parsed columns of <file> are kept as .npy files in <file>.cache
+CACHE_SUFFIX = '.cache'
+CACHE_VERSION = 1
+
+def open_data_file(file_name):
+    """Open a CSV file, gzip-compressed if it ends in .gz or zstd-compressed if it ends in .zst, as text."""
+    if file_name.endswith('.gz'): return gzip.open(file_name,'rt',newline='')
+    if file_name.endswith('.zst'):
+        if zstandard is None: raise ImportError(f"{file_name}: reading .zst files needs the zstandard package")
+        return io.TextIOWrapper(zstandard.ZstdDecompressor().stream_reader(open(file_name,'rb'),closefd=True),newline='')
+    return open(file_name,'r',newline='')
+
+def admitted_rows(reader, index_of_admission_date_field, start=None, end=None, ordinal_of=None):
+    """Yield (date ordinal, row) for the rows admitted between start and end, inclusive.
+
+    Dates are parsed once per distinct YYYY-MM-DD prefix and kept in ordinal_of.
+    """
+    if ordinal_of is None: ordinal_of = dict()
+    first = start.toordinal() if start else None
+    last = end.toordinal() if end else None
+    for row in reader:
+        d = row[index_of_admission_date_field][0:10]
+        ordinal = ordinal_of.get(d)
+        if ordinal is None: ordinal = ordinal_of[d] = date(int(d[0:4]), int(d[5:7]), int(d[8:10])).toordinal()
+        if (first is not None and ordinal<first) or (last is not None and ordinal>last): continue
+        yield ordinal, row
+
+def _codes_dtype(number_of_categories):
+    for dtype in (np.int8, np.int16, np.int32):
+        if number_of_categories <= np.iinfo(dtype).max: return dtype
+    return np.int64
+
+def _file_digests(file_name, size):
+    """Digests of the first size bytes of a file and of the whole file."""
+    digest = hashlib.blake2b(digest_size=16)
+    with open(file_name,'rb') as file:
+        remaining = size
+        while remaining>0:
+            block = file.read(min(remaining, 1<<20))
+            if not block: break
+            digest.update(block)
+            remaining -= len(block)
+        prefix = digest.hexdigest()
+        for block in iter(lambda: file.read(1<<20), b''): digest.update(block)
+    return prefix, digest.hexdigest()
+
+def _ends_with_newline(file_name):
+    with open(file_name,'rb') as file:
+        if file.seek(0,os.SEEK_END)==0: return True
+        file.seek(-1,os.SEEK_END)
+        return file.read(1)==b'\n'
+
+def _kept_fields(header, fields, admission_date_field):
+    return [i for i, field in enumerate(header) if fields is None or field in fields or field==admission_date_field]
+
+def _cache_categories(meta):
+    return [meta['categories'].get(str(i)) for i in range(len(meta['header']))]
+
+def _read_cache_meta(directory, parameters):
+    try:
+        with open(os.path.join(directory,'meta.json'),'r') as file: meta = json.load(file)
+    except (OSError, ValueError):
+        return None
+    if not isinstance(meta, dict) or any(meta.get(key)!=value for key, value in parameters.items()): return None
+    return meta
+
+def _read_cache_columns(directory, meta, indices):
+    """Memory-mapped ordinals and columns of a cache, or None if any of them is missing or damaged."""
+    try:
+        build = meta['build']
+        ordinals = np.load(os.path.join(directory, f"{build}-ordinals.npy"), mmap_mode='r')
+        columns = dict()
+        for i in indices:
+            column = np.load(os.path.join(directory, f"{build}-{i}.npy"), mmap_mode='r')
+            if column.shape!=ordinals.shape or column.dtype.kind!=('i' if str(i) in meta['categories'] else 'f'): return None
+            columns[i] = column
+    except (OSError, ValueError, KeyError):
+        return None
+    return ordinals, columns
+
+def _write_cache(directory, meta, ordinals, columns, categories):
+    """Write a new build of the cache, switch meta.json to it, and remove older builds.
+
+    Failing to write the cache is not an error; the data has been read already.
+    """
+    build = secrets.token_hex(8)
+    try:
+        os.makedirs(directory, exist_ok=True)
+        np.save(os.path.join(directory, f"{build}-ordinals.npy"), np.asarray(ordinals))
+        for i, column in columns.items():
+            if categories[i] is not None: column = column.astype(_codes_dtype(len(categories[i])), copy=False)
+            np.save(os.path.join(directory, f"{build}-{i}.npy"), np.asarray(column))
+        meta = dict(meta, build=build, categories={str(i): list(c) for i, c in enumerate(categories) if c is not None})
+        with open(os.path.join(directory,'meta.json.tmp'),'w') as file: json.dump(meta, file)
+        os.replace(os.path.join(directory,'meta.json.tmp'), os.path.join(directory,'meta.json'))
+        for name in os.listdir(directory):
+            if name.endswith('.npy') and not name.startswith(build+'-'): os.remove(os.path.join(directory, name))
+    except OSError:
+        pass
+
 
 class Data:
-    """Data class."""
-
-    def __init__(self, admission_date_field, delimiter, file_missing_value, data_missing_value, file_name):
-        self.data = dict()
-        file = open(file_name,'r')
-        reader = csv.reader(file,delimiter=delimiter)
-        header = next(reader)
-        index_of_admission_date_field = header.index(admission_date_field)
-        for row in reader:
-            d = row[index_of_admission_date_field]
-            pt_date = date(int(d[0:4]), int(d[5:7]), int(d[8:10]))
-            if not(pt_date in self.data): self.data[pt_date]=[]
-            self.data[pt_date].append(Patient(header,row,file_missing_value,data_missing_value))
-        self.all_dates = sorted(list(self.data.keys()))
-        self.all_fields = header
+    """Data class.
+
+    Patients are stored column by column, sorted by admission date: a float
+    array per log-likelihood/probability field (nan where missing) and an
+    array of codes into a list of distinct values for every other field
+    (MISSING_CODE where missing).  The patients of day d are the rows
+    offsets[d] to offsets[d+1].  patients(day) returns PatientView objects
+    that read from the columns, for code written against the old
+    one-Patient-per-row representation.
+
+    If fields is given, only those fields and the admission date are kept;
+    if start or end dates are given, only the patients admitted between
+    them.  Rows are streamed from the file, which may be gzip or zstd
+    compressed, and rows outside the dates are never stored.
+
+    With cache=True the whole file is parsed once into a cache directory
+    next to it, and later loads memory-map the columns from there.
+    """
+
+    def __init__(self, admission_date_field, delimiter, file_missing_value, data_missing_value, file_name, fields=None,
+                 start=None, end=None, cache=False):
+        self.file_missing_value = file_missing_value
+        self.data_missing_value = data_missing_value
+        if cache:
+            header, ordinals, columns, categories = self._cached_columns(admission_date_field, delimiter, file_name, fields)
+            first = np.searchsorted(ordinals, start.toordinal()) if start else 0
+            last = np.searchsorted(ordinals, end.toordinal(), side='right') if end else len(ordinals)
+            ordinals = ordinals[first:last]
+            columns = {i: column[first:last] for i, column in columns.items()}
+        else:
+            file = open_data_file(file_name)
+            reader = csv.reader(file,delimiter=delimiter)
+            header = next(reader)
+            categories = [None if NUMERIC_FIELD.search(field) else dict() for field in header]
+            index_of_admission_date_field = header.index(admission_date_field)
+            kept = _kept_fields(header, fields, admission_date_field)
+            ordinals, columns = self._read_rows(reader, header, index_of_admission_date_field, kept, categories, start, end, file_name)
+            file.close()
+            order = np.argsort(ordinals, kind='stable')
+            ordinals = ordinals[order]
+            columns = {i: column[order] for i, column in columns.items()}
+        self._set_columns(header, ordinals, columns, categories)
+
+    def _set_columns(self, header, ordinals, columns, categories):
+        """Index rows sorted by date ordinal by day and keep their columns."""
+        starts = np.flatnonzero(np.diff(ordinals))+1 if len(ordinals) else np.empty(0, dtype=np.int64)
+        starts = np.concatenate([[0], starts]) if len(ordinals) else starts
+        self.offsets = np.append(starts, len(ordinals))
+        self.number_of_rows = len(ordinals)
+        self.all_dates = [date.fromordinal(int(ordinals[start])) for start in starts]
+        self.day_of_date = {d: day for day, d in enumerate(self.all_dates)}
+        self.all_fields = [header[i] for i in columns]
         self.all_cuis = [field for field in self.all_fields if field[0:4]=='C_D_']
         self.all_luis = [field for field in self.all_fields if field[0:4]=='L_D_']
-        file.close()
+        self.numeric = dict()
+        self.categorical = dict()
+        for i, column in columns.items():
+            if categories[i] is None: self.numeric[header[i]] = column
+            else: self.categorical[header[i]] = (column.astype(_codes_dtype(len(categories[i])), copy=False), list(categories[i]))
+
+    def _read_rows(self, reader, header, index_of_admission_date_field, kept, categories, start, end, file_name):
+        """Parse the rows of reader into the kept columns, in file order."""
+        ordinals = []
+        chunks = {i: [] for i in kept}
+        admitted = admitted_rows(reader, index_of_admission_date_field, start, end)
+        while True:
+            rows = list(islice(admitted, CHUNK_ROWS))
+            if not rows: break
+            ordinals.extend(ordinal for ordinal, row in rows)
+            columns = list(zip(*[row for ordinal, row in rows]))
+            del rows
+            for i in kept:
+                column, columns[i] = columns[i], None
+                if categories[i] is None:
+                    try:
+                        chunks[i].append(self._numeric_chunk(column))
+                    except ValueError as error:
+                        raise ValueError(f"{file_name}: {header[i]}: {error}")
+                else:
+                    chunks[i].append(self._codes_chunk(column, categories[i]))
+        empty = lambda i: np.empty(0) if categories[i] is None else np.empty(0, dtype=np.int32)
+        return np.array(ordinals, dtype=np.int64), {i: np.concatenate(chunks[i] or [empty(i)]) for i in kept}
+
+    def _numeric_chunk(self, column):
+        missing = self.file_missing_value
+        return np.array([nan if v==missing else float(v) for v in column])
+
+    def _codes_chunk(self, column, categories):
+        missing = self.file_missing_value
+        return np.array([MISSING_CODE if v==missing else categories.setdefault(v, len(categories)) for v in column], dtype=np.int32)
+
+    def _cached_columns(self, admission_date_field, delimiter, file_name, fields):
+        """Header, date ordinals and kept columns of every row of file_name, in date order, from its cache.
+
+        The cache is used as it is if the file's size and modification time
+        have not changed.  If the file has only been appended to, just the
+        new rows are parsed and merged in.  Otherwise, or if the cache
+        cannot be read, it is rebuilt from the whole file.
+        """
+        directory = file_name+CACHE_SUFFIX
+        parameters = {'version': CACHE_VERSION, 'admission_date_field': admission_date_field, 'delimiter': delimiter,
+                      'file_missing_value': self.file_missing_value}
+        status = os.stat(file_name)
+        meta = _read_cache_meta(directory, parameters)
+        cached, digest = None, None
+        if meta is not None:
+            header = meta['header']
+            kept = _kept_fields(header, fields, admission_date_field)
+            if (meta['size'], meta['mtime_ns'])==(status.st_size, status.st_mtime_ns):
+                cached = _read_cache_columns(directory, meta, kept)
+                if cached is not None: return header, cached[0], cached[1], _cache_categories(meta)
+            elif status.st_size==meta['size'] or (status.st_size>meta['size'] and meta['ends_with_newline'] and not file_name.endswith(('.gz','.zst'))):
+                prefix_digest, digest = _file_digests(file_name, meta['size'])
+                if prefix_digest==meta['digest']: cached = _read_cache_columns(directory, meta, range(len(header)))
+        if cached is None:
+            file = open_data_file(file_name)
+            reader = csv.reader(file,delimiter=delimiter)
+            header = next(reader)
+            kept = _kept_fields(header, fields, admission_date_field)
+            meta = dict(parameters, header=header, size=0)
+            categories = [None if NUMERIC_FIELD.search(field) else dict() for field in header]
+            ordinals, columns = self._read_rows(reader, header, header.index(admission_date_field), range(len(header)), categories,
+                                                None, None, file_name)
+            file.close()
+            order = np.argsort(ordinals, kind='stable')
+        else:
+            ordinals, columns = cached
+            categories = [None if c is None else {v: code for code, v in enumerate(c)} for c in _cache_categories(meta)]
+            raw = open(file_name,'rb')
+            raw.seek(meta['size'])
+            file = io.TextIOWrapper(raw, newline='')
+            new_ordinals, new_columns = self._read_rows(csv.reader(file,delimiter=delimiter), header, header.index(admission_date_field),
+                                                        range(len(header)), categories, None, None, file_name)
+            file.close()
+            # The cached rows come first in the file, so a stable sort keeps them ahead of new rows of the same day
+            ordinals = np.concatenate([ordinals, new_ordinals])
+            columns = {i: np.concatenate([columns[i], new_columns[i]]) for i in columns}
+            order = np.argsort(ordinals, kind='stable')
+        ordinals = ordinals[order]
+        columns = {i: column[order] for i, column in columns.items()}
+        # Only cache what was read if the file did not change while it was being read
+        if (os.stat(file_name).st_size, os.stat(file_name).st_mtime_ns)==(status.st_size, status.st_mtime_ns):
+            _write_cache(directory, dict(meta, size=status.st_size, mtime_ns=status.st_mtime_ns, digest=digest or _file_digests(file_name, 0)[1],
+                                         ends_with_newline=_ends_with_newline(file_name)), ordinals, columns, categories)
+        return header, ordinals, {i: columns[i] for i in kept}, categories
+
+    def select(self,rows):
+        """A Data object with only the given rows (indices in date order), e.g. the patients of one site."""
+        subset = Data.__new__(Data)
+        subset.file_missing_value, subset.data_missing_value = self.file_missing_value, self.data_missing_value
+        ordinals = np.repeat([d.toordinal() for d in self.all_dates], np.diff(self.offsets)).astype(np.int64)[rows]
+        header, columns, categories = list(self.all_fields), dict(), []
+        for i, field in enumerate(header):
+            if field in self.numeric:
+                columns[i] = np.asarray(self.numeric[field][rows])
+                categories.append(None)
+            else:
+                codes, values = self.categorical[field]
+                columns[i] = np.asarray(codes[rows])
+                categories.append(values)
+        subset._set_columns(header, ordinals, columns, categories)
+        return subset
+
+    def partition(self,fields):
+        """Row indices of the patients with each combination of values of the categorical fields, in date order.
+
+        Returns {(value, ...): rows}; a missing value is data_missing_value.
+        """
+        for field in fields:
+            if field not in self.categorical: raise ValueError(f"No categorical field {field} to partition the patients by")
+        codes = np.stack([self.categorical[field][0].astype(np.int64) for field in fields], axis=1) if fields else np.zeros((self.number_of_rows,0), dtype=np.int64)
+        if not self.number_of_rows: return dict()
+        combinations, inverse = np.unique(codes, axis=0, return_inverse=True)
+        inverse = inverse.reshape(-1)
+        order = np.argsort(inverse, kind='stable')
+        bounds = np.searchsorted(inverse[order], np.arange(len(combinations)+1))
+        groups = dict()
+        for g, combination in enumerate(combinations.tolist()):
+            key = tuple(self.data_missing_value if code==MISSING_CODE else self.categorical[field][1][code] for field, code in zip(fields, combination))
+            groups[key] = order[bounds[g]:bounds[g+1]]
+        return groups
 
     def number_of_days(self): return len(self.all_dates)
 
@@ -28,13 +311,56 @@ class Data:
 
     def date(self,day): return self.all_dates[day]
 
-    def day(self,date): return self.all_dates.index(date)
+    def day(self,date): return self.day_of_date[date]
 
-    def patients(self,day): return self.data[self.date(day)]
+    def rows(self,day): return slice(int(self.offsets[day]), int(self.offsets[day+1]))
 
-    def number_of_patients(self,day): return len(self.data[self.date(day)])
+    def values(self,field,day=None):
+        """Float array of a numeric field, for one day or for all rows in date order."""
+        column = self.numeric[field]
+        return column if day is None else column[self.rows(day)]
 
-    def patient(self,day,patient): return self.data[self.date(day)][patient]
+    def codes(self,field,day=None):
+        """Codes and distinct values of a categorical field."""
+        codes, categories = self.categorical[field]
+        return (codes if day is None else codes[self.rows(day)]), categories
 
-# end-of-file
+    def patients(self,day): return [PatientView(self,row) for row in range(self.offsets[day], self.offsets[day+1])]
+
+    def number_of_patients(self,day): return int(self.offsets[day+1]-self.offsets[day])
+
+    def patient(self,day,patient): return PatientView(self,int(self.offsets[day])+patient)
 
+    def has_value(self,row,field):
+        if field in self.numeric: return not np.isnan(self.numeric[field][row])
+        return field in self.categorical and self.categorical[field][0][row]!=MISSING_CODE
+
+    def get_value(self,row,field):
+        if field in self.numeric:
+            value = self.numeric[field][row]
+            return self.data_missing_value if np.isnan(value) else float(value)
+        if field not in self.categorical: return self.data_missing_value
+        codes, categories = self.categorical[field]
+        code = codes[row]
+        return self.data_missing_value if code==MISSING_CODE else categories[code]
+
+    def set_value(self,row,field,value):
+        if field in self.numeric:
+            if not self.numeric[field].flags.writeable: self.numeric[field] = np.array(self.numeric[field])
+            self.numeric[field][row] = float(value)
+            return
+        if field not in self.categorical:
+            self.categorical[field] = (np.full(self.number_of_rows, MISSING_CODE, dtype=np.int8), [])
+            self.all_fields.append(field)
+        codes, categories = self.categorical[field]
+        if not codes.flags.writeable:
+            codes = np.array(codes)
+            self.categorical[field] = (codes, categories)
+        if value not in categories:
+            categories.append(value)
+            if len(categories) > np.iinfo(codes.dtype).max:
+                codes = codes.astype(_codes_dtype(len(categories)))
+                self.categorical[field] = (codes, categories)
+        codes[row] = categories.index(value)
+
+# end-of-file
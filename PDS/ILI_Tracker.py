@@ -1,5 +1,8 @@
-from math import log, exp, e
-from numpy import logaddexp
+import hashlib
+import json
+import os
+from math import log, e
+import numpy as np
 
 MIN_POSTERIOR = 0.0001
 
@@ -8,39 +11,95 @@ def _normalize(probabilities,min_probability):
     total = sum(probabilities)
     return [p/total for p in probabilities]
 
-def _logsum(logs):
-    result = logs[0]
-    for i in range(1,len(logs)): result = logaddexp(result,logs[i])
-    return result
+def _day_digest(log_likelihoods):
+    return hashlib.blake2b(np.ascontiguousarray(log_likelihoods).tobytes(), digest_size=16).hexdigest()
+
+def load_checkpoint(file_name):
+    """Checkpoint saved by save_checkpoint(), or an empty one if there is none yet."""
+    if not os.path.exists(file_name): return dict()
+    with open(file_name,'r') as file: return json.load(file)
+
+def save_checkpoint(file_name, checkpoint):
+    with open(file_name+'.tmp','w') as file: json.dump(checkpoint,file)
+    os.replace(file_name+'.tmp',file_name)
 
-def ili_tracker(diseases, original_priors, log_likelihood_fields, eqs, base, data):
+def ili_tracker(diseases, original_priors, log_likelihood_fields, eqs, base, data, checkpoint=None):
+    """Track the diseases day by day through data.
+
+    If a checkpoint dict is given, days whose date and log-likelihoods match
+    the ones it recorded are taken from it instead of being recomputed, so
+    only new days and days that received late data (and every day after
+    them) are processed.  The checkpoint is updated in place.
+
+    Every patient needs all of the log-likelihood fields: a missing one
+    raises ValueError rather than turning the day's results into nan.
+    """
     original_priors[len(original_priors)-1] = 1.0-sum(original_priors[0:len(original_priors)-1])
     priors = original_priors
     result = dict()
     for dx in diseases: result[dx]=[]
     daily_log_probability = []
-    daily_log_unusual_cutoff = []
-    for day in range(data.number_of_days()):
-        log_priors = [log(prior) for prior in priors]
-        expected = [0.0 for dx in diseases]
-        number_of_patients_day = 0
-        log_probability_day = 0.0
-        for patient in data.patients(day):
-            log_likelihoods = [(float(patient.get_value(field))/log(e,base)) for field in log_likelihood_fields]
-            log_posteriors = [ll+p for (ll,p) in zip(log_likelihoods,log_priors)]
-            log_denominator = _logsum(log_posteriors)
-            log_probabilities = [log_posterior-log_denominator for log_posterior in log_posteriors]
-            probabilities = [exp(lp) for lp in log_probabilities]
-            expected = [e+p for (e,p) in zip(expected,probabilities)]
-            number_of_patients_day += 1
-            log_probability_day += log_denominator
+    # One row per patient in date order, one column per disease, natural logs
+    log_likelihoods = np.column_stack([data.values(field) for field in log_likelihood_fields])/log(e,base)
+    missing = np.argwhere(np.isnan(log_likelihoods))
+    if len(missing):
+        row, column = missing[0]
+        day = int(np.searchsorted(data.offsets, row, side='right'))-1
+        raise ValueError(f"{log_likelihood_fields[column]} is missing for {len(missing)} value(s), first for a patient "
+                         f"admitted on {data.date(day).isoformat()}")
+    first_day = 0
+    if checkpoint is not None:
+        parameters = {'diseases': list(diseases), 'log_likelihood_fields': list(log_likelihood_fields),
+                      'priors': list(original_priors), 'eqs': eqs, 'base': base}
+        if checkpoint.get('parameters')!=parameters: checkpoint.update(parameters=parameters, days=[])
+        days = checkpoint['days']
+        while first_day<min(len(days),data.number_of_days()):
+            day = days[first_day]
+            if day['date']!=data.date(first_day).isoformat() or day['digest']!=_day_digest(log_likelihoods[data.rows(first_day)]): break
+            for i in range(len(diseases)): result[diseases[i]].append(day['expected'][i])
+            daily_log_probability.append(day['log_probability'])
+            priors = day['priors']
+            first_day += 1
+        del days[first_day:]
+    for day in range(first_day, data.number_of_days()):
+        log_priors = np.array([log(prior) for prior in priors])
+        log_posteriors = log_likelihoods[data.rows(day)]+log_priors
+        log_denominators = np.logaddexp.reduce(log_posteriors,axis=1)
+        probabilities = np.exp(log_posteriors-log_denominators[:,np.newaxis])
+        expected = probabilities.sum(axis=0).tolist()
         for i in range(len(diseases)): result[diseases[i]].append(expected[i])
         total = sum(expected)
         posteriors = [(e+(eqs*prior))/(total+eqs) for (e,prior) in zip(expected,original_priors)]
         posteriors = _normalize(posteriors,MIN_POSTERIOR)
         priors = posteriors
-        log_probability_day = log_probability_day / len(data.patients(day))
+        log_probability_day = float(log_denominators.sum()/len(log_denominators))
         daily_log_probability.append(log_probability_day)
+        if checkpoint is not None:
+            days.append({'date': data.date(day).isoformat(), 'digest': _day_digest(log_likelihoods[data.rows(day)]),
+                         'expected': expected, 'log_probability': log_probability_day, 'priors': priors})
     result['daily_log_probability'] = daily_log_probability
     return result
 
+def combine_results(diseases, shards):
+    """Add up the results of trackers run on disjoint sets of patients, day by day, without the patients.
+
+    shards is a list of (dates, patients, results): the days a tracker
+    covered, the number of patients on each and its ili_tracker() results.
+    Expected counts add up; the daily log probability, a mean over the
+    day's patients, becomes the patient-weighted mean.  Each shard's priors
+    follow its own history, so the sum is not a tracker run over the pooled
+    patients.  Returns (dates, patients, results) over the union of the days.
+    """
+    all_dates = sorted(set().union(*[dates for dates, _, _ in shards]))
+    index = {d: i for i, d in enumerate(all_dates)}
+    expected = np.zeros((len(diseases), len(all_dates)))
+    patients = np.zeros(len(all_dates), dtype=np.int64)
+    log_probability = np.zeros(len(all_dates))
+    for dates, counts, results in shards:
+        at = np.array([index[d] for d in dates], dtype=np.intp)
+        for i, dx in enumerate(diseases): expected[i, at] += results[dx]
+        patients[at] += counts
+        log_probability[at] += np.asarray(results['daily_log_probability'])*counts
+    result = {dx: expected[i].tolist() for i, dx in enumerate(diseases)}
+    result['daily_log_probability'] = (log_probability/np.maximum(patients, 1)).tolist()
+    return all_dates, patients.tolist(), result
@@ -1,6 +1,7 @@
 from Data import Data
 from Patient import Patient
-from math import nan
+from math import nan, isnan
+from bisect import bisect_left, insort
 
 def lab1(patient,dx): return patient.get_value('LAB_'+dx)
 def lab2(patient,dx): return patient.get_value('LAB_'+dx+'_ADDITIONAL')
@@ -28,27 +29,42 @@ def daily_lab_positive(disease,data):
 def normalize(L,total): return [(x/sum(L))*total for x in L]
 
 def moving_average(window_size, list_of_numbers):
-    result = []
+    """Centered moving average, shrinking the window at both ends.
+
+    Each window is summed left to right with sum(), as it always was: any
+    running or prefix sum rounds differently, so this is what keeps the
+    averages the same to the last bit.  The cost is O(n*window_size), linear
+    for the 7-day window of the plots.
+    """
+    n = len(list_of_numbers)
     half = window_size//2
-    for i in range(len(list_of_numbers)):
+    result = []
+    for i in range(n):
         start = max(0,i-half)
-        end = min(len(list_of_numbers), i+half+1)
-        window = list_of_numbers[start:end]
-        average = sum(window)/len(window)
-        result.append(average)
+        end = min(n, i+half+1)
+        result.append(sum(list_of_numbers[start:end])/(end-start))
     return result
 
 def empirical_p(window_size, min_window_size, daily_log_probability):
+    """Fraction of the previous window_size days less probable than each day.
+
+    The window is kept sorted (without nan, which compares false with
+    everything), so each day costs two bisections instead of a scan.
+    """
     result = []
+    window = []
     for day in range(len(daily_log_probability)):
+        if day>0:
+            entering = daily_log_probability[day-1]
+            if not isnan(entering): insort(window, entering)
+            if day-1-window_size>=0:
+                leaving = daily_log_probability[day-1-window_size]
+                if not isnan(leaving): del window[bisect_left(window, leaving)]
         if day<=min_window_size:
             result.append(nan)
             continue
         day_log_p = daily_log_probability[day]
-        window = daily_log_probability[max(0,day-window_size):day]
-        larger = 0
-        for x in window:
-            if (x<day_log_p): larger+=1
-        result.append(larger/len(window))
+        larger = 0 if isnan(day_log_p) else bisect_left(window, day_log_p)
+        result.append(larger/(day-max(0,day-window_size)))
     return result
 
@@ -17,3 +17,20 @@ class Patient:
     def __repr__(self): return self.get_value('ID')
 
 
+
+class PatientView:
+    """One row of a columnar Data object, with the Patient interface."""
+
+    __slots__ = ('data', 'row')
+
+    def __init__(self, data, row):
+        self.data = data
+        self.row = row
+
+    def has_value(self,field): return self.data.has_value(self.row,field)
+
+    def get_value(self,field): return self.data.get_value(self.row,field)
+
+    def set_value(self,field,value): self.data.set_value(self.row,field,value)
+
+    def __repr__(self): return str(self.get_value('ID'))
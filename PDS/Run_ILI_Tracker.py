@@ -4,10 +4,14 @@ import os
 from Data import Data
 from Misc import *
 from datetime import date
-from ILI_Tracker import ili_tracker
-import matplotlib.pyplot as plt
+from ILI_Tracker import ili_tracker, combine_results, load_checkpoint, save_checkpoint
+from concurrent.futures import ProcessPoolExecutor
+from math import isnan
 import argparse
+import csv
+import json
 import numpy as np
+import sys
 
 
 # Default
@@ -15,73 +19,298 @@ data_directory = './data'
 data_file = 'Sample_Data.csv'
 diseases = ['INFLUENZA','RSV','HMPV','PARAINFLUENZA','OTHER']
 
-ll_fields = [disease+'_loglikelihood_T' for disease in diseases]
-priors = normalize([(0.1/(len(diseases)-1)) if dx!='OTHER' else 0.9 for dx in diseases],1.0)
 admission_date_field, delimiter, file_missing_value, data_missing_value, base = 'Admit_date_time', ',', 'M', 'M', 10.0
 equivalent_sample_size, moving_average_window = 10, 7
+empirical_p_window, empirical_p_min_window = 365, 30
 
 # ------------------------------------------------------------------------
-# Command Line Arguments
-# ------------------------------------------------------------------------
-parser = argparse.ArgumentParser(description='ILI Tracker')
-parser.add_argument('--data_directory', type=str, default='./data', help='Directory containing the data file')
-parser.add_argument('--data_file', type=str, default='Sample_Data.csv', help='Data file')
-parser.add_argument('--diseases', type=str, default='INFLUENZA,RSV,HMPV,PARAINFLUENZA,OTHER', help='List of diseases')
-
-args = parser.parse_args()
-if args.diseases:
-    diseases = args.diseases.split(',')
-if args.data_directory:
-    data_directory = args.data_directory
-if args.data_file:
-    data_file = args.data_file
 
-# ------------------------------------------------------------------------
+def pyplot():
+    """Import matplotlib only when a plot is drawn; it takes most of the start-up time."""
+    import matplotlib.pyplot as plt
+    return plt
+
+def run_ili_tracker(data_directory, data_file, diseases, checkpoint_file=None, output_png_file=None, start=None, end=None,
+                    cache=False, plot=True, output=None, output_file=None, verbose=False):
+    """Run the tracker on one data file and save the plot next to it.
+
+    Kept separate from the command line handling so a long-lived worker can
+    call it for every new file without re-importing numpy and matplotlib.
+    With a checkpoint_file, only the days that are new or changed since the
+    last run on the same file are recomputed.  start and end limit the
+    tracking to patients admitted between those dates.  With cache, the
+    parsed data file is kept in <data_file>.cache for the next run.
+
+    output 'json' or 'csv' writes the daily results to output_file (or
+    stdout); plot=False skips the plot and never imports matplotlib.
+    Nothing is printed unless verbose, which the command line sets when
+    there is no output: a worker tracking a growing history would print
+    all of it on every run.
+    """
+    ll_fields, priors = tracker_parameters(diseases)
+
+    data = Data(admission_date_field, delimiter, file_missing_value, data_missing_value, data_directory + os.sep + data_file,
+                fields=['ID']+ll_fields, start=start, end=end, cache=cache)
+    checkpoint = load_checkpoint(checkpoint_file) if checkpoint_file else None
+    ili_tracker_results = ili_tracker(diseases, priors, ll_fields, equivalent_sample_size, base, data, checkpoint)
+    if checkpoint_file: save_checkpoint(checkpoint_file, checkpoint)
+    daily_log_probability = ili_tracker_results['daily_log_probability']
+
+    if output:
+        write_results(output, output_file, data.dates(), diseases, ili_tracker_results)
+    elif verbose:
+        print(data)
+        print(ili_tracker_results)
+        print("Daily Log Probability: ", daily_log_probability)
+
+    if plot:
+        if output_png_file is None: output_png_file = data_directory + os.sep + data_file + '.png'
+        plot_results(output_png_file, data.dates(), diseases, ili_tracker_results)
+        if verbose and not output: print("The Output of ILI Tracker saved to: ", output_png_file)
+
+    return ili_tracker_results
+
+def tracker_parameters(diseases):
+    """The log likelihood field and prior of each disease."""
+    ll_fields = [disease+'_loglikelihood_T' for disease in diseases]
+    priors = normalize([(0.1/(len(diseases)-1)) if dx!='OTHER' else 0.9 for dx in diseases],1.0)
+    return ll_fields, priors
+
+def track_shard(key, data, diseases, checkpoint):
+    """Run the tracker on the patients of one shard (in a worker process).
+
+    Returns the key, the days tracked, the number of patients on each, the
+    ili_tracker() results and the updated checkpoint.
+    """
+    ll_fields, priors = tracker_parameters(diseases)
+    results = ili_tracker(diseases, priors, ll_fields, equivalent_sample_size, base, data, checkpoint)
+    return key, data.dates(), np.diff(data.offsets).tolist(), results, checkpoint
+
+def run_sharded_ili_tracker(data_directory, data_file, diseases, shard_fields, checkpoint_file=None, output_png_file=None,
+                            start=None, end=None, cache=False, plot=True, output=None, output_file=None, processes=None,
+                            verbose=False):
+    """Run the tracker separately on the patients of each site and add the results up to every coarser level.
+
+    shard_fields name the columns that locate a patient, coarsest first,
+    e.g. ['Region','Site'].  The rows are partitioned by the combination of
+    their values and each shard is tracked in a pool of processes (one per
+    CPU by default; processes=1 runs them in this process).  Expected counts
+    and daily log probabilities add up across shards, so the levels above
+    them ('all', then each shard field but the last) are combined from the
+    shard results with combine_results() without reading the patients again.
+
+    The checkpoint_file holds one checkpoint per shard.  With output, one
+    result set per level is written to <output_file stem>.<level><ext> (or
+    all of them to stdout), one row per shard and day; with plot, one plot
+    per level goes to <output_png_file stem>.<level>.png.  verbose prints
+    the results without output, as in run_ili_tracker().  Returns
+    {level: {shard key: (dates, patients, results)}}.
+    """
+    ll_fields, _ = tracker_parameters(diseases)
+    data = Data(admission_date_field, delimiter, file_missing_value, data_missing_value, data_directory + os.sep + data_file,
+                fields=['ID']+ll_fields+list(shard_fields), start=start, end=end, cache=cache)
+    shards = data.partition(shard_fields)
+    checkpoints = load_checkpoint(checkpoint_file).get('shards', dict()) if checkpoint_file else dict()
+    jobs = [(key, data.select(rows), diseases, checkpoints.get('/'.join(key), dict()) if checkpoint_file else None)
+            for key, rows in sorted(shards.items())]
+    del data
 
-data = Data(admission_date_field, delimiter, file_missing_value, data_missing_value, data_directory + os.sep + data_file)
-ili_tracker_results = ili_tracker(diseases, priors, ll_fields, equivalent_sample_size, base, data)
-daily_log_probability = ili_tracker_results['daily_log_probability']
+    if processes==1 or len(jobs)<2:
+        tracked = [track_shard(*job) for job in jobs]
+    else:
+        with ProcessPoolExecutor(max_workers=processes) as pool:
+            tracked = list(pool.map(track_shard, *zip(*jobs)))
+    if checkpoint_file: save_checkpoint(checkpoint_file, {'shards': {'/'.join(key): checkpoint for key, _, _, _, checkpoint in tracked}})
 
-print(data)
-print(ili_tracker_results)
-print("Daily Log Probability: ", daily_log_probability)
+    levels = dict()
+    for depth in range(len(shard_fields)):
+        groups = dict()
+        for key, dates, patients, results, _ in tracked: groups.setdefault(key[:depth], []).append((dates, patients, results))
+        levels[shard_fields[depth-1] if depth else 'all'] = {key: combine_results(diseases, group) for key, group in groups.items()}
+    levels[shard_fields[-1]] = {key: (dates, patients, results) for key, dates, patients, results, _ in tracked}
 
+    if output:
+        write_level_results(output, output_file, shard_fields, diseases, levels)
+    elif verbose:
+        for level, groups in levels.items():
+            for key, (dates, patients, results) in groups.items():
+                print(level, '/'.join(key) or 'all', 'days', len(dates), 'patients', sum(patients))
+                print(results)
 
-# ----------------------------------------------------------------------
+    if plot:
+        if output_png_file is None: output_png_file = data_directory + os.sep + data_file + '.png'
+        for level, groups in levels.items():
+            level_png_file = level_file_name(output_png_file, level)
+            plot_level(level_png_file, level, diseases, groups)
+            if verbose and not output: print("The Output of ILI Tracker for", level, "saved to: ", level_png_file)
 
-dates = data.dates()
-xticks = [dates.index(date) for date in dates if date.day==1]
-xticklabels = [str(dates[d].month)+'/'+str(dates[d].year) for d in xticks]
+    return levels
 
-# ----------------------------------------------------------------------
+def level_file_name(file_name, level):
+    stem, ext = os.path.splitext(file_name)
+    return stem+'.'+level+ext
 
-fig, axes = plt.subplots(len(diseases) + 1)
-fig.tight_layout(pad=2.0)
-fig.set_size_inches(16,10)
+def write_level_results(output, output_file, shard_fields, diseases, levels):
+    """Write one record per level, shard and day, like write_results() with the level, the shard's values
+    of shard_fields (empty below its level) and the number of patients; one file per level with output_file."""
+    files = {level: level_file_name(output_file, level) for level in levels} if output_file else {level: None for level in levels}
+    records = {level: [] for level in levels}
+    for level, groups in levels.items():
+        for key, (dates, patients, results) in groups.items():
+            daily_log_probability = results['daily_log_probability']
+            p_values = empirical_p(empirical_p_window, empirical_p_min_window, daily_log_probability)
+            for day in range(len(dates)):
+                records[level].append((level, key, dates[day], [results[dx][day] for dx in diseases], daily_log_probability[day],
+                                       p_values[day], patients[day]))
+    if not output_file: records = {None: [record for level in levels for record in records[level]]}
+    for file_level, level_records in records.items():
+        file = open(files[file_level],'w',newline='') if file_level else sys.stdout
+        if output=='json':
+            json.dump([{'level': level, 'shard': dict(zip(shard_fields, key)), 'date': day.isoformat(),
+                        'expected': dict(zip(diseases, expected)), 'daily_log_probability': log_p,
+                        'empirical_p': None if isnan(p) else p, 'patients': patients}
+                       for level, key, day, expected, log_p, p, patients in level_records], file)
+            file.write('\n')
+        else:
+            writer = csv.writer(file)
+            writer.writerow(['level']+list(shard_fields)+['date']+diseases+['daily_log_probability','empirical_p','patients'])
+            for level, key, day, expected, log_p, p, patients in level_records:
+                writer.writerow([level]+list(key)+['']*(len(shard_fields)-len(key))+[day.isoformat()]+expected+
+                                [log_p, '' if isnan(p) else p, patients])
+        if file_level: file.close()
 
-for i in range(len(diseases)):
-    axes[i].set_title(diseases[i])
-    axes[i].plot(moving_average(moving_average_window,ili_tracker_results[diseases[i]]), color='blue')
-    axes[i].set_ylabel('ILI Tracker', color='blue')
-    axes[i].set_xticks(xticks)
-    axes[i].set_xticklabels(xticklabels)
-    axes[i].secondary_xaxis("top")
-axes[len(diseases)].set_title('Daily Log Probability')
-axes[len(diseases)].plot(moving_average(moving_average_window, daily_log_probability), color='red')
-axes[len(diseases)].set_ylabel('Log Probability', color='red')
-axes[len(diseases)].set_xticks(xticks)
-axes[len(diseases)].set_xticklabels(xticklabels)
-axes[len(diseases)].secondary_xaxis("top")
-axes[len(diseases)].set_xlabel('Date')
+def write_results(output, output_file, dates, diseases, ili_tracker_results):
+    """Write one record per day: date, expected patients per disease, daily_log_probability and empirical_p."""
+    daily_log_probability = ili_tracker_results['daily_log_probability']
+    p_values = empirical_p(empirical_p_window, empirical_p_min_window, daily_log_probability)
+    file = open(output_file,'w',newline='') if output_file else sys.stdout
+    if output=='json':
+        records = [{'date': dates[day].isoformat(),
+                    'expected': {dx: ili_tracker_results[dx][day] for dx in diseases},
+                    'daily_log_probability': daily_log_probability[day],
+                    'empirical_p': None if isnan(p_values[day]) else p_values[day]} for day in range(len(dates))]
+        json.dump(records, file)
+        file.write('\n')
+    else:
+        writer = csv.writer(file)
+        writer.writerow(['date']+diseases+['daily_log_probability','empirical_p'])
+        for day in range(len(dates)):
+            writer.writerow([dates[day].isoformat()]+[ili_tracker_results[dx][day] for dx in diseases]+
+                            [daily_log_probability[day], '' if isnan(p_values[day]) else p_values[day]])
+    if output_file: file.close()
 
-output_png_file = data_directory + os.sep + data_file + '.png'
-plt.savefig(output_png_file)
+def plot_results(output_png_file, dates, diseases, ili_tracker_results):
+    plt = pyplot()
+    daily_log_probability = ili_tracker_results['daily_log_probability']
 
-print("The Output of ILI Tracker saved to: ", output_png_file)
+    xticks = [day for day, date in enumerate(dates) if date.day==1]
+    xticklabels = [str(dates[d].month)+'/'+str(dates[d].year) for d in xticks]
 
+    # ----------------------------------------------------------------------
+
+    fig, axes = plt.subplots(len(diseases) + 1)
+    fig.tight_layout(pad=2.0)
+    fig.set_size_inches(16,10)
+
+    for i in range(len(diseases)):
+        axes[i].set_title(diseases[i])
+        axes[i].plot(moving_average(moving_average_window,ili_tracker_results[diseases[i]]), color='blue')
+        axes[i].set_ylabel('ILI Tracker', color='blue')
+        axes[i].set_xticks(xticks)
+        axes[i].set_xticklabels(xticklabels)
+        axes[i].secondary_xaxis("top")
+    axes[len(diseases)].set_title('Daily Log Probability')
+    axes[len(diseases)].plot(moving_average(moving_average_window, daily_log_probability), color='red')
+    axes[len(diseases)].set_ylabel('Log Probability', color='red')
+    axes[len(diseases)].set_xticks(xticks)
+    axes[len(diseases)].set_xticklabels(xticklabels)
+    axes[len(diseases)].secondary_xaxis("top")
+    axes[len(diseases)].set_xlabel('Date')
+
+    plt.savefig(output_png_file)
+    plt.close(fig)
+
+def plot_level(output_png_file, level, diseases, groups):
+    """Like plot_results(), with one line per shard of the level over all of their days."""
+    if len(groups)==1:
+        (dates, _, results), = groups.values()
+        return plot_results(output_png_file, dates, diseases, results)
+    plt = pyplot()
+    dates = sorted(set().union(*[group_dates for group_dates, _, _ in groups.values()]))
+    index = {d: day for day, d in enumerate(dates)}
+
+    xticks = [day for day, date in enumerate(dates) if date.day==1]
+    xticklabels = [str(dates[d].month)+'/'+str(dates[d].year) for d in xticks]
+
+    fig, axes = plt.subplots(len(diseases) + 1)
+    fig.tight_layout(pad=2.0)
+    fig.set_size_inches(16,10)
+
+    titles = diseases+['Daily Log Probability']
+    for key, (group_dates, _, results) in groups.items():
+        for i in range(len(diseases)):
+            # a day without patients of the shard expects none
+            series = [0.0]*len(dates)
+            for day, value in zip(group_dates, results[diseases[i]]): series[index[day]] = value
+            axes[i].plot(moving_average(moving_average_window, series), label='/'.join(key))
+        # but has no log probability: average it over the shard's own days
+        axes[len(diseases)].plot([index[day] for day in group_dates],
+                                 moving_average(moving_average_window, results['daily_log_probability']), label='/'.join(key))
+    for i in range(len(titles)):
+        axes[i].set_title(titles[i]+' by '+level)
+        axes[i].set_ylabel('ILI Tracker' if i<len(diseases) else 'Log Probability')
+        axes[i].set_xticks(xticks)
+        axes[i].set_xticklabels(xticklabels)
+        axes[i].secondary_xaxis("top")
+    axes[0].legend(loc='upper right', fontsize='small', ncol=4)
+    axes[len(diseases)].set_xlabel('Date')
+
+    plt.savefig(output_png_file)
+    plt.close(fig)
+
+# ------------------------------------------------------------------------
+# Command Line Arguments
 # ------------------------------------------------------------------------
 
-quit()
+def main():
+    global data_directory, data_file, diseases
+
+    parser = argparse.ArgumentParser(description='ILI Tracker')
+    parser.add_argument('--data_directory', type=str, default='./data', help='Directory containing the data file')
+    parser.add_argument('--data_file', type=str, default='Sample_Data.csv', help='Data file')
+    parser.add_argument('--diseases', type=str, default='INFLUENZA,RSV,HMPV,PARAINFLUENZA,OTHER', help='List of diseases')
+    parser.add_argument('--checkpoint', type=str, default=None, help='Resume from and update this checkpoint file')
+    parser.add_argument('--output_png', type=str, default=None, help='Plot file (default <data_directory>/<data_file>.png)')
+    parser.add_argument('--start', type=date.fromisoformat, default=None, help='First admission date to track (YYYY-MM-DD)')
+    parser.add_argument('--end', type=date.fromisoformat, default=None, help='Last admission date to track (YYYY-MM-DD)')
+    parser.add_argument('--cache', action='store_true', help='Keep the parsed data file in <data_file>.cache for later runs')
+    parser.add_argument('--no-plot', dest='plot', action='store_false', help='Do not draw the plot (matplotlib is not imported)')
+    parser.add_argument('--output', choices=['json','csv'], default=None, help='Write the daily results as json or csv')
+    parser.add_argument('--output_file', type=str, default=None, help='File for --output (default stdout)')
+    parser.add_argument('--quiet', dest='verbose', action='store_false', help='Print nothing without --output (for the pipeline)')
+    parser.add_argument('--shard_by', type=str, default=None,
+                        help='Comma separated site fields, coarsest first (e.g. Region,Site): track each site separately and add them up per level')
+    parser.add_argument('--processes', type=int, default=None, help='Processes tracking shards at once with --shard_by (default one per CPU)')
+
+    args = parser.parse_args()
+    if args.diseases:
+        diseases = args.diseases.split(',')
+    if args.data_directory:
+        data_directory = args.data_directory
+    if args.data_file:
+        data_file = args.data_file
+
+    if args.shard_by:
+        run_sharded_ili_tracker(data_directory, data_file, diseases, args.shard_by.split(','), args.checkpoint, args.output_png,
+                                args.start, args.end, args.cache, args.plot, args.output, args.output_file, args.processes,
+                                args.verbose)
+    else:
+        run_ili_tracker(data_directory, data_file, diseases, args.checkpoint, args.output_png, args.start, args.end, args.cache,
+                        args.plot, args.output, args.output_file, args.verbose)
 
 # ------------------------------------------------------------------------
 
+if __name__ == "__main__":
+    main()
+
+# ------------------------------------------------------------------------
@@ -0,0 +1,84 @@
+#!/usr/bin/env python3
+"""Per-document ann2arff conversion time over the mailboxes/metamap_archive
+reports, annotated with fake_metamap.py.
+
+"list scan" is the conversion as it was before the header index: a
+membership test against the 26,008-name header list per concept, then a
+walk over every column to build the row.
+"""
+
+import argparse
+import contextlib
+import glob
+import io
+import os
+import statistics
+import sys
+import tempfile
+import time
+
+REPO = os.path.abspath(os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+sys.path.insert(0, os.path.join(REPO, 'brat2csv'))
+
+import ann2arff
+import fake_metamap
+
+
+def list_scan_row(input_file, header_array):
+    c = ann2arff.collate(ann2arff.brat_load(input_file))
+    kept_cuis = {}
+    for cui in c:
+        status = "N" if c[cui]['count'] == c[cui]['negated'] else "P"
+        if "C_D_" + cui in header_array:
+            kept_cuis["C_D_" + cui] = status
+    return [kept_cuis.get(name, "M") for name in header_array]
+
+
+def make_documents(directory):
+    dictionary = fake_metamap.load_dictionary()
+    documents = []
+    for report in sorted(glob.glob(os.path.join(REPO, 'mailboxes', 'metamap_archive', '*.txt'))):
+        with open(report, 'r') as f:
+            text = f.read()
+        path = os.path.join(directory, os.path.basename(report).replace('.txt', '.ann'))
+        with open(path, 'w') as out:
+            out.write('\n'.join(fake_metamap.annotate(text, dictionary)) + '\n')
+        documents.append(path)
+    return documents
+
+
+def time_per_document(convert, documents, repeat):
+    times = []
+    for _ in range(repeat):
+        for document in documents:
+            start = time.perf_counter()
+            convert(document)
+            times.append(time.perf_counter() - start)
+    return times
+
+
+def report(label, times):
+    print(f"{label:<14} median {1000 * statistics.median(times):7.3f} ms/doc"
+          f"   mean {1000 * statistics.mean(times):7.3f} ms/doc")
+
+
+def main():
+    parser = argparse.ArgumentParser(description='ann2arff per-document conversion time')
+    parser.add_argument('-r', '--repeat', type=int, default=5, help='Passes over the archive')
+    args = parser.parse_args()
+
+    header_array = ann2arff.read_header()
+    header_index = ann2arff.index_header(header_array)
+    with tempfile.TemporaryDirectory() as directory:
+        documents = make_documents(directory)
+        with contextlib.redirect_stdout(io.StringIO()):
+            before = time_per_document(lambda d: list_scan_row(d, header_array), documents, args.repeat)
+            after = time_per_document(lambda d: ann2arff.concept_row(d, header_array, header_index), documents, args.repeat)
+
+    print(f"{len(documents)} documents x {args.repeat} passes")
+    report("list scan", before)
+    report("header index", after)
+
+
+if __name__ == "__main__":
+    main()
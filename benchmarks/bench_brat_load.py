@@ -0,0 +1,100 @@
+#!/usr/bin/env python3
+"""BRAT parsing time over the mailboxes/metamap_archive reports, annotated
+with fake_metamap.py.
+
+"regex" is collate(brat_load()), a regex per reference kind and a dict per
+trigger; "single pass" is brat_concepts().  MetaMap Lite lists every source
+vocabulary of a concept on its own N line, so each Source line of the fake
+annotation is repeated for --sources vocabularies.  The two parsers' counts
+are compared on every document and on a few hand-written edge cases.
+"""
+
+import argparse
+import contextlib
+import io
+import os
+import sys
+import tempfile
+
+from bench_ann2arff import REPO, make_documents, time_per_document, report
+
+sys.path.insert(0, os.path.join(REPO, 'brat2csv'))
+
+import ann2arff
+
+VOCABULARIES = ['MSH', 'MTH', 'SNOMEDCT_US', 'NCI', 'MEDLINEPLUS', 'LNC', 'CHV', 'ICD10CM', 'MEDCIN', 'RCD']
+
+# N lines that refer to an earlier trigger, of an unknown kind, or malformed,
+# and a Negated line that is not the last reference of its trigger
+EDGE_CASES = """T1\tsosy 0 5\tcough
+N1\tReference T1 ConceptId:C0010200\tCoughing
+N2\tReference T1 Source:C0010200:MSH\tMSH
+N3\tReference T1 Temporality:Recent\tRecent
+T2\tsosy 10 15\tfever
+N4\tReference T2 ConceptId:C0015967\tFever
+N5\tReference T1 SemanticType:C0010200:sosy\tsosy
+N6\tReference T2 Temporality:Historical\tHistorical
+T3\tsosy 20 25\tcough
+N7\tReference T3 Negated:True\tTrue
+N8\tReference T3 ConceptId:C0010200\tCough
+N9\tReference T3 SemanticType:C0010200:sosy\tsosy
+N10\tReference T3 Temporality:Recent\tRecent
+T4\tsosy 30 35\tfever
+N11\tReference T4 ConceptId:C0015967\tFever
+N12\tReference T4 Temporality:Recent\tRecent
+N13\tReference T4 Subject:Patient\tPatient
+T5\tsosy 40 45\tfever
+N14\tReference T5 ConceptId:C0015967\tFever
+N15\tReference T5 Source:C0015967\tMSH
+N16\tReference T5 Temporality:Recent\tRecent
+garbage line
+"""
+
+
+def add_sources(document, sources):
+    with open(document, 'r') as f:
+        lines = f.read().splitlines()
+    out = []
+    for line in lines:
+        out.append(line)
+        if '\tReference ' in line and ' Source:' in line:
+            prefix = line.rsplit(':', 1)[0]
+            out.extend(f"{prefix}:{v}\t{v}" for v in VOCABULARIES[1:sources])
+    n = 0
+    with open(document, 'w') as f:
+        for line in out:
+            if line.startswith('N'):
+                n += 1
+                line = f"N{n}\t{line.split(chr(9), 1)[1]}"
+            f.write(line + '\n')
+
+
+def main():
+    parser = argparse.ArgumentParser(description='BRAT parsing time per document')
+    parser.add_argument('-r', '--repeat', type=int, default=20, help='Passes over the archive')
+    parser.add_argument('-s', '--sources', type=int, default=5, help='Source vocabularies per concept')
+    args = parser.parse_args()
+
+    with tempfile.TemporaryDirectory() as directory:
+        documents = make_documents(directory)
+        for document in documents:
+            add_sources(document, args.sources)
+        edge_cases = os.path.join(directory, 'edge_cases.ann')
+        with open(edge_cases, 'w') as f:
+            f.write(EDGE_CASES)
+        lines = sum(1 for document in documents for _ in open(document))
+
+        with contextlib.redirect_stdout(io.StringIO()):
+            differing = [os.path.basename(d) for d in documents + [edge_cases]
+                         if ann2arff.collate(ann2arff.brat_load(d)) != ann2arff.brat_concepts(d)]
+            before = time_per_document(lambda d: ann2arff.collate(ann2arff.brat_load(d)), documents, args.repeat)
+            after = time_per_document(ann2arff.brat_concepts, documents, args.repeat)
+
+    print(f"{len(documents)} documents ({lines / len(documents):.0f} lines each) x {args.repeat} passes")
+    report("regex", before)
+    report("single pass", after)
+    print("same concept counts on every document" if not differing else f"counts differ: {', '.join(differing)}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,153 @@
+#!/usr/bin/env python3
+"""ili_tracker time on a synthetic multi-year dataset with many patients a day.
+
+Log-likelihoods are drawn around the *_loglikelihood_T values of
+PDS/data/Sample_Data.csv and held in memory, so no CSV of that size is
+written.  "patient loop" is ili_tracker as it was before it was vectorized:
+per-patient lists and a pairwise logaddexp per disease.  It is run on the
+first --reference-days days only and its results are compared with the
+vectorized tracker's on those days.  Exits 1 if they differ by more than
+--tolerance, or if a missing log-likelihood does not raise ValueError as
+the patient loop's float('M') did.
+"""
+
+import argparse
+import csv
+import os
+import sys
+import time
+from datetime import date, timedelta
+from math import log, exp, e, nan
+
+import numpy as np
+
+REPO = os.path.abspath(os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+sys.path.insert(0, os.path.join(REPO, 'PDS'))
+
+from ILI_Tracker import ili_tracker, _normalize, MIN_POSTERIOR
+from Misc import normalize
+from Patient import PatientView
+
+DISEASES = ['INFLUENZA', 'RSV', 'HMPV', 'PARAINFLUENZA', 'OTHER']
+FIELDS = [dx + '_loglikelihood_T' for dx in DISEASES]
+SAMPLE = os.path.join(REPO, 'PDS', 'data', 'Sample_Data.csv')
+
+
+class SyntheticData:
+    """The parts of the Data interface that ili_tracker reads."""
+
+    def __init__(self, days, per_day, seed=0):
+        with open(SAMPLE, 'r') as f:
+            rows = list(csv.DictReader(f))
+        base = np.array([[float(row[field]) for field in FIELDS] for row in rows])
+        rng = np.random.default_rng(seed)
+        picks = rng.integers(len(base), size=days * per_day)
+        matrix = base[picks] + rng.normal(0.0, 2.0, size=(days * per_day, len(FIELDS)))
+        self.columns = {field: matrix[:, i].copy() for i, field in enumerate(FIELDS)}
+        self.offsets = np.arange(days + 1) * per_day
+
+    def number_of_days(self): return len(self.offsets) - 1
+
+    def rows(self, day): return slice(int(self.offsets[day]), int(self.offsets[day + 1]))
+
+    def values(self, field, day=None):
+        return self.columns[field] if day is None else self.columns[field][self.rows(day)]
+
+    def patients(self, day): return [PatientView(self, row) for row in range(self.offsets[day], self.offsets[day + 1])]
+
+    def get_value(self, row, field): return self.columns[field][row]
+
+    def date(self, day): return date(2000, 1, 1) + timedelta(days=day)
+
+    def truncated(self, days):
+        data = SyntheticData.__new__(SyntheticData)
+        data.columns = {field: column[:self.offsets[days]] for field, column in self.columns.items()}
+        data.offsets = self.offsets[:days + 1]
+        return data
+
+
+def _logsum(logs):
+    result = logs[0]
+    for i in range(1, len(logs)): result = np.logaddexp(result, logs[i])
+    return result
+
+
+def patient_loop(diseases, original_priors, log_likelihood_fields, eqs, base, data):
+    original_priors[len(original_priors) - 1] = 1.0 - sum(original_priors[0:len(original_priors) - 1])
+    priors = original_priors
+    result = {dx: [] for dx in diseases}
+    daily_log_probability = []
+    for day in range(data.number_of_days()):
+        log_priors = [log(prior) for prior in priors]
+        expected = [0.0 for dx in diseases]
+        log_probability_day = 0.0
+        patients = data.patients(day)
+        for patient in patients:
+            log_likelihoods = [(float(patient.get_value(field)) / log(e, base)) for field in log_likelihood_fields]
+            log_posteriors = [ll + p for (ll, p) in zip(log_likelihoods, log_priors)]
+            log_denominator = _logsum(log_posteriors)
+            probabilities = [exp(lp - log_denominator) for lp in log_posteriors]
+            expected = [x + p for (x, p) in zip(expected, probabilities)]
+            log_probability_day += log_denominator
+        for i in range(len(diseases)): result[diseases[i]].append(expected[i])
+        total = sum(expected)
+        posteriors = [(x + (eqs * prior)) / (total + eqs) for (x, prior) in zip(expected, original_priors)]
+        priors = _normalize(posteriors, MIN_POSTERIOR)
+        daily_log_probability.append(log_probability_day / len(patients))
+    result['daily_log_probability'] = daily_log_probability
+    return result
+
+
+def run(tracker, data):
+    priors = normalize([(0.1 / (len(DISEASES) - 1)) if dx != 'OTHER' else 0.9 for dx in DISEASES], 1.0)
+    start = time.perf_counter()
+    result = tracker(DISEASES, priors, FIELDS, 10, 10.0, data)
+    return result, time.perf_counter() - start
+
+
+def max_relative_difference(a, b):
+    worst = 0.0
+    for key in a:
+        x, y = np.array(a[key], dtype=float), np.array(b[key], dtype=float)
+        worst = max(worst, float(np.max(np.abs(x - y) / np.maximum(np.abs(y), 1e-300))))
+    return worst
+
+
+def main():
+    parser = argparse.ArgumentParser(description='ili_tracker time per day')
+    parser.add_argument('-y', '--years', type=float, default=3, help='Years of daily data')
+    parser.add_argument('-p', '--per-day', type=int, default=10000, help='Patients per day')
+    parser.add_argument('-r', '--reference-days', type=int, default=30, help='Days to run the patient loop on')
+    parser.add_argument('-t', '--tolerance', type=float, default=1e-9, help='Largest relative difference allowed')
+    args = parser.parse_args()
+
+    days = int(365 * args.years)
+    data = SyntheticData(days, args.per_day)
+    reference_days = min(args.reference_days, days)
+    before, before_seconds = run(patient_loop, data.truncated(reference_days))
+    after, after_seconds = run(ili_tracker, data)
+    after_prefix = {key: values[:reference_days] for key, values in after.items()}
+
+    print(f"{days} days x {args.per_day} patients")
+    print(f"patient loop  {1000 * before_seconds / reference_days:8.2f} ms/day  ({reference_days} days)")
+    print(f"vectorized    {1000 * after_seconds / days:8.2f} ms/day  ({days} days, {after_seconds:.2f} s)")
+    difference = max_relative_difference(after_prefix, before)
+    print(f"max relative difference over the first {reference_days} days: {difference:.2e}")
+
+    missing = data.truncated(reference_days)
+    missing.columns = {field: column.copy() for field, column in missing.columns.items()}
+    missing.columns[FIELDS[1]][missing.rows(reference_days // 2)][0] = nan
+    try:
+        run(ili_tracker, missing)
+        raised = None
+    except ValueError as error:
+        raised = error
+    print(f"missing log-likelihood: {raised if raised else 'not detected'}")
+
+    ok = difference <= args.tolerance and raised is not None
+    print("Tracker OK" if ok else f"Tracker FAILED (tolerance {args.tolerance})")
+    sys.exit(0 if ok else 1)
+
+
+if __name__ == "__main__":
+    main()
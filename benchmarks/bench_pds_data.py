@@ -0,0 +1,102 @@
+#!/usr/bin/env python3
+"""Load time and memory of PDS Data on a synthetic multi-year CDS output file.
+
+The file repeats the rows of PDS/data/Sample_Data.csv with new IDs and
+admission dates.  "patient rows" is the loader as it was before the
+columnar Data: one Patient (a defaultdict of every field) per row, grouped
+in per-date lists.  "tracker only" keeps just the fields Run_ILI_Tracker
+reads.  "cache build" parses the file into its .npy cache directory and
+"cached" memory-maps the tracker fields from it.
+"""
+
+import argparse
+import csv
+import os
+import random
+import shutil
+import sys
+import tempfile
+import time
+import tracemalloc
+from datetime import date, timedelta
+
+REPO = os.path.abspath(os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+sys.path.insert(0, os.path.join(REPO, 'PDS'))
+
+from Data import Data
+from Patient import Patient
+
+SAMPLE = os.path.join(REPO, 'PDS', 'data', 'Sample_Data.csv')
+ARGS = ('Admit_date_time', ',', 'M', 'M')
+
+
+def make_data_file(path, days, per_day, start=date(2014, 7, 1), seed=0):
+    """Write days x per_day rows sampled from Sample_Data.csv to path."""
+    with open(SAMPLE, 'r') as f:
+        reader = csv.reader(f)
+        header = next(reader)
+        rows = list(reader)
+    id_field, date_field = header.index('ID'), header.index('Admit_date_time')
+    rng = random.Random(seed)
+    with open(path, 'w', newline='') as f:
+        writer = csv.writer(f)
+        writer.writerow(header)
+        n = 0
+        for day in range(days):
+            admitted = (start + timedelta(days=day)).isoformat()
+            for _ in range(per_day):
+                row = list(rng.choice(rows))
+                n += 1
+                row[id_field] = str(n)
+                row[date_field] = f"{admitted} {rng.randrange(24):02d}:{rng.randrange(60):02d}:00"
+                writer.writerow(row)
+    return n
+
+
+class PatientRows:
+    def __init__(self, admission_date_field, delimiter, file_missing_value, data_missing_value, file_name):
+        self.data = dict()
+        with open(file_name, 'r') as file:
+            reader = csv.reader(file, delimiter=delimiter)
+            header = next(reader)
+            index_of_admission_date_field = header.index(admission_date_field)
+            for row in reader:
+                d = row[index_of_admission_date_field]
+                pt_date = date(int(d[0:4]), int(d[5:7]), int(d[8:10]))
+                self.data.setdefault(pt_date, []).append(Patient(header, row, file_missing_value, data_missing_value))
+
+
+def measure(loader, path):
+    start = time.perf_counter()
+    loader(*ARGS, path)
+    seconds = time.perf_counter() - start
+    tracemalloc.start()
+    data = loader(*ARGS, path)
+    retained, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    del data
+    return seconds, retained, peak
+
+
+def main():
+    parser = argparse.ArgumentParser(description='PDS Data load time and memory')
+    parser.add_argument('-d', '--days', type=int, default=730, help='Days of data')
+    parser.add_argument('-p', '--per-day', type=int, default=100, help='Patients per day')
+    args = parser.parse_args()
+
+    with tempfile.TemporaryDirectory() as directory:
+        path = os.path.join(directory, 'data.csv')
+        rows = make_data_file(path, args.days, args.per_day)
+        print(f"{rows} rows, {os.path.getsize(path) / 1e6:.1f} MB")
+        tracker_fields = ['ID'] + [f"{dx}_loglikelihood_T" for dx in ('INFLUENZA', 'RSV', 'HMPV', 'PARAINFLUENZA', 'OTHER')]
+        loaders = (('patient rows', PatientRows), ('columnar', Data),
+                   ('tracker only', lambda *a: Data(*a, fields=tracker_fields)),
+                   ('cache build', lambda *a: shutil.rmtree(path + '.cache', ignore_errors=True) or Data(*a, cache=True)),
+                   ('cached', lambda *a: Data(*a, fields=tracker_fields, cache=True)))
+        for label, loader in loaders:
+            seconds, retained, peak = measure(loader, path)
+            print(f"{label:<13} {seconds:6.3f} s   retained {retained / 1e6:7.1f} MB   peak {peak / 1e6:7.1f} MB")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,319 @@
+#!/usr/bin/env python3
+"""End-to-end throughput of the mailbox pipeline.
+
+Runs com/file_watcher.py against a temporary copy of the /opt tree
+(PDS_BASE_PATH), with fake_metamap.py as metamaplite.sh and, for
+--engine java, fake_cds_jvm.py as java, so no UMLS license or JVM is
+needed.  N reports from generate_reports.py are renamed into
+metamap_inbox, all at once or at --rate reports per second.
+
+A report's end-to-end latency runs from its arrival in metamap_inbox to
+the end of the first PDS run that started after CDS wrote its row; both
+come from the watcher's trace file.  Peak RSS is taken per stage: from
+wait4() for the subprocesses in the trace, from the warm workers' RSS
+gauges (sampled) and from the watcher's own VmHWM for the stages that run
+in it.
+
+--json writes the results; --baseline compares them with an earlier
+--json file and exits 1 if throughput fell, or p95 latency rose, by more
+than --max-regression.
+"""
+
+import argparse
+import collections
+import json
+import os
+import shutil
+import signal
+import socket
+import subprocess
+import sys
+import tempfile
+import time
+import urllib.request
+
+REPO = os.path.abspath(os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+sys.path.insert(0, os.path.join(REPO, 'benchmarks'))
+
+from generate_reports import generate
+
+FILE_WATCHER = os.path.join(REPO, 'com', 'file_watcher.py')
+LINKED = ['com', 'brat2csv', 'cds', 'PDS', 'models']
+MAILBOXES = ['metamap_inbox', 'metamap_archive', 'brat2csv_inbox', 'brat2csv_archive', 'cds_inbox', 'cds_archive',
+             'pds_inbox', 'pds_archive', 'pds_outbox']
+STAGES = ['metamap', 'brat2csv', 'cds', 'pds']
+FAKES = {'public_mm_lite/metamaplite.sh': 'fake_metamap.py', 'bin/java': 'fake_cds_jvm.py'}
+SAMPLE_INTERVAL = 0.5
+
+
+def make_tree(base):
+    """Lay out PDS_BASE_PATH: the repo's directories, empty mailboxes and the fakes."""
+    for name in LINKED:
+        os.symlink(os.path.join(REPO, name), os.path.join(base, name))
+    for name in MAILBOXES:
+        os.makedirs(os.path.join(base, 'mailboxes', name))
+    for path, fake in FAKES.items():
+        path = os.path.join(base, path)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        with open(path, 'w') as f:
+            f.write(f'#!/bin/sh\nexec "{sys.executable}" "{os.path.join(REPO, "benchmarks", fake)}" "$@"\n')
+        os.chmod(path, 0o755)
+
+
+def free_port():
+    with socket.socket() as s:
+        s.bind(('127.0.0.1', 0))
+        return s.getsockname()[1]
+
+
+def scrape(port):
+    """{(name, labels): value} from the watcher's metrics endpoint."""
+    with urllib.request.urlopen(f"http://127.0.0.1:{port}/metrics", timeout=2) as response:
+        text = response.read().decode('utf-8')
+    samples = {}
+    for line in text.splitlines():
+        if line and not line.startswith('#'):
+            name, value = line.rsplit(' ', 1)
+            samples[name] = float(value)
+    return samples
+
+
+def peak_rss(pid):
+    """VmHWM of a running process in bytes."""
+    with open(f"/proc/{pid}/status", 'r') as f:
+        for line in f:
+            if line.startswith('VmHWM:'):
+                return int(line.split()[1]) * 1024
+    return 0
+
+
+def read_trace(filename):
+    records = []
+    if os.path.exists(filename):
+        with open(filename, 'r') as f:
+            for line in f:
+                if line.endswith('\n'):
+                    records.append(json.loads(line))
+    return records
+
+
+def percentile(values, p):
+    """Nearest-rank percentile."""
+    values = sorted(values)
+    return values[min(len(values) - 1, max(0, -(-len(values) * p // 100) - 1))] if values else float('nan')
+
+
+def finished(records, documents):
+    """Whether every document reached CDS or failed, and PDS has run since the last CDS row."""
+    done, cds_end = set(), 0.0
+    pds_starts = []
+    for record in records:
+        if record['stage'] == 'pds':
+            pds_starts.append(record['time'])
+        elif record['status'] != 'ok' or record['stage'] == 'cds':
+            done.add(record['doc'])
+            if record['stage'] == 'cds':
+                cds_end = max(cds_end, record['time'] + record['run_seconds'])
+    return documents <= done and any(start >= cds_end for start in pds_starts)
+
+
+def latencies(records, submitted):
+    """End-to-end seconds per document, and the documents that failed."""
+    pds_runs = sorted((r['time'], r['time'] + r['run_seconds']) for r in records if r['stage'] == 'pds')
+    cds_end, failed = {}, set()
+    for record in records:
+        if record['doc'] not in submitted:
+            continue
+        if record['status'] != 'ok':
+            failed.add(record['doc'])
+        elif record['stage'] == 'cds':
+            cds_end[record['doc']] = record['time'] + record['run_seconds']
+    result = {}
+    for doc, end in cds_end.items():
+        tracked = next((finish for start, finish in pds_runs if start >= end), None)
+        if tracked is not None:
+            result[doc] = tracked - submitted[doc]
+    return result, failed
+
+
+def stage_stats(records, submitted, tracked, worker_rss, watcher_rss, engine, worker_mode):
+    """Runs, run time, queue wait and peak RSS per stage.  PDS runs over the
+    CDS output, not single reports; its documents are those it tracked."""
+    stats = {}
+    in_watcher = {'cds'} if engine == 'python' else set()
+    warm = {'brat2csv', 'pds'} if worker_mode == 'warm' else set()
+    for stage in STAGES:
+        stage_records = [r for r in records if r['stage'] == stage]
+        runs = {}
+        for record in stage_records:
+            runs[(record['time'], record['run_seconds'])] = record
+        rss = [p['max_rss'] for r in runs.values() for p in r.get('subprocesses', [])]
+        if stage in warm:
+            rss += worker_rss.get(stage, [])
+        if stage in in_watcher:
+            rss.append(watcher_rss)
+        stats[stage] = {
+            'documents': tracked if stage == 'pds' else sum(1 for r in stage_records if r['doc'] in submitted),
+            'runs': len(runs),
+            'run_p50_ms': 1000 * percentile([r['run_seconds'] for r in runs.values()], 50),
+            'queue_wait_p95_ms': 1000 * percentile([r['queue_wait_seconds'] for r in runs.values()
+                                                    if 'queue_wait_seconds' in r], 95),
+            'peak_rss_mb': max(rss, default=0) / (1 << 20),
+            'rss_from': 'watcher' if stage in in_watcher else 'workers' if stage in warm else 'wait4',
+        }
+    return stats
+
+
+def run(args, base):
+    make_tree(base)
+    staging = os.path.join(base, 'staging')
+    os.makedirs(staging)
+    names = []
+    for name, text in generate(args.n, args.seed):
+        with open(os.path.join(staging, name), 'w', newline='') as f:
+            f.write(text)
+        names.append(name)
+
+    port = free_port()
+    trace_file = os.path.join(base, 'mailboxes', 'pipeline_trace.jsonl')
+    env = dict(os.environ, PDS_BASE_PATH=base, PDS_CDS_ENGINE=args.engine, PDS_WORKER_MODE=args.worker_mode,
+               PDS_METRICS_PORT=str(port), PDS_TRACE_FILE=trace_file,
+               PATH=os.path.join(base, 'bin') + os.pathsep + os.environ.get('PATH', ''))
+    for setting in args.env:
+        key, _, value = setting.partition('=')
+        env[key] = value
+    log = open(os.path.join(base, 'file_watcher.log'), 'w')
+    watcher = subprocess.Popen([sys.executable, '-u', FILE_WATCHER], cwd=os.path.dirname(FILE_WATCHER), env=env,
+                               stdout=log, stderr=subprocess.STDOUT)
+    worker_rss = collections.defaultdict(list)
+    try:
+        deadline = time.monotonic() + 120
+        while True:
+            if watcher.poll() is not None:
+                raise RuntimeError(f"file_watcher.py exited with {watcher.returncode}, see {log.name}")
+            try:
+                scrape(port)
+                break
+            except OSError:
+                if time.monotonic() > deadline:
+                    raise RuntimeError(f"file_watcher.py did not start, see {log.name}")
+                time.sleep(0.2)
+
+        inbox = os.path.join(base, 'mailboxes', 'metamap_inbox')
+        submitted = {}
+        documents = {os.path.splitext(name)[0] for name in names}
+        start = time.time()
+        deadline = time.monotonic() + args.timeout
+        next_sample = 0.0
+        pending = list(names)
+        while time.monotonic() < deadline:
+            now = time.time()
+            while pending and (not args.rate or len(submitted) < (now - start) * args.rate):
+                name = pending.pop(0)
+                os.rename(os.path.join(staging, name), os.path.join(inbox, name))
+                submitted[os.path.splitext(name)[0]] = time.time()
+            if time.monotonic() >= next_sample:
+                next_sample = time.monotonic() + SAMPLE_INTERVAL
+                try:
+                    for sample, value in scrape(port).items():
+                        if sample.startswith('pds_worker_rss_bytes'):
+                            worker_rss[sample.split('worker="', 1)[1].split('-', 1)[0]].append(value)
+                except OSError:
+                    pass
+                if not pending and finished(read_trace(trace_file), documents):
+                    break
+            time.sleep(0.01 if pending and args.rate else 0.05)
+        watcher_rss = peak_rss(watcher.pid)
+    finally:
+        watcher.send_signal(signal.SIGINT)
+        try:
+            watcher.wait(timeout=30)
+        except subprocess.TimeoutExpired:
+            watcher.kill()
+            watcher.wait()
+        log.close()
+
+    records = read_trace(trace_file)
+    seconds, failed = latencies(records, submitted)
+    end = max((submitted[doc] + s for doc, s in seconds.items()), default=time.time())
+    return {
+        'documents': len(names),
+        'engine': args.engine,
+        'worker_mode': args.worker_mode,
+        'rate': args.rate,
+        'settings': args.env,
+        'completed': len(seconds),
+        'failed': len(failed),
+        'docs_per_second': len(seconds) / (end - start) if seconds else 0.0,
+        'latency_ms': {f"p{p}": 1000 * percentile(list(seconds.values()), p) for p in (50, 95, 99)},
+        'stages': stage_stats(records, submitted, len(seconds), worker_rss, watcher_rss, args.engine, args.worker_mode),
+        'watcher_peak_rss_mb': watcher_rss / (1 << 20),
+    }
+
+
+def print_results(results):
+    arrival = f"{results['rate']:g} reports/s" if results['rate'] else "all at once"
+    settings = ''.join(f", {setting}" for setting in results['settings'])
+    print(f"{results['documents']} reports {arrival}, CDS engine {results['engine']}, "
+          f"{results['worker_mode']} workers{settings}")
+    print(f"completed {results['completed']}, failed {results['failed']}")
+    print(f"throughput  {results['docs_per_second']:8.2f} docs/s")
+    latency = results['latency_ms']
+    print(f"end to end  p50 {latency['p50']:8.1f} ms   p95 {latency['p95']:8.1f} ms   p99 {latency['p99']:8.1f} ms")
+    print(f"{'stage':<10}{'docs':>6}{'runs':>6}{'run p50 ms':>12}{'wait p95 ms':>13}{'peak RSS MB':>13}  from")
+    for stage, s in results['stages'].items():
+        print(f"{stage:<10}{s['documents']:>6}{s['runs']:>6}{s['run_p50_ms']:>12.1f}{s['queue_wait_p95_ms']:>13.1f}"
+              f"{s['peak_rss_mb']:>13.1f}  {s['rss_from']}")
+    print(f"watcher peak RSS {results['watcher_peak_rss_mb']:.1f} MB")
+
+
+def regressions(results, baseline, limit):
+    found = []
+    if results['docs_per_second'] < baseline['docs_per_second'] * (1 - limit):
+        found.append(f"throughput {results['docs_per_second']:.2f} docs/s, baseline {baseline['docs_per_second']:.2f}")
+    if results['latency_ms']['p95'] > baseline['latency_ms']['p95'] * (1 + limit):
+        found.append(f"p95 latency {results['latency_ms']['p95']:.1f} ms, baseline {baseline['latency_ms']['p95']:.1f}")
+    if results['failed'] > baseline['failed']:
+        found.append(f"{results['failed']} failed reports, baseline {baseline['failed']}")
+    return found
+
+
+def main():
+    parser = argparse.ArgumentParser(description='End-to-end mailbox pipeline throughput and latency')
+    parser.add_argument('-n', type=int, default=200, help='Number of reports')
+    parser.add_argument('-s', '--seed', type=int, default=0, help='Seed of the report generator')
+    parser.add_argument('-r', '--rate', type=float, default=0.0, help='Reports per second (default: all at once)')
+    parser.add_argument('--engine', choices=['python', 'java'], default='python', help='CDS engine')
+    parser.add_argument('--worker-mode', choices=['warm', 'cold'], default='warm', help='brat2csv and PDS workers')
+    parser.add_argument('-e', '--env', action='append', default=[], metavar='NAME=VALUE',
+                        help='Environment setting for the watcher, e.g. PDS_METAMAP_BATCH_SIZE=1')
+    parser.add_argument('-t', '--timeout', type=float, default=600, help='Seconds to wait for the reports')
+    parser.add_argument('--json', help='Write the results to this file')
+    parser.add_argument('--baseline', help='Results of an earlier --json run to compare with')
+    parser.add_argument('--max-regression', type=float, default=0.2, help='Allowed fractional regression')
+    parser.add_argument('--keep', action='store_true', help='Keep the temporary tree and print its path')
+    args = parser.parse_args()
+
+    base = tempfile.mkdtemp(prefix='pds-bench-')
+    try:
+        results = run(args, base)
+    finally:
+        if args.keep:
+            print(f"tree kept in {base}")
+        else:
+            shutil.rmtree(base, ignore_errors=True)
+
+    print_results(results)
+    if args.json:
+        with open(args.json, 'w') as f:
+            json.dump(results, f, indent=2)
+    if args.baseline:
+        with open(args.baseline, 'r') as f:
+            found = regressions(results, json.load(f), args.max_regression)
+        for problem in found:
+            print(f"REGRESSION: {problem}")
+        sys.exit(1 if found else 0)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,70 @@
+#!/usr/bin/env python3
+"""Share of the mailboxes/metamap_archive reports MetaMap still has to
+annotate with the section cache of com/annotation_cache.py.
+
+The reports are annotated in archive order, starting from an empty cache,
+by fake_metamap.py: "whole report" annotates every report, "sections" only
+the sections the cache has not seen and puts the .ann back together.  The
+two .ann files of every report are compared.
+"""
+
+import argparse
+import glob
+import os
+import sys
+import tempfile
+import time
+
+REPO = os.path.abspath(os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+sys.path.insert(0, os.path.join(REPO, 'com'))
+
+import fake_metamap
+from annotation_cache import AnnotationCache, SectionAnnotation
+
+
+def annotate(text, dictionary):
+    lines = fake_metamap.annotate(text, dictionary)
+    return '\n'.join(lines) + '\n' if lines else ''
+
+
+def main():
+    parser = argparse.ArgumentParser(description='MetaMap input saved by the section cache')
+    parser.add_argument('-r', '--repeat', type=int, default=5, help='Passes over the archive, each with an empty cache')
+    args = parser.parse_args()
+
+    dictionary = fake_metamap.load_dictionary()
+    reports = []
+    for filename in sorted(glob.glob(os.path.join(REPO, 'mailboxes', 'metamap_archive', '*.txt'))):
+        with open(filename, 'r', newline='') as f:
+            reports.append(f.read())
+
+    whole_seconds, section_seconds, differing = 0.0, 0.0, 0
+    for _ in range(args.repeat):
+        start = time.perf_counter()
+        expected = [annotate(text, dictionary) for text in reports]
+        whole_seconds += time.perf_counter() - start
+
+        with tempfile.TemporaryDirectory() as directory:
+            cache = AnnotationCache(directory, 1 << 30)
+            sections, novel_sections, novel_characters = 0, 0, 0
+            start = time.perf_counter()
+            for text, reference in zip(reports, expected):
+                report = SectionAnnotation(cache, text)
+                sections += len(report.spans)
+                novel_sections += len(report.novel)
+                novel_characters += len(report.novel_text)
+                annotation = report.complete(annotate(report.novel_text, dictionary) if report.novel_text else '')
+                differing += annotation != reference
+            section_seconds += time.perf_counter() - start
+
+    characters = sum(len(text) for text in reports)
+    print(f"{len(reports)} reports, {sections} sections, {characters} characters x {args.repeat} passes")
+    print(f"sent to MetaMap: {novel_sections} sections ({novel_sections / sections:.1%}), "
+          f"{novel_characters} characters ({novel_characters / characters:.1%})")
+    print(f"whole report  {1000 * whole_seconds / (args.repeat * len(reports)):7.3f} ms/report")
+    print(f"sections      {1000 * section_seconds / (args.repeat * len(reports)):7.3f} ms/report (cache included)")
+    print("same .ann for every report" if not differing else f"{differing} .ann files differ")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,94 @@
+#!/usr/bin/env python3
+"""Time and check the sliding-window statistics of PDS/Misc.py.
+
+moving_average and empirical_p must equal the baseline implementations
+(sum() of each window, and a scan of each trailing window) bit for bit, on
+random days holding nans, infinities, subnormals and values of very different sizes,
+for several window sizes.  Exits 1 on any difference.
+"""
+
+import argparse
+import math
+import os
+import random
+import sys
+import time
+
+REPO = os.path.abspath(os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+sys.path.insert(0, os.path.join(REPO, 'PDS'))
+
+from Misc import moving_average, empirical_p
+
+WINDOWS = (1, 7, 30, 365)
+
+
+# The baseline implementations, copied unchanged from PDS/Misc.py before it
+# was optimized; the current ones must give the same results to the last bit
+
+
+def baseline_moving_average(window_size, list_of_numbers):
+    result = []
+    half = window_size//2
+    for i in range(len(list_of_numbers)):
+        start = max(0,i-half)
+        end = min(len(list_of_numbers), i+half+1)
+        window = list_of_numbers[start:end]
+        average = sum(window)/len(window)
+        result.append(average)
+    return result
+
+
+def baseline_empirical_p(window_size, min_window_size, daily_log_probability):
+    result = []
+    for day in range(len(daily_log_probability)):
+        if day<=min_window_size:
+            result.append(math.nan)
+            continue
+        day_log_p = daily_log_probability[day]
+        window = daily_log_probability[max(0,day-window_size):day]
+        larger = 0
+        for x in window:
+            if (x<day_log_p): larger+=1
+        result.append(larger/len(window))
+    return result
+
+
+def random_days(rng, days, not_finite):
+    values = [rng.choice((rng.uniform(-300.0, 0.0), rng.expovariate(1.0) * 1e-6, rng.uniform(0.0, 50.0), 5e-324,
+                          1e15, -1e-300)) for _ in range(days)]
+    for day in rng.sample(range(days), int(days * not_finite)):
+        values[day] = rng.choice((math.nan, math.inf, -math.inf))
+    return values
+
+
+def same(a, b): return len(a) == len(b) and all(x == y or (math.isnan(x) and math.isnan(y)) for x, y in zip(a, b))
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Check and time moving_average and empirical_p')
+    parser.add_argument('-d', '--days', type=int, default=3650, help='Days of random values to check')
+    parser.add_argument('-s', '--seed', type=int, default=0, help='Random seed')
+    args = parser.parse_args()
+
+    rng = random.Random(args.seed)
+    failed = 0
+    for not_finite in (0.0, 0.01):
+        values = random_days(rng, args.days, not_finite)
+        for window in WINDOWS:
+            timings = []
+            for new, old, call in ((moving_average, baseline_moving_average, lambda f: f(window, values)),
+                                   (empirical_p, baseline_empirical_p, lambda f: f(window, window // 12, values))):
+                start = time.perf_counter()
+                result = call(new)
+                middle = time.perf_counter()
+                reference = call(old)
+                timings.append((new.__name__, middle - start, time.perf_counter() - middle, same(result, reference)))
+            for name, seconds, reference_seconds, ok in timings:
+                failed += not ok
+                print(f"{name:15s} window {window:4d} not finite {not_finite:4.0%}: {1000 * seconds:8.1f} ms, "
+                      f"baseline {1000 * reference_seconds:8.1f} ms  {'identical' if ok else 'DIFFERENT'}")
+    sys.exit(1 if failed else 0)
+
+
+if __name__ == "__main__":
+    main()
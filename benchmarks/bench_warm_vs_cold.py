@@ -0,0 +1,116 @@
+#!/usr/bin/env python3
+"""Documents/second of the brat2csv, CDS and PDS stages run cold (a new
+process per document, as file_watcher.py did) and warm (state kept loaded).
+
+MetaMap Lite is not part of the comparison; the .ann inputs come from
+fake_metamap.py over the mailboxes/metamap_archive reports.  The cold CDS
+step runs naive_bayes_evaluator.py as a script, which is cheaper to start
+than the Java evaluator it replaces.
+"""
+
+import argparse
+import contextlib
+import glob
+import os
+import subprocess
+import sys
+import tempfile
+import time
+
+REPO = os.path.abspath(os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+sys.path.insert(0, os.path.join(REPO, 'com'))
+sys.path.insert(0, os.path.join(REPO, 'cds'))
+
+import fake_metamap
+from naive_bayes_evaluator import NaiveBayesEvaluator
+from warm_worker import WarmWorker, brat2csv_stage, pds_stage
+
+ANN2ARFF = os.path.join(REPO, 'brat2csv', 'ann2arff.py')
+EVALUATOR = os.path.join(REPO, 'cds', 'naive_bayes_evaluator.py')
+RUN_ILI_TRACKER = os.path.join(REPO, 'PDS', 'Run_ILI_Tracker.py')
+MODEL_DIR = os.path.join(REPO, 'models')
+MODEL_YEAR = '2020'
+
+
+@contextlib.contextmanager
+def quiet():
+    """Silence the stages' progress output, including that of child processes."""
+    sys.stdout.flush()
+    saved = os.dup(1)
+    with open(os.devnull, 'w') as devnull:
+        os.dup2(devnull.fileno(), 1)
+        try:
+            yield
+        finally:
+            sys.stdout.flush()
+            os.dup2(saved, 1)
+            os.close(saved)
+
+
+def make_documents(directory, n):
+    reports = sorted(glob.glob(os.path.join(REPO, 'mailboxes', 'metamap_archive', '*.txt')))
+    dictionary = fake_metamap.load_dictionary()
+    documents = []
+    for i in range(n):
+        with open(reports[i % len(reports)], 'r') as f:
+            text = f.read()
+        path = os.path.join(directory, f"doc_{i:05d}.ann")
+        with open(path, 'w') as out:
+            out.write('\n'.join(fake_metamap.annotate(text, dictionary)) + '\n')
+        documents.append(path)
+    return documents
+
+
+def run_cold(documents, directory):
+    output = os.path.join(directory, 'cds_output.csv')
+    for document in documents:
+        arff = document.replace('.ann', '.arff')
+        subprocess.run(["python3", ANN2ARFF, "-i", document, "-o", arff], check=True)
+        subprocess.run(["python3", EVALUATOR, "-m", MODEL_DIR, "-y", MODEL_YEAR, "-i", arff, "-o", output], check=True)
+        subprocess.run(["python3", RUN_ILI_TRACKER, "--data_directory", directory, "--data_file", os.path.basename(output)],
+                       check=True, cwd=os.path.dirname(RUN_ILI_TRACKER))
+
+
+def run_warm(documents, directory, brat2csv, evaluator, pds):
+    output = os.path.join(directory, 'cds_output.csv')
+    for document in documents:
+        arff = document.replace('.ann', '.arff')
+        brat2csv.call(document, arff)
+        evaluator.evaluate(arff, output)
+        pds.call(directory, os.path.basename(output))
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Cold vs warm stage throughput')
+    parser.add_argument('-n', type=int, default=20, help='Number of documents')
+    args = parser.parse_args()
+
+    with tempfile.TemporaryDirectory() as cold_dir, tempfile.TemporaryDirectory() as warm_dir:
+        cold_documents = make_documents(cold_dir, args.n)
+        warm_documents = make_documents(warm_dir, args.n)
+
+        with quiet():
+            start = time.perf_counter()
+            run_cold(cold_documents, cold_dir)
+            cold = time.perf_counter() - start
+
+            start = time.perf_counter()
+            brat2csv = WarmWorker("brat2csv", brat2csv_stage, os.path.dirname(ANN2ARFF))
+            pds = WarmWorker("pds", pds_stage, os.path.dirname(RUN_ILI_TRACKER))
+            evaluator = NaiveBayesEvaluator.load(MODEL_DIR, MODEL_YEAR)
+            startup = time.perf_counter() - start
+
+            start = time.perf_counter()
+            run_warm(warm_documents, warm_dir, brat2csv, evaluator, pds)
+            warm = time.perf_counter() - start
+            brat2csv.close()
+            pds.close()
+
+    print(f"documents:        {args.n}")
+    print(f"cold:             {args.n / cold:8.2f} docs/s  ({1000 * cold / args.n:8.1f} ms/doc)")
+    print(f"warm:             {args.n / warm:8.2f} docs/s  ({1000 * warm / args.n:8.1f} ms/doc)")
+    print(f"warm startup:     {startup:8.2f} s (once)")
+
+
+if __name__ == "__main__":
+    main()
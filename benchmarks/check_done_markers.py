@@ -0,0 +1,94 @@
+#!/usr/bin/env python3
+"""Check that .done markers pass each file on exactly once and keep the
+observer alive.
+
+A StageEventHandler of com/file_watcher.py, with PDS_DONE_MARKERS=1, watches
+a temporary inbox through a real watchdog observer (inotify where the
+platform has it, polling otherwise).  Files are written one after another,
+each followed by its <name>.done marker; every file must be handed on once,
+and the marker removed.  A marker whose file is missing must not stop the
+files after it.  Exits 1 otherwise.
+"""
+
+import argparse
+import os
+import sys
+import tempfile
+import threading
+import time
+
+REPO = os.path.abspath(os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+sys.path.insert(0, os.path.join(REPO, 'com'))
+
+os.environ['PDS_DONE_MARKERS'] = '1'
+os.environ.setdefault('PDS_BASE_PATH', tempfile.gettempdir())
+
+import file_watcher
+
+
+class RecordingHandler(file_watcher.StageEventHandler):
+    """Records the files it is handed instead of processing them."""
+
+    stage = "check"
+
+    def __init__(self):
+        super().__init__()
+        self.handled = []
+        self.changed = threading.Condition()
+
+    def handle_file(self, file_path):
+        with self.changed:
+            self.handled.append(os.path.basename(file_path))
+            self.changed.notify_all()
+
+    def wait_for(self, count, timeout):
+        with self.changed:
+            return self.changed.wait_for(lambda: len(self.handled) >= count, timeout)
+
+
+def write(path, text):
+    with open(path, 'w') as f:
+        f.write(text)
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Check .done marker handling with a real observer')
+    parser.add_argument('-n', type=int, default=5, help='Files to write after the first')
+    parser.add_argument('--timeout', type=float, default=10.0, help='Seconds to wait for each file')
+    args = parser.parse_args()
+
+    with tempfile.TemporaryDirectory() as inbox:
+        handler = RecordingHandler()
+        observer = file_watcher.make_observer()
+        handler.close_events = file_watcher.reports_close_events(observer)
+        observer.schedule(handler, inbox, recursive=False)
+        observer.start()
+        try:
+            expected = []
+            for i in range(args.n + 1):
+                name = f"report_{i}.txt"
+                write(os.path.join(inbox, name), f"report {i}\n")
+                write(os.path.join(inbox, name + file_watcher.DONE_SUFFIX), "")
+                expected.append(name)
+                if i == 0:
+                    # a marker without its file is dropped
+                    write(os.path.join(inbox, "missing.txt" + file_watcher.DONE_SUFFIX), "")
+                handler.wait_for(len(expected), args.timeout)
+            time.sleep(1.0)
+            alive = observer.is_alive()
+        finally:
+            observer.stop()
+            observer.join()
+        markers = [name for name in os.listdir(inbox) if name.endswith(file_watcher.DONE_SUFFIX)]
+
+    print(f"observer {type(observer).__name__}, close events {handler.close_events}")
+    print(f"handled {len(handler.handled)} of {len(expected)} files; observer alive {alive}; markers left {len(markers)}")
+    ok = handler.handled == expected and alive and not markers
+    if not ok:
+        print(f"expected {expected}\nhandled  {handler.handled}")
+    print("Done markers OK" if ok else "Done markers FAILED")
+    sys.exit(0 if ok else 1)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,111 @@
+#!/usr/bin/env python3
+"""Model-conversion consistency of cds/naive_bayes_evaluator.py: its scores
+must match those computed straight from the Weka models it was converted
+from.  The fixture is fixtures/model_conversion/reports.arff, twelve
+mailboxes/metamap_archive reports, and fixtures/model_conversion/reference.csv,
+their scores by the 2020 models.  The evaluator scores the ARFF in its
+default model format and compare() checks every loglikelihood and Prob
+column against the reference within the tolerance.  Exits 1 if any column
+is further off.
+
+The committed reference was written with --weka, from the models' Weka dumps
+(the full-precision .txt files printed from the .model files the Java
+evaluator loads), scored one row and one feature at a time: log10 P(row |
+class) is the sum over the row's non-missing attributes, the posterior is
+normalized over the classes with the class priors.  It is computed in
+Python, not by the Java NaiveBayesEvaluator, so passing shows that the
+.csv/.txt to .nbm conversion and the vectorized scoring reproduce the Weka
+models, not that the output is the Java evaluator's.
+
+--java CLASSPATH rewrites the reference with the Java NaiveBayesEvaluator,
+run as com/file_watcher.py runs it (e.g. cds-1.0-SNAPSHOT.jar and the Weka
+jar); with that reference the check is a parity check against Java.
+"""
+
+import argparse
+import csv
+import math
+import os
+import subprocess
+import sys
+import tempfile
+
+REPO = os.path.abspath(os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+sys.path.insert(0, os.path.join(REPO, 'cds'))
+
+from compile_models import full_precision_tables
+from naive_bayes_evaluator import (NaiveBayesEvaluator, DOCUMENT_FIELD, MISSING_VALUE, CLASS_SUFFIXES, read_arff,
+                                   compare, write_records)
+
+FIXTURE_DIR = os.path.join(REPO, 'benchmarks', 'fixtures', 'model_conversion')
+INPUT_FILE = os.path.join(FIXTURE_DIR, 'reports.arff')
+REFERENCE_FILE = os.path.join(FIXTURE_DIR, 'reference.csv')
+MODEL_DIR = os.path.join(REPO, 'models')
+MODEL_YEAR = '2020'
+JAVA_CLASS = 'edu.pitt.rods.cds.NaiveBayesEvaluator'
+
+
+def weka_scores(evaluator, input_file):
+    """Score input_file from the .txt dumps of the evaluator's models."""
+    attributes, rows = read_arff(input_file)
+    column = {name: c for c, (name, _) in enumerate(attributes)}
+    records = [{'ID': row[column['ID']], 'Admit_date_time': ''} for row in rows]
+    for model in evaluator.models:
+        csv_file = os.path.join(MODEL_DIR, f"{model.disease}_{model.years}.csv")
+        table, classes, priors, probabilities = full_precision_tables(csv_file, os.path.splitext(csv_file)[0] + '.txt')
+        for record, row in zip(records, rows):
+            log_likelihoods = []
+            for c in range(len(classes)):
+                total = 0.0
+                for j, feature in enumerate(table.features):
+                    value = row[column[feature]] if feature in column else MISSING_VALUE
+                    if value in table.value_index[j]:
+                        total += math.log10(probabilities[c, j, table.value_index[j][value]])
+                log_likelihoods.append(total)
+            joint = [10.0 ** (ll - max(log_likelihoods)) * p for ll, p in zip(log_likelihoods, priors)]
+            for c, suffix in enumerate(CLASS_SUFFIXES):
+                record[f"{model.disease}_loglikelihood_{suffix}"] = log_likelihoods[c]
+                record[f"{model.disease}_Prob_{suffix}"] = joint[c] / sum(joint)
+    return records
+
+
+def java_scores(classpath, output_file):
+    subprocess.run(['java', '-cp', classpath, JAVA_CLASS, MODEL_DIR, MODEL_YEAR, INPUT_FILE, output_file], check=True)
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Check the Python CDS evaluator against the scores of the Weka models')
+    parser.add_argument('-t', '--tolerance', type=float, default=1e-6, help='Largest absolute difference allowed')
+    parser.add_argument('-f', '--model-format', default=None, help='Model format to check (default the evaluator\'s)')
+    parser.add_argument('--java', metavar='CLASSPATH', help='Rewrite the reference with the Java evaluator')
+    parser.add_argument('--weka', action='store_true', help='Rewrite the reference from the models\' .txt dumps')
+    args = parser.parse_args()
+
+    if args.model_format:
+        evaluator = NaiveBayesEvaluator.load(MODEL_DIR, MODEL_YEAR, args.model_format)
+    else:
+        evaluator = NaiveBayesEvaluator.load(MODEL_DIR, MODEL_YEAR)
+
+    if args.java or args.weka:
+        with tempfile.TemporaryDirectory() as directory:
+            output_file = os.path.join(directory, 'reference.csv')
+            if args.java:
+                java_scores(args.java, output_file)
+            else:
+                write_records(output_file, [f for f in evaluator.fields() if f != DOCUMENT_FIELD],
+                              weka_scores(evaluator, INPUT_FILE))
+            os.replace(output_file, REFERENCE_FILE)
+        print(f"Reference written to {REFERENCE_FILE}")
+
+    records = evaluator.score_file(INPUT_FILE)
+    differences, ok = compare(REFERENCE_FILE, records, args.tolerance)
+    print(f"{len(records)} rows scored by {evaluator.describe()}")
+    if differences:
+        column = max(differences, key=differences.get)
+        print(f"{len(differences)} columns compared, largest difference {differences[column]:.3g} in {column}")
+    print("Model conversion OK" if ok else f"Model conversion FAILED (tolerance {args.tolerance})")
+    sys.exit(0 if ok else 1)
+
+
+if __name__ == "__main__":
+    main()
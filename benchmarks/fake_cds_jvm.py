@@ -0,0 +1,41 @@
+#!/usr/bin/env python3
+"""Stand-in for the CDS JVM: java -cp <jars> <class> <model dir> <model year>
+<input .arff> <output .csv>, as file_watcher.py runs it with CDS_ENGINE "java".
+
+Scores the ARFF with naive_bayes_evaluator.py and writes the Java
+evaluator's columns, without DOC.  FAKE_JVM_STARTUP seconds of sleep stand
+in for starting the JVM and loading Weka (default 0).
+"""
+
+import os
+import sys
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'cds'))
+
+from naive_bayes_evaluator import (NaiveBayesEvaluator, NaiveBayesEnsemble, ALL_YEARS, DOCUMENT_FIELD,
+                                   write_records)
+
+
+def main():
+    args = sys.argv[1:]
+    if args[:1] == ['-cp']:
+        args = args[2:]
+    if len(args) != 5:
+        print(f"Usage: {sys.argv[0]} -cp <classpath> <class> <model dir> <model year> <input> <output>")
+        sys.exit(2)
+    _, model_dir, model_year, input_file, output_file = args
+    time.sleep(float(os.environ.get("FAKE_JVM_STARTUP", 0)))
+
+    if model_year == ALL_YEARS:
+        evaluator = NaiveBayesEnsemble.load(model_dir)
+    else:
+        evaluator = NaiveBayesEvaluator.load(model_dir, model_year)
+    records = evaluator.score_file(input_file)
+    for record in records:
+        record.pop(DOCUMENT_FIELD, None)
+    write_records(output_file, [f for f in evaluator.fields() if f != DOCUMENT_FIELD], records)
+
+
+if __name__ == "__main__":
+    main()
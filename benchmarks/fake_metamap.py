@@ -0,0 +1,86 @@
+#!/usr/bin/env python3
+"""Deterministic stand-in for metamaplite.sh --brat --usecontext.
+
+Annotates text with a small concept dictionary taken from the C_D_ features
+of the models/*.csv tables, so the pipeline can be benchmarked without a
+UMLS license.  Like MetaMap Lite it reads one document from stdin when the
+input is "--" and writes BRAT to stdout, or annotates each named file and
+writes <basename>.ann next to it.
+"""
+
+import glob
+import os
+import re
+import sys
+
+MODEL_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'models')
+
+SYNONYMS = {
+    'cough': 'C0010200',
+    'shortness of breath': 'C0013404',
+    'runny nose': 'C1260880',
+    'sore throat': 'C0242429',
+    'body aches': 'C0231528',
+}
+NEGATION = re.compile(r'\b(no|denies|denied|without|negative for)\b[^.\n]*$', re.IGNORECASE)
+
+
+def load_dictionary(model_dir=MODEL_DIR):
+    names = {}
+    preferred = {}
+    for filename in sorted(glob.glob(os.path.join(model_dir, '*.csv'))):
+        with open(filename, 'r') as f:
+            for line in f:
+                match = re.match(r'^C_D_(C[0-9]+) \((.*?)\)?,', line)
+                if not match or "'" in match.group(2):
+                    continue
+                cui, name = match.groups()
+                preferred.setdefault(cui, name)
+                names.setdefault(name.lower(), cui)
+    for name, cui in SYNONYMS.items():
+        names.setdefault(name, cui)
+    alternatives = sorted(names, key=len, reverse=True)
+    pattern = re.compile(r'\b(' + '|'.join(re.escape(n) for n in alternatives) + r')\b', re.IGNORECASE)
+    return pattern, names, preferred
+
+
+def annotate(text, dictionary):
+    """Return BRAT lines for every dictionary match in text."""
+    pattern, names, preferred = dictionary
+    lines = []
+    t, n = 0, 0
+    for match in pattern.finditer(text):
+        cui = names[match.group(1).lower()]
+        t += 1
+        lines.append(f"T{t}\tsosy {match.start()} {match.end()}\t{match.group(0)}")
+        references = [f"ConceptId:{cui}\t{preferred.get(cui, match.group(1))}",
+                      f"SemanticType:{cui}:sosy\tsosy",
+                      f"Source:{cui}:MSH\tMSH",
+                      "Temporality:Recent\tRecent"]
+        line_start = text.rfind('\n', 0, match.start()) + 1
+        if NEGATION.search(text[line_start:match.start()]):
+            references.append("Negated:True\tTrue")
+        for reference in references:
+            n += 1
+            lines.append(f"N{n}\tReference T{t} {reference}")
+    return lines
+
+
+def main():
+    files = [a for a in sys.argv[1:] if not a.startswith('--')]
+    dictionary = load_dictionary()
+    if not files:
+        text = sys.stdin.read()
+        for line in annotate(text, dictionary):
+            print(line)
+        return
+    for filename in files:
+        with open(filename, 'r') as f:
+            text = f.read()
+        with open(os.path.splitext(filename)[0] + '.ann', 'w') as out:
+            for line in annotate(text, dictionary):
+                out.write(line + '\n')
+
+
+if __name__ == "__main__":
+    main()
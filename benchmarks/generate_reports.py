@@ -0,0 +1,123 @@
+#!/usr/bin/env python3
+"""Synthetic discharge reports for benchmarks.
+
+Each report is one of the mailboxes/metamap_archive samples with new
+demographics (name, MRN, date of birth), its visit moved to a random day,
+new vital signs and a random set of present and denied findings taken from
+fake_metamap.py's concept dictionary.  The same seed gives the same
+reports.
+"""
+
+import argparse
+import datetime
+import glob
+import os
+import random
+import re
+import sys
+
+REPO = os.path.abspath(os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+sys.path.insert(0, os.path.join(REPO, 'benchmarks'))
+
+import fake_metamap
+
+FIRST_NAMES = ['Maria', 'James', 'Aisha', 'Wei', 'Olga', 'Carlos', 'Priya', 'John', 'Fatima', 'Liam', 'Mei', 'Noah',
+               'Sofia', 'Ahmed', 'Grace', 'Diego', 'Hana', 'Samuel', 'Elena', 'Kofi']
+LAST_NAMES = ['Ramirez', 'Smith', 'Okafor', 'Chen', 'Ivanova', 'Garcia', 'Patel', 'Johnson', 'Haddad', 'Murphy',
+              'Nguyen', 'Brown', 'Rossi', 'Khan', 'Kim', 'Lopez', 'Sato', 'Cohen', 'Novak', 'Mensah']
+FINDINGS = ['cough', 'fever', 'fatigue', 'headache', 'nausea', 'vomiting', 'diarrhea', 'sore throat', 'runny nose',
+            'shortness of breath', 'body aches', 'chills', 'wheezing', 'chest pain', 'nasal congestion', 'myalgia']
+
+NAME_LINE = re.compile(r'^(Patient Name: ).*$', re.MULTILINE)
+MRN_LINE = re.compile(r'^(MRN: ).*$', re.MULTILINE)
+BIRTH_LINE = re.compile(r'^(Date of Birth: ).*$', re.MULTILINE)
+VISIT_DATE = re.compile(r'^(Date of (?:Visit|Discharge): )(\d{2})/(\d{2})/(\d{4})$', re.MULTILINE)
+VITALS = {
+    re.compile(r'^(- Temp: )[\d.]+'): lambda r: f"{r.uniform(97.0, 103.5):.1f}",
+    re.compile(r'^(- BP: )\d+/\d+'): lambda r: f"{r.randint(95, 165)}/{r.randint(55, 100)}",
+    re.compile(r'^(- HR: )\d+'): lambda r: str(r.randint(55, 130)),
+    re.compile(r'^(- RR: )\d+'): lambda r: str(r.randint(12, 30)),
+    re.compile(r'^(- O2 Sat: )\d+'): lambda r: str(r.randint(88, 100)),
+}
+SECTION_END = re.compile(r'^(History of Present Illness:\n(?:.+\n)*)', re.MULTILINE)
+
+
+def templates():
+    """The sample reports, by file name."""
+    reports = {}
+    for filename in sorted(glob.glob(os.path.join(REPO, 'mailboxes', 'metamap_archive', '*.txt'))):
+        with open(filename, 'r', newline='') as f:
+            reports[os.path.basename(filename)] = f.read()
+    return reports
+
+
+def known_findings(dictionary=None):
+    """The FINDINGS fake_metamap.py annotates."""
+    pattern, _, _ = dictionary or fake_metamap.load_dictionary()
+    return [f for f in FINDINGS if pattern.fullmatch(f)]
+
+
+def synthesize(template, rng, findings, start, days):
+    """One report from a template."""
+    text = NAME_LINE.sub(lambda m: m.group(1) + f"{rng.choice(FIRST_NAMES)} {chr(rng.randint(65, 90))}. "
+                                                f"{rng.choice(LAST_NAMES)}", template)
+    text = MRN_LINE.sub(lambda m: m.group(1) + f"{rng.randrange(10 ** 10):010d}", text)
+    birth = start - datetime.timedelta(days=rng.randint(365, 90 * 365))
+    text = BIRTH_LINE.sub(lambda m: m.group(1) + birth.isoformat(), text)
+
+    # every date of the visit moves by the same number of days
+    visit = start + datetime.timedelta(days=rng.randrange(days))
+    first = [None]
+
+    def move(m):
+        date = datetime.date(int(m.group(4)), int(m.group(2)), int(m.group(3)))
+        if first[0] is None:
+            first[0] = date
+        return m.group(1) + (visit + (date - first[0])).strftime('%m/%d/%Y')
+    text = VISIT_DATE.sub(move, text)
+
+    lines = text.split('\n')
+    for i, line in enumerate(lines):
+        for pattern, value in VITALS.items():
+            lines[i] = pattern.sub(lambda m: m.group(1) + value(rng), lines[i])
+    text = '\n'.join(lines)
+
+    chosen = rng.sample(findings, rng.randint(1, min(6, len(findings))))
+    present = chosen[:max(1, len(chosen) * 2 // 3)]
+    denied = chosen[len(present):]
+    sentence = f"Also reports {', '.join(present)}."
+    if denied:
+        sentence += f" Denies {', '.join(denied)}."
+    return SECTION_END.sub(lambda m: m.group(1) + sentence + '\n', text, count=1)
+
+
+def generate(n, seed=0, start=datetime.date(2025, 1, 1), days=28):
+    """Yield (name, text) for n synthetic reports."""
+    rng = random.Random(seed)
+    samples = templates()
+    names = sorted(samples)
+    findings = known_findings()
+    for i in range(n):
+        name = names[i % len(names)]
+        yield f"synthetic_{i:06d}_{os.path.splitext(name)[0]}.txt", synthesize(samples[name], rng, findings, start, days)
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Write synthetic discharge reports')
+    parser.add_argument('-n', type=int, default=100, help='Number of reports')
+    parser.add_argument('-o', '--output', required=True, help='Directory to write them to')
+    parser.add_argument('-s', '--seed', type=int, default=0, help='Random seed')
+    parser.add_argument('--start', default='2025-01-01', help='First visit date (YYYY-MM-DD)')
+    parser.add_argument('--days', type=int, default=28, help='Days the visits are spread over')
+    args = parser.parse_args()
+
+    os.makedirs(args.output, exist_ok=True)
+    start = datetime.date.fromisoformat(args.start)
+    for name, text in generate(args.n, args.seed, start, args.days):
+        with open(os.path.join(args.output, name), 'w', newline='') as f:
+            f.write(text)
+    print(f"{args.n} reports written to {args.output}")
+
+
+if __name__ == "__main__":
+    main()
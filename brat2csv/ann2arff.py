@@ -1,10 +1,18 @@
 import glob
+import json
 import re
 import os
 import getopt
 import sys
 
 
+# compile for speed
+regex_text = re.compile('^([T|N])([0-9]+)')
+regex_source = re.compile('^Reference (T[0-9]+) Source:(.*):(.*)')
+regex_type = re.compile('^Reference (T[0-9]+) SemanticType:(.*):(.*)')
+regex_concept = re.compile('^Reference (T[0-9]+) ConceptId:(.*)')
+regex_temporality = re.compile('^Reference (T[0-9]+) Temporality:(.*)')
+regex_negated = re.compile('^Reference (T[0-9]+) Negated:(.*)')
 
 
 def brat_load(filename):
@@ -13,14 +21,6 @@ def brat_load(filename):
 
     max_chars = 0
 
-    # compile for speed
-    regex_text = re.compile('^([T|N])([0-9]+)')
-    regex_source = re.compile('^Reference (T[0-9]+) Source:(.*):(.*)')
-    regex_type = re.compile('^Reference (T[0-9]+) SemanticType:(.*):(.*)')
-    regex_concept = re.compile('^Reference (T[0-9]+) ConceptId:(.*)')
-    regex_temporality = re.compile('^Reference (T[0-9]+) Temporality:(.*)')
-    regex_negated = re.compile('^Reference (T[0-9]+) Negated:(.*)')
-
     # build'JSON' object
     entities = {}
     file = open(filename, 'r', newline='\n')
@@ -140,40 +140,140 @@ def collate(entities):
     return concepts
 
 
+def _concept_counts(concepts, trigger_concepts, negated, temporality):
+    """Add one trigger's concepts to the collate() counts."""
+    recent = temporality == 'Recent'
+    historical = temporality == 'Historical'
+    for concept, preferred_name in trigger_concepts.items():
+        counts = concepts.get(concept)
+        if counts is None:
+            counts = concepts[concept] = {'preferred_name': preferred_name, 'count': 0, 'negated': 0,
+                                          'recent': 0, 'historical': 0}
+        counts['count'] += 1
+        if negated:
+            counts['negated'] += 1
+        if recent:
+            counts['recent'] += 1
+        if historical:
+            counts['historical'] += 1
+
+
+def brat_concepts(filename):
+    """Return collate(brat_load(filename)) from one streaming pass over the
+    .ann file.
+
+    Each N line is dispatched on the kind after "Reference <T> " and counted
+    into the current trigger, which is added to the concept counts when the
+    next T line starts.  As in brat_load, N lines belong to the last T line;
+    a reference to another trigger or of an unknown kind marks the trigger
+    negated, like a Negated reference does.
+    """
+    concepts = {}
+    trigger = None
+    trigger_concepts, negated, temporality = {}, False, None
+    with open(filename, 'r', newline='\n') as file:
+        for line in file:
+            tokens = line.strip().split('\t')
+            first = tokens[0]
+            brattype = first[:1]
+            if brattype not in ('T', 'N', '|') or not ('0' <= first[1:2] <= '9'):
+                print(f"WARNING: No data found in this line \"{line}\"")
+                continue
+
+            if brattype == 'T':
+                if trigger is not None:
+                    _concept_counts(concepts, trigger_concepts, negated, temporality)
+                trigger = first
+                trigger_concepts, negated, temporality = {}, False, None
+                # brat_load's regex only takes T<digits> followed by a space as a reference
+                valid_reference = first[1:].isdigit() and first.isascii()
+                continue
+
+            if brattype != 'N':
+                continue
+            if trigger is None:
+                print(f"WARNING: No T line before this line \"{line}\"")
+                continue
+            reference = tokens[1]
+            if valid_reference and reference.startswith('Reference ') and \
+                    reference.startswith(trigger + ' ', 10):
+                kind, colon, value = reference[11 + len(trigger):].partition(':')
+                if colon and (kind == 'Source' or kind == 'SemanticType') and ':' in value:
+                    concept = value.rpartition(':')[0]
+                    if concept not in trigger_concepts:
+                        trigger_concepts[concept] = None
+                    continue
+                if colon and kind == 'ConceptId':
+                    if trigger_concepts.get(value) is None:
+                        trigger_concepts[value] = tokens[2]
+                    continue
+                if colon and kind == 'Temporality':
+                    temporality = value
+                    continue
+            negated = True
+    if trigger is not None:
+        _concept_counts(concepts, trigger_concepts, negated, temporality)
+    return concepts
+
+
+def read_header():
+    """Parse big-header.csv, the column order of the ARFF rows."""
+    # Get the directory where the script is located
+    script_dir = os.path.dirname(os.path.abspath(__file__))
+    with open(os.path.join(script_dir, 'big-header.csv'), 'r') as f:
+        # Parse header.csv into an array
+        header_line = f.readline().strip()
+        return header_line.split(',')
+
+
+def index_header(header_array):
+    """Map each column name of the header to its position in the row."""
+    return {name: i for i, name in enumerate(header_array)}
 
-def outputCSV(input_file, output_file, header_array):
-    
-    # Check if output file exists
-    file_exists = os.path.isfile(output_file)
-    
-    # Open file in appropriate mode (write or append)
-    mode = "a" if file_exists else "w"
-    output = open(output_file, mode)
-    
-    # Write header only if file doesn't exist
-    if not file_exists:
-        # Get the directory where the script is located
-        script_dir = os.path.dirname(os.path.abspath(__file__))
-        arff_header = open(os.path.join(script_dir, 'big-blank.arff'), 'r')
-
-        # copy the lines of arff_header to output
-        for line in arff_header:
-            output.write(line)  
-        
-        arff_header.close()
-        print(f"Created new output file with ARFF header: {output_file}")
-    else:
-        print(f"Appending to existing file: {output_file}")
-    
-    id_number = 1
-    
+
+def read_arff_template():
+    """Return the text of big-blank.arff, the header of every output file."""
+    script_dir = os.path.dirname(os.path.abspath(__file__))
+    with open(os.path.join(script_dir, 'big-blank.arff'), 'r') as arff_header:
+        return arff_header.read()
+
+
+def attribute_defaults(arff_template):
+    """Return the value a Weka sparse row implies for each omitted column:
+    the first declared value of a nominal attribute, 0 for a numeric one."""
+    defaults = []
+    for line in arff_template.splitlines():
+        if line[:10].lower() == '@attribute':
+            declaration = line.split(None, 2)[2].strip()
+            defaults.append(declaration.strip('{}').split(',')[0].strip() if declaration.startswith('{') else '0')
+    return defaults
+
+
+def format_row(row, header_array, output_format, defaults=None, docid=None):
+    """Format one row as a dense ARFF line, a Weka sparse ARFF line
+    ({index value,...} for every column that differs from its default, also
+    for 'rows'), or a JSON line with the ID, the document and only the
+    non-"M" columns."""
+    if output_format in ('sparse', 'rows'):
+        return "{" + ",".join(f"{i} {v}" for i, v in enumerate(row) if v != defaults[i]) + "}\n"
+    if output_format == 'jsonl':
+        values = {header_array[i]: v for i, v in enumerate(row) if i > 0 and v != "M"}
+        return json.dumps({"ID": row[0], "doc": docid, "values": values}, separators=(',', ':')) + "\n"
+    return ",".join(row) + "\n"
+
+
+def concept_row(input_file, header_array, header_index):
+    """Build the ARFF row for one .ann file; the ID column is left to the caller.
+
+    The row starts as all "M" and only the columns of the document's
+    concepts, found through header_index, are filled in.
+    """
 
     print(f"Processing file: {input_file}")
-    kept_cuis = {}  # Dictionary to store CUIs and their status
+    kept_cui_row = ["M"] * len(header_array)
     docid = os.path.basename(input_file).replace(".ann", "")
 
-    json_data = brat_load(input_file)
-    c = collate(json_data)
+    c = brat_concepts(input_file)
 
     print(f"Processing {docid} with {len(c)} concepts")
 
@@ -192,28 +292,95 @@ def outputCSV(input_file, output_file, header_array):
         weka_cui_name = "C_D_" + cui
 
         # print(f"CUI: {cui}, wekaCUI: {weka_cui_name}, Name: {umls_preferred_name}, Occurrences: {occurences}, Negated: {negation_count}, Recent: {recent_count}, Historical: {historical_count}, Status: {status}")
-        if weka_cui_name in header_array:
-            kept_cuis[weka_cui_name] = status
-
-    kept_cui_row =  []
-    for cui in header_array:
-        if cui in kept_cuis:
-            kept_cui_row.append(kept_cuis[cui])
-            # print(f"Keeping {cui} with status {kept_cuis[cui]}")
-        else:
-            kept_cui_row.append("M")
-
-    kept_cui_row[0] = str(id_number)
-    id_number += 1
+        column = header_index.get(weka_cui_name)
+        if column is not None:
+            kept_cui_row[column] = status
+
+    return kept_cui_row
+
+
+def count_rows(arff_file):
+    """Count the data rows already in an ARFF or JSON lines file."""
+    rows = 0
+    in_data = arff_file.endswith('.jsonl')
+    with open(arff_file, 'r') as f:
+        for line in f:
+            if in_data:
+                if line.strip() and not line.startswith('%'):
+                    rows += 1
+            elif line.strip().lower() == '@data':
+                in_data = True
+    return rows
+
+
+def outputCSV(input_files, output_file, header_array, arff_template=None, header_index=None,
+              output_format='dense', defaults=None):
+    """Write one row per .ann file to output_file in a single buffered pass.
+
+    input_files may be a single filename.  Rows are numbered after the
+    rows already in output_file.  output_format is 'dense' or 'sparse' ARFF,
+    or one of two formats without a header: 'jsonl', whose rows name their
+    columns and whose declarations the CDS side reads from big-blank.arff,
+    and 'rows', the sparse ARFF data lines alone, which the CDS side puts
+    under one copy of big-blank.arff per batch of documents.
+    """
+    if isinstance(input_files, str):
+        input_files = [input_files]
+    if header_index is None:
+        header_index = index_header(header_array)
     
-    ## output
-    output.write(",".join(kept_cui_row) + "\n")
-    output.close()
+    # Check if output file exists
+    file_exists = os.path.isfile(output_file)
+    
+    # Open file in appropriate mode (write or append)
+    mode = "a" if file_exists else "w"
+    id_number = count_rows(output_file) + 1 if file_exists else 1
+    output = open(output_file, mode, buffering=1024 * 1024)
+    
+    header = output_format in ('dense', 'sparse')
+    if arff_template is None and (output_format in ('sparse', 'rows') or (header and not file_exists)):
+        arff_template = read_arff_template()
+    if output_format in ('sparse', 'rows') and defaults is None:
+        defaults = attribute_defaults(arff_template)
+
+    # Write header only if file doesn't exist
+    if not file_exists and header:
+        # copy the arff header to output
+        output.write(arff_template)
+        print(f"Created new output file with ARFF header: {output_file}")
+    elif file_exists:
+        print(f"Appending to existing file: {output_file}")
 
-    print(f"Output complete: {output_file}")
+    row_bytes = 0
+    for input_file in input_files:
+        kept_cui_row = concept_row(input_file, header_array, header_index)
+        kept_cui_row[0] = str(id_number)
+        id_number += 1
+
+        ## output
+        line = format_row(kept_cui_row, header_array, output_format, defaults,
+                          os.path.basename(input_file).replace(".ann", ""))
+        row_bytes += len(line)
+        output.write(line)
+    output.close()
 
+    print(f"Output complete: {output_file} ({len(input_files)} {output_format} rows, "
+          f"{row_bytes // max(len(input_files), 1)} bytes per row)")
 
 
+def input_files_from(opts):
+    """Collect the .ann files named by -i, -d and -g options, in order."""
+    input_files = []
+    for name, value in opts:
+        if name == '-i' and value == '-':
+            input_files.extend(line.strip() for line in sys.stdin if line.strip())
+        elif name == '-i':
+            input_files.append(value)
+        elif name == '-d':
+            input_files.extend(sorted(glob.glob(os.path.join(value, '*.ann'))))
+        elif name == '-g':
+            input_files.extend(sorted(glob.glob(value)))
+    return input_files
 
 
 def main():
@@ -221,39 +388,42 @@ def main():
     if len(sys.argv) < 2:
 
         print("Usage: ", sys.argv[0], "-i<input file> -o<output file>")
-        print("     -i <filename> input .ann file")
+        print("     -i <filename> input .ann file, may be repeated; - reads filenames from stdin")
+        print("     -d <dirname>  convert every .ann file in a directory")
+        print("     -g <pattern>  convert every file matching a glob pattern, e.g. 'archive/*/*.ann'")
         print("     -o <filename> output of arff file (appends if it exists)")
+        print("     -f <format>   dense (default) or sparse ARFF, or without a header jsonl or sparse ARFF rows")
         sys.exit(0)
 
-    input_file = None
     outputfile = None
+    output_format = 'dense'
     argv = sys.argv[1:]
-    opts, args = getopt.getopt(argv, 'i:o:')
+    opts, args = getopt.getopt(argv, 'i:d:g:o:f:')
     for name, value in opts:
-        if name == '-i':
-            input_file = value
         if name == '-o':
             outputfile = value
+        if name == '-f':
+            output_format = value
+
+    if output_format not in ('dense', 'sparse', 'jsonl', 'rows'):
+        print(f"Error: unknown output format {output_format}")
+        sys.exit(1)
+    input_files = input_files_from(opts)
 
-    if not input_file or not outputfile:
-        print("Error: Both -i and -o arguments are required.")
+    if not input_files or not outputfile:
+        print("Error: an input (-i, -d or -g) and -o are required.")
         sys.exit(1)
 
     header_array = []
     try:
-        # Get the directory where the script is located
-        script_dir = os.path.dirname(os.path.abspath(__file__))
-        with open(os.path.join(script_dir, 'big-header.csv'), 'r') as f:
-            # Parse header.csv into an array
-            header_line = f.readline().strip()
-            header_array = header_line.split(',')
+        header_array = read_header()
 
     except FileNotFoundError:
         print("Warning: 'header.csv' not found.")
         exit(0)
 
 
-    outputCSV(input_file, outputfile, header_array)
+    outputCSV(input_files, outputfile, header_array, output_format=output_format)
 
 if __name__ == "__main__":
-    main()
\ No newline at end of file
+    main()
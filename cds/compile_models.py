@@ -0,0 +1,198 @@
+#!/usr/bin/env python3
+"""Compile the models/<DISEASE>_<YEARS> tables into .nbm artifacts.
+
+The .csv tables give the ARFF feature names and value codes but round the
+probabilities to 4 decimals; the .txt files list the same probabilities at
+full precision, in the same feature and value order, under display names.
+An artifact holds the feature table and value codes of the .csv with the
+log10 of the .txt probabilities, laid out so NaiveBayesModel.load_compiled
+can memory-map them.  Every artifact written is verified against its .txt.
+"""
+
+import csv
+import getopt
+import glob
+import json
+import os
+import re
+import sys
+
+import numpy as np
+
+from naive_bayes_evaluator import (NaiveBayesModel, COMPILED_MAGIC, COMPILED_VERSION, COMPILED_PREAMBLE,
+                                   compiled_path, read_compiled_header, source_digest, _aligned_offset)
+
+PRIOR_LINE = re.compile(r'^P\((\w+)=(\w+)\) = (\S+)$')
+CONDITIONAL_LINE = re.compile(r'^P\((.*)=(.*?) \| (\w+)=(\w+)\) = (\S+)$')
+# Largest difference allowed between the artifact and the .txt, relative,
+# and between the .txt and the .csv, which rounds to 4 decimals
+TXT_TOLERANCE = 1e-12
+CSV_TOLERANCE = 0.00005 + 1e-9
+
+
+def read_txt(filename):
+    """Return the class values, class priors and (name, value, class,
+    probability) conditional entries of a model .txt, in file order."""
+    classes, priors, conditionals = [], [], []
+    with open(filename, 'r') as f:
+        for line in f:
+            line = line.strip()
+            match = CONDITIONAL_LINE.match(line)
+            if match:
+                name, value, _, class_value, p = match.groups()
+                conditionals.append((name, value, class_value, float(p)))
+                continue
+            match = PRIOR_LINE.match(line)
+            if match:
+                classes.append(match.group(2))
+                priors.append(float(match.group(3)))
+    return classes, priors, conditionals
+
+
+def read_descriptions(csv_file):
+    """{feature: description} from the "<feature> (<description>)" labels of a
+    model .csv, with the quotes and the commas (written as spaces) of the
+    .txt display names undone for comparison."""
+    descriptions = {}
+    with open(csv_file, 'r') as f:
+        reader = csv.reader(f)
+        next(reader)
+        for row in reader:
+            if row[0] != 'Class Prior':
+                feature, description = row[0].split(' (', 1)
+                descriptions[feature] = description[:-1].strip("'")
+    return descriptions
+
+
+def full_precision_tables(csv_file, txt_file):
+    """Match the .txt entries to the features and values of the .csv and
+    return (model loaded from the .csv, classes, priors, probabilities) where
+    probabilities is a (class, feature, value) array with zeros past the
+    last value of each feature."""
+    model = NaiveBayesModel.load(csv_file)
+    descriptions = read_descriptions(csv_file)
+    classes, priors, conditionals = read_txt(txt_file)
+    if len(priors) != model.log_priors.shape[0]:
+        raise ValueError(f"{txt_file}: {len(priors)} class priors, {csv_file} has {model.log_priors.shape[0]}")
+    expected = len(classes) * sum(len(vs) for vs in model.values)
+    if len(conditionals) != expected:
+        raise ValueError(f"{txt_file}: {len(conditionals)} conditional probabilities, {csv_file} has {expected}")
+    probabilities = np.zeros((len(classes), len(model.features), max(len(vs) for vs in model.values)))
+    i = 0
+    for j, (feature, values) in enumerate(zip(model.features, model.values)):
+        for c, class_value in enumerate(classes):
+            for k in range(len(values)):
+                name, _, entry_class, p = conditionals[i]
+                i += 1
+                if entry_class != class_value:
+                    raise ValueError(f"{txt_file}: {name} lists class {entry_class} where {class_value} was expected")
+                if descriptions[feature] != 'N/A' and descriptions[feature] != name.replace(',', ' '):
+                    raise ValueError(f"{txt_file}: {name} is where {feature} ({descriptions[feature]}) was expected")
+                if p <= 0.0:
+                    raise ValueError(f"{txt_file}: P({name}={values[k]} | {class_value}) is {p}")
+                probabilities[c, j, k] = p
+    return model, classes, np.array(priors), probabilities
+
+
+def compile_model(csv_file, txt_file=None, output_file=None):
+    """Write the compiled artifact of one model and return its path."""
+    txt_file = txt_file or os.path.splitext(csv_file)[0] + '.txt'
+    output_file = output_file or compiled_path(csv_file)
+    model, classes, priors, probabilities = full_precision_tables(csv_file, txt_file)
+    log_probabilities = np.zeros((len(classes), len(model.features), probabilities.shape[2] + 1))
+    log_probabilities[:, :, :-1] = np.log10(np.where(probabilities > 0.0, probabilities, 1.0))
+    arrays = {'log_priors': np.log10(priors), 'log_probabilities': log_probabilities}
+
+    specs, offset = {}, 0
+    for name, array in arrays.items():
+        specs[name] = {'offset': offset, 'dtype': '<f8', 'shape': list(array.shape)}
+        offset = _aligned_offset(offset + array.nbytes)
+    header = json.dumps({'disease': model.disease, 'years': model.years, 'classes': classes,
+                         'features': model.features, 'values': model.values, 'arrays': specs,
+                         'sources': {os.path.basename(f): source_digest(f) for f in (csv_file, txt_file)}}).encode('utf-8')
+    start = _aligned_offset(COMPILED_PREAMBLE.size + len(header))
+
+    temporary = f"{output_file}.{os.getpid()}.tmp"
+    with open(temporary, 'wb') as f:
+        f.write(COMPILED_PREAMBLE.pack(COMPILED_MAGIC, COMPILED_VERSION, len(header)))
+        f.write(header)
+        for name, array in arrays.items():
+            f.seek(start + specs[name]['offset'])
+            f.write(array.astype('<f8').tobytes())
+    os.replace(temporary, output_file)
+    return output_file
+
+
+def verify(compiled_file, csv_file, txt_file=None):
+    """Check a compiled artifact against the .txt probabilities (and the
+    rounded .csv ones).  Returns a list of problems, empty if it matches."""
+    txt_file = txt_file or os.path.splitext(csv_file)[0] + '.txt'
+    problems = []
+    header, _ = read_compiled_header(compiled_file)
+    for source in (csv_file, txt_file):
+        if header['sources'].get(os.path.basename(source)) != source_digest(source):
+            problems.append(f"compiled from a different {os.path.basename(source)}")
+    compiled = NaiveBayesModel.load_compiled(compiled_file)
+    model, classes, priors, probabilities = full_precision_tables(csv_file, txt_file)
+    if compiled.features != model.features or compiled.values != model.values or header['classes'] != classes:
+        return problems + ["feature table or value codes differ"]
+
+    width = probabilities.shape[2]
+    stored = np.power(10.0, np.asarray(compiled.log_probabilities[:, :, :width]))
+    listed = probabilities > 0.0
+    txt_difference = max(float(np.max(np.abs(stored[listed] / probabilities[listed] - 1.0))),
+                         float(np.max(np.abs(np.power(10.0, compiled.log_priors) / priors - 1.0))))
+    if txt_difference > TXT_TOLERANCE:
+        problems.append(f"relative difference from the .txt {txt_difference:.3g}")
+    if np.any(compiled.log_probabilities[:, :, width:] != 0.0) or np.any(compiled.log_probabilities[:, :, :width][~listed] != 0.0):
+        problems.append("missing-value slots are not 0")
+    rounded = np.power(10.0, model.log_probabilities[:, :, :width])
+    csv_difference = float(np.max(np.abs(stored - rounded)[listed & (rounded > 0.00005)], initial=0.0))
+    if csv_difference > CSV_TOLERANCE:
+        problems.append(f"absolute difference from the .csv {csv_difference:.3g}")
+    return problems
+
+
+def main():
+
+    if len(sys.argv) < 2:
+        print("Usage: ", sys.argv[0], "-m<model dir> [-v] [model ...]")
+        print("     -m <dirname>  directory with the <DISEASE>_<YEARS>.csv and .txt model files")
+        print("     -v            only verify the existing artifacts")
+        print("     model         <DISEASE>_<YEARS> names to compile (default: every .csv in the directory)")
+        sys.exit(0)
+
+    model_dir, verify_only = None, False
+    opts, args = getopt.getopt(sys.argv[1:], 'm:v')
+    for name, value in opts:
+        if name == '-m':
+            model_dir = value
+        if name == '-v':
+            verify_only = True
+
+    if not model_dir:
+        print("Error: -m is required.")
+        sys.exit(1)
+
+    if args:
+        csv_files = [os.path.join(model_dir, f"{name}.csv") for name in args]
+    else:
+        csv_files = sorted(glob.glob(os.path.join(model_dir, "*_*-*.csv")))
+
+    failed = 0
+    for csv_file in csv_files:
+        compiled_file = compiled_path(csv_file)
+        try:
+            if not verify_only:
+                compile_model(csv_file)
+            problems = verify(compiled_file, csv_file)
+        except (OSError, ValueError) as e:
+            problems = [str(e)]
+        failed += bool(problems)
+        print(f"{os.path.basename(compiled_file)}: {'; '.join(problems) if problems else 'OK'}")
+    print(f"{len(csv_files) - failed} of {len(csv_files)} models OK")
+    sys.exit(1 if failed else 0)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,588 @@
+#!/usr/bin/env python3
+
+import csv
+import getopt
+import glob
+import hashlib
+import json
+import os
+import re
+import struct
+import sys
+import time
+
+import numpy as np
+
+# The published tables round to 4 decimals, so a probability printed as 0
+# was smaller than half of the last digit.
+MIN_PROBABILITY = 0.00005
+CLASS_SUFFIXES = ['M', 'T']
+ADMISSION_DATE_FIELD = 'Admit_date_time'
+# Output field naming the report a row was scored from, its correlation ID
+# through the pipeline; the last field, so readers of the other fields by
+# position are not affected
+DOCUMENT_FIELD = 'DOC'
+MISSING_VALUE = 'M'
+# Model year that selects every training window (NaiveBayesEnsemble)
+ALL_YEARS = 'all'
+# Attribute declarations for .jsonl rows, which carry no header of their own
+ARFF_HEADER = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'brat2csv', 'big-blank.arff')
+# Compiled model artifacts (compile_models.py): magic, format version and
+# JSON header length, the JSON header, then float64 arrays at ARRAY_ALIGNMENT
+COMPILED_SUFFIX = '.nbm'
+COMPILED_MAGIC = b'NBMODEL\0'
+COMPILED_VERSION = 1
+COMPILED_PREAMBLE = struct.Struct('<8sII')
+ARRAY_ALIGNMENT = 64
+# Where the probabilities are loaded from: "compiled" requires the .nbm of
+# every model, compiled from its current .csv and .txt, and scores at the full
+# precision of the Weka .model files the Java evaluator reads; "csv" uses the
+# .csv tables, rounded to 4 decimals, whose scores differ by up to ~0.15 in
+# log10 likelihood and ~0.04 in posterior
+MODEL_FORMATS = ('compiled', 'csv')
+DEFAULT_MODEL_FORMAT = 'compiled'
+
+
+_parsed_headers = {}
+
+
+def _parse_attributes(header):
+    attributes = []
+    for line in header.splitlines():
+        line = line.strip()
+        if line[:10].lower() != '@attribute':
+            continue
+        name, declaration = line.split(None, 2)[1:]
+        if declaration.startswith('{'):
+            values = [v.strip().strip("'") for v in declaration.strip('{}').split(',')]
+        else:
+            values = None
+        attributes.append((name.strip("'"), values))
+    return attributes
+
+
+def _sparse_row(line, attributes):
+    """Parse a Weka sparse row into {column: value}, where an absent column
+    means MISSING_VALUE.  In the ARFF an omitted column means its first
+    declared value, so that value is filled in where it is not "M"."""
+    row = {}
+    for entry in line.strip()[1:-1].split(','):
+        if entry.strip():
+            column, value = entry.split(None, 1)
+            row[int(column)] = value.strip()
+    for c, (_, values) in enumerate(attributes):
+        if c not in row:
+            default = values[0] if values else '0'
+            if default != MISSING_VALUE:
+                row[c] = default
+    return row
+
+
+def read_arff(filename):
+    """Read a dense or sparse ARFF file into its attribute declarations and
+    data rows.
+
+    Attributes are returned as (name, values) pairs where values is the list
+    of nominal values, or None for numeric/string attributes.  Dense rows are
+    lists of values; sparse rows are {column: value} dicts in which absent
+    columns are missing ("M").  Every file the pipeline produces carries the
+    same header, so the parsed declarations are cached and the same list is
+    returned for an identical header.
+    """
+    with open(filename, 'r') as f:
+        text = f.read()
+    match = re.search(r'^@data[ \t]*$', text, re.IGNORECASE | re.MULTILINE)
+    if match is None:
+        raise ValueError(f"No @data section in {filename}")
+    attributes = _attributes_of(text[:match.end()])
+    rows = []
+    for line in text[match.end():].splitlines():
+        if not line.strip() or line.startswith('%'):
+            continue
+        if line.lstrip().startswith('{'):
+            rows.append(_sparse_row(line, attributes))
+        else:
+            rows.append(line.strip().split(','))
+    return attributes, rows
+
+
+def _attributes_of(header):
+    if header not in _parsed_headers:
+        _parsed_headers[header] = _parse_attributes(header)
+    return _parsed_headers[header]
+
+
+_jsonl_headers = {}
+
+
+def read_jsonl(filename, header_file=ARFF_HEADER):
+    """Read the .jsonl rows written by ann2arff.py -f jsonl.
+
+    Each line names only its non-missing columns, so the attribute
+    declarations come from header_file, which is read once.  Rows are
+    returned like sparse ARFF rows, with the document a row came from under
+    DOCUMENT_FIELD.
+    """
+    if header_file not in _jsonl_headers:
+        with open(header_file, 'r') as f:
+            attributes = _attributes_of(f.read())
+        _jsonl_headers[header_file] = (attributes, {name: i for i, (name, _) in enumerate(attributes)})
+    attributes, column_index = _jsonl_headers[header_file]
+    rows = []
+    with open(filename, 'r') as f:
+        for line in f:
+            if not line.strip():
+                continue
+            record = json.loads(line)
+            row = {column_index[name]: value for name, value in record['values'].items() if name in column_index}
+            row[column_index.get('ID', 0)] = str(record['ID'])
+            if record.get('doc'):
+                row[DOCUMENT_FIELD] = record['doc']
+            rows.append(row)
+    return attributes, rows
+
+
+def read_rows(filename, header_file=ARFF_HEADER):
+    """Read an .arff or .jsonl file of CDS input rows."""
+    if filename.endswith('.jsonl'):
+        return read_jsonl(filename, header_file)
+    return read_arff(filename)
+
+
+def read_compiled_header(filename):
+    """Return the JSON header of a compiled model and the file offset its
+    array offsets are relative to."""
+    with open(filename, 'rb') as f:
+        magic, version, length = COMPILED_PREAMBLE.unpack(f.read(COMPILED_PREAMBLE.size))
+        if magic != COMPILED_MAGIC:
+            raise ValueError(f"{filename} is not a compiled model")
+        if version != COMPILED_VERSION:
+            raise ValueError(f"{filename} has format version {version}, expected {COMPILED_VERSION}; recompile it")
+        header = json.loads(f.read(length).decode('utf-8'))
+    return header, _aligned_offset(COMPILED_PREAMBLE.size + length)
+
+
+def _aligned_offset(offset): return -(-offset // ARRAY_ALIGNMENT) * ARRAY_ALIGNMENT
+
+
+def compiled_path(csv_file): return os.path.splitext(csv_file)[0] + COMPILED_SUFFIX
+
+
+def source_digest(filename):
+    """The digest of a model source file that compile_models.py records."""
+    with open(filename, 'rb') as f:
+        return hashlib.blake2b(f.read(), digest_size=16).hexdigest()
+
+
+def stale_sources(compiled_file, csv_file):
+    """The sources of a compiled model (.csv, .txt) whose digest differs from
+    the one recorded when it was compiled."""
+    header, _ = read_compiled_header(compiled_file)
+    sources = (csv_file, os.path.splitext(csv_file)[0] + '.txt')
+    return [os.path.basename(f) for f in sources
+            if not os.path.isfile(f) or header.get('sources', {}).get(os.path.basename(f)) != source_digest(f)]
+
+
+def load_model(csv_file, model_format=DEFAULT_MODEL_FORMAT):
+    """Load one model in model_format (MODEL_FORMATS).  A compiled model must
+    exist and have been compiled from the current .csv and .txt."""
+    if model_format == 'csv':
+        return NaiveBayesModel.load(csv_file)
+    if model_format != 'compiled':
+        raise ValueError(f"Unknown model format {model_format}, expected one of {', '.join(MODEL_FORMATS)}")
+    compiled = compiled_path(csv_file)
+    if not os.path.isfile(compiled):
+        raise FileNotFoundError(f"No compiled model {compiled}; run compile_models.py or use the csv model format")
+    stale = stale_sources(compiled, csv_file)
+    if stale:
+        raise ValueError(f"{compiled} was compiled from a different {' and '.join(stale)}; run compile_models.py")
+    return NaiveBayesModel.load_compiled(compiled)
+
+
+class NaiveBayesModel:
+    """One disease model loaded from a models/<DISEASE>_<YEARS>.csv table or
+    the .nbm artifact compile_models.py builds from it.
+
+    The conditional probabilities are kept as a (class, feature, value) array
+    of log10 probabilities.  The extra value slot at the end of each feature
+    holds 0.0 and is used for missing or unknown values, which Weka's Naive
+    Bayes skips.
+    """
+
+    def __init__(self, disease, years, class_priors, features, values, probabilities):
+        max_values = max(len(vs) for vs in values)
+        log_probabilities = np.zeros((len(class_priors), len(features), max_values + 1))
+        for j, feature_probabilities in enumerate(probabilities):
+            p = np.maximum(np.array(feature_probabilities, dtype=float).T, MIN_PROBABILITY)
+            log_probabilities[:, j, :p.shape[1]] = np.log10(p)
+        self._set_tables(disease, years, features, values,
+                         np.log10(np.maximum(class_priors, MIN_PROBABILITY)), log_probabilities)
+
+    def _set_tables(self, disease, years, features, values, log_priors, log_probabilities):
+        self.disease = disease
+        self.years = years
+        self.features = features
+        self.values = values
+        self.value_index = [{v: i for i, v in enumerate(vs)} for vs in values]
+        self.log_priors = log_priors
+        self.log_probabilities = log_probabilities
+        self._aligned = {}
+        self._last_aligned = None
+
+    @classmethod
+    def load(cls, filename):
+        disease, years = os.path.splitext(os.path.basename(filename))[0].split('_', 1)
+        features, values, probabilities = [], [], []
+        feature_index = {}
+        with open(filename, 'r') as f:
+            reader = csv.reader(f)
+            next(reader)
+            class_priors = None
+            for row in reader:
+                if row[0] == 'Class Prior':
+                    class_priors = [float(p) for p in row[2:]]
+                    continue
+                feature = row[0].split(' (', 1)[0]
+                if feature not in feature_index:
+                    feature_index[feature] = len(features)
+                    features.append(feature)
+                    values.append([])
+                    probabilities.append([])
+                j = feature_index[feature]
+                values[j].append(row[1])
+                probabilities[j].append([float(p) for p in row[2:]])
+        return cls(disease, years, np.array(class_priors), features, values, probabilities)
+
+    @classmethod
+    def load_compiled(cls, filename):
+        """Load a model compiled by compile_models.py.  The probability
+        tables are memory-mapped read-only, so processes that load the same
+        artifact share its pages."""
+        header, offset = read_compiled_header(filename)
+        arrays = {name: np.memmap(filename, dtype=spec['dtype'], mode='r', offset=offset + spec['offset'],
+                                  shape=tuple(spec['shape']))
+                  for name, spec in header['arrays'].items()}
+        model = cls.__new__(cls)
+        model._set_tables(header['disease'], header['years'], header['features'], header['values'],
+                          arrays['log_priors'], arrays['log_probabilities'])
+        return model
+
+    def align(self, attributes):
+        """Return the ARFF columns this model uses and the table re-indexed by
+        the ARFF nominal value codes of those columns (cached per header)."""
+        if self._last_aligned is not None and self._last_aligned[0] is attributes:
+            return self._last_aligned[1]
+        key = tuple(name for name, _ in attributes)
+        if key not in self._aligned:
+            attribute_index = {name: i for i, (name, _) in enumerate(attributes)}
+            used = [j for j, feature in enumerate(self.features) if feature in attribute_index]
+            columns = np.array([attribute_index[self.features[j]] for j in used], dtype=np.intp)
+            width = max([len(attributes[c][1] or []) for c in columns] + [0]) + 1
+            table = np.zeros((self.log_probabilities.shape[0], len(used), width))
+            for k, j in enumerate(used):
+                for code, value in enumerate(attributes[columns[k]][1] or []):
+                    if value in self.value_index[j]:
+                        table[:, k, code] = self.log_probabilities[:, j, self.value_index[j][value]]
+            self._aligned[key] = (columns, table)
+        self._last_aligned = (attributes, self._aligned[key])
+        return self._aligned[key]
+
+    def log_likelihoods(self, attributes, codes):
+        """Score a batch of encoded rows.
+
+        codes is an (n_rows, n_attributes) array of ARFF value codes with -1
+        for missing values.  Returns an (n_rows, n_classes) array of log10
+        P(row | class).
+        """
+        columns, table = self.align(attributes)
+        row_codes = codes[:, columns]
+        row_codes = np.where(row_codes < 0, table.shape[2] - 1, row_codes)
+        gathered = table[:, np.arange(len(columns)), row_codes]
+        return gathered.sum(axis=2).T
+
+    def posteriors(self, log_likelihoods):
+        log_joint = log_likelihoods + self.log_priors
+        log_joint = log_joint - log_joint.max(axis=1, keepdims=True)
+        joint = np.power(10.0, log_joint)
+        return joint / joint.sum(axis=1, keepdims=True)
+
+
+class NaiveBayesEvaluator:
+    """In-process replacement for edu.pitt.rods.cds.NaiveBayesEvaluator."""
+
+    def __init__(self, models, model_format=None):
+        self.models = models
+        self.model_format = model_format
+
+    @classmethod
+    def load(cls, model_dir, model_year, model_format=DEFAULT_MODEL_FORMAT):
+        files = sorted(glob.glob(os.path.join(model_dir, f"*_*-{model_year}.csv")))
+        if not files:
+            raise FileNotFoundError(f"No models for {model_year} in {model_dir}")
+        return cls([load_model(f, model_format) for f in files], model_format)
+
+    def describe(self):
+        """Which models were loaded and from where, for the logs."""
+        source = {'compiled': 'compiled .nbm artifacts', 'csv': '.csv tables (4 decimals)'}.get(self.model_format, 'memory')
+        return f"{len(self.models)} models for {', '.join(self.diseases())} from {source}"
+
+    def diseases(self): return [model.disease for model in self.models]
+
+    def fields(self):
+        fields = ['ID', ADMISSION_DATE_FIELD]
+        fields += [f"{dx}_loglikelihood_{c}" for dx in self.diseases() for c in CLASS_SUFFIXES]
+        fields += [f"{dx}_Prob_{c}" for dx in self.diseases() for c in CLASS_SUFFIXES]
+        return fields + [DOCUMENT_FIELD]
+
+    def encode(self, attributes, rows):
+        """Turn string rows into an (n_rows, n_attributes) array of nominal
+        value codes.  Only the columns used by a model are encoded."""
+        used = set()
+        for model in self.models:
+            used.update(model.align(attributes)[0].tolist())
+        codes = np.full((len(rows), len(attributes)), -1, dtype=np.int16)
+        for c in used:
+            value_index = {v: i for i, v in enumerate(attributes[c][1] or [])}
+            codes[:, c] = [value_index.get(row.get(c, MISSING_VALUE) if isinstance(row, dict) else row[c], -1)
+                           for row in rows]
+        return codes
+
+    def _records(self, attributes, rows, document=''):
+        names = [name for name, _ in attributes]
+        id_column = names.index('ID') if 'ID' in names else None
+        admitted = time.strftime('%Y-%m-%d %H:%M:%S')
+        documents = document if isinstance(document, list) else [document] * len(rows)
+        return [{'ID': row[id_column] if id_column is not None and (isinstance(row, list) or id_column in row)
+                       else str(i + 1),
+                 ADMISSION_DATE_FIELD: admitted,
+                 DOCUMENT_FIELD: row.get(DOCUMENT_FIELD, doc) if isinstance(row, dict) else doc}
+                for i, (row, doc) in enumerate(zip(rows, documents))]
+
+    def score(self, attributes, rows, document=''):
+        """Return a list of output records, one per row, keyed by fields().
+        document names the report of rows that do not carry their own, or is
+        a list with one name per row."""
+        codes = self.encode(attributes, rows)
+        records = self._records(attributes, rows, document)
+        for model in self.models:
+            log_likelihoods = model.log_likelihoods(attributes, codes)
+            probabilities = model.posteriors(log_likelihoods)
+            for record, ll, p in zip(records, log_likelihoods.tolist(), probabilities.tolist()):
+                for c, suffix in enumerate(CLASS_SUFFIXES):
+                    record[f"{model.disease}_loglikelihood_{suffix}"] = ll[c]
+                    record[f"{model.disease}_Prob_{suffix}"] = p[c]
+        return records
+
+    def score_file(self, input_file):
+        document = os.path.splitext(os.path.basename(input_file))[0]
+        return self.score(*read_rows(input_file), document)
+
+    def score_files(self, input_files):
+        """Score the rows of several files with one score() call per distinct
+        header (one for the pipeline's files).  Returns the records in file
+        order, each naming the file's document unless its row names one."""
+        groups, members = [], []
+        for input_file in input_files:
+            attributes, rows = read_rows(input_file)
+            document = os.path.splitext(os.path.basename(input_file))[0]
+            group = next((g for g in groups if g[0] is attributes), None)
+            if group is None:
+                group = (attributes, [], [])
+                groups.append(group)
+            members.append((group, len(group[1]), len(rows)))
+            group[1].extend(rows)
+            group[2].extend([document] * len(rows))
+        scored = {id(group): self.score(*group) for group in groups}
+        return [record for group, start, count in members for record in scored[id(group)][start:start + count]]
+
+    def write(self, output_file, records): write_records(output_file, self.fields(), records)
+
+    def evaluate(self, input_file, output_file):
+        """Score an ARFF file and append the results to a CDS output CSV."""
+        records = self.score_file(input_file)
+        self.write(output_file, records)
+        return records
+
+
+class NaiveBayesEnsemble(NaiveBayesEvaluator):
+    """Every training window of every disease, scored in one pass.
+
+    The aligned tables of all models are stacked into one (model, class,
+    column, value) array over the union of their ARFF columns, with zeros
+    where a model does not use a column, so a batch of rows is scored
+    against every window with one gather and one sum.  Records carry the
+    log-likelihoods and posteriors of each window as
+    <DISEASE>_<YEARS>_loglikelihood_<c> and <DISEASE>_<YEARS>_Prob_<c>, and
+    an ensemble under the usual <DISEASE>_loglikelihood_<c> and
+    <DISEASE>_Prob_<c> names: the mean of the windows' log-likelihoods and
+    the mean of their posteriors.
+    """
+
+    # Rows gathered at a time; the gather is (models x classes x rows x columns)
+    BATCH_ROWS = 256
+
+    def __init__(self, models, model_format=None):
+        super().__init__(models, model_format)
+        self.log_priors = np.array([model.log_priors for model in models])
+        self._stacked = {}
+        self._last_stacked = None
+
+    @classmethod
+    def load(cls, model_dir, model_year=None, model_format=DEFAULT_MODEL_FORMAT):
+        files = sorted(glob.glob(os.path.join(model_dir, "*_*-*.csv")))
+        if not files:
+            raise FileNotFoundError(f"No models in {model_dir}")
+        return cls([load_model(f, model_format) for f in files], model_format)
+
+    def diseases(self): return list(dict.fromkeys(model.disease for model in self.models))
+
+    def windows(self): return [f"{model.disease}_{model.years}" for model in self.models]
+
+    def fields(self):
+        fields = super().fields()[:-1]
+        fields += [f"{window}_loglikelihood_{c}" for window in self.windows() for c in CLASS_SUFFIXES]
+        fields += [f"{window}_Prob_{c}" for window in self.windows() for c in CLASS_SUFFIXES]
+        return fields + [DOCUMENT_FIELD]
+
+    def stack(self, attributes):
+        """Return the union of the models' ARFF columns and the stacked
+        (model, class, column, value) table for them (cached per header)."""
+        if self._last_stacked is not None and self._last_stacked[0] is attributes:
+            return self._last_stacked[1]
+        key = tuple(name for name, _ in attributes)
+        if key not in self._stacked:
+            aligned = [model.align(attributes) for model in self.models]
+            columns = np.unique(np.concatenate([c for c, _ in aligned] + [np.empty(0, dtype=np.intp)]))
+            position = {c: k for k, c in enumerate(columns.tolist())}
+            width = max([table.shape[2] for _, table in aligned] + [1])
+            stacked = np.zeros((len(self.models), len(CLASS_SUFFIXES), len(columns), width))
+            for m, (model_columns, table) in enumerate(aligned):
+                positions = [position[c] for c in model_columns.tolist()]
+                stacked[m][:, positions, :table.shape[2] - 1] = table[:, :, :-1]
+            self._stacked[key] = (columns, stacked)
+        self._last_stacked = (attributes, self._stacked[key])
+        return self._stacked[key]
+
+    def log_likelihoods(self, attributes, codes):
+        """(n_models, n_rows, n_classes) log10 P(row | class) for every window."""
+        columns, stacked = self.stack(attributes)
+        result = np.empty((len(self.models), len(codes), len(CLASS_SUFFIXES)))
+        for start in range(0, len(codes), self.BATCH_ROWS):
+            row_codes = codes[start:start + self.BATCH_ROWS, columns]
+            row_codes = np.where(row_codes < 0, stacked.shape[3] - 1, row_codes)
+            gathered = stacked[:, :, np.arange(len(columns)), row_codes]
+            result[:, start:start + len(row_codes)] = gathered.sum(axis=3).transpose(0, 2, 1)
+        return result
+
+    def score(self, attributes, rows, document=''):
+        codes = self.encode(attributes, rows)
+        records = self._records(attributes, rows, document)
+        log_likelihoods = self.log_likelihoods(attributes, codes)
+        log_joint = log_likelihoods + self.log_priors[:, np.newaxis, :]
+        joint = np.power(10.0, log_joint - log_joint.max(axis=2, keepdims=True))
+        probabilities = joint / joint.sum(axis=2, keepdims=True)
+        for window, ll, p in zip(self.windows(), log_likelihoods.tolist(), probabilities.tolist()):
+            for record, row_ll, row_p in zip(records, ll, p):
+                for c, suffix in enumerate(CLASS_SUFFIXES):
+                    record[f"{window}_loglikelihood_{suffix}"] = row_ll[c]
+                    record[f"{window}_Prob_{suffix}"] = row_p[c]
+        diseases = [model.disease for model in self.models]
+        for disease in self.diseases():
+            members = [m for m, d in enumerate(diseases) if d == disease]
+            mean_ll = log_likelihoods[members].mean(axis=0).tolist()
+            mean_p = probabilities[members].mean(axis=0).tolist()
+            for record, row_ll, row_p in zip(records, mean_ll, mean_p):
+                for c, suffix in enumerate(CLASS_SUFFIXES):
+                    record[f"{disease}_loglikelihood_{suffix}"] = row_ll[c]
+                    record[f"{disease}_Prob_{suffix}"] = row_p[c]
+        return records
+
+
+def write_records(output_file, fields, records):
+    file_exists = os.path.isfile(output_file) and os.path.getsize(output_file) > 0
+    with open(output_file, 'a', newline='') as f:
+        writer = csv.DictWriter(f, fieldnames=fields)
+        if not file_exists:
+            writer.writeheader()
+        writer.writerows(records)
+
+
+def compare(reference_file, records, tolerance):
+    """Compare scored records with the Java evaluator's output for the same
+    ARFF file.  Returns the largest absolute difference per shared numeric
+    column and whether all of them are within tolerance."""
+    with open(reference_file, 'r', newline='') as f:
+        reference = list(csv.DictReader(f))
+    if len(reference) != len(records):
+        print(f"Row count differs: reference {len(reference)}, scored {len(records)}")
+        return {}, False
+    columns = [c for c in records[0] if c in reference[0] and ('_loglikelihood_' in c or '_Prob_' in c)]
+    differences = {c: max(abs(float(r[c]) - float(s[c])) for r, s in zip(reference, records)) for c in columns}
+    return differences, all(d <= tolerance for d in differences.values())
+
+
+def main():
+
+    if len(sys.argv) < 2:
+        print("Usage: ", sys.argv[0], "-m<model dir> -y<model year> -i<input file> -o<output file> [-c<reference file>]")
+        print("     -m <dirname>  directory with the <DISEASE>_<YEARS>.csv model tables")
+        print("     -y <year>     last training year of the models to use, e.g. 2020, or all for every")
+        print("                   training window and their ensemble")
+        print("     -i <filename> input .arff file")
+        print("     -o <filename> output csv file (appends if it exists)")
+        print("     -c <filename> compare against the Java NaiveBayesEvaluator output for the same input")
+        print("     -t <float>    largest absolute difference allowed by -c (default 0.05)")
+        print("     -f <format>   compiled (default: the .nbm artifacts of compile_models.py, at full precision)")
+        print("                   or csv (the .csv tables, rounded to 4 decimals)")
+        sys.exit(0)
+
+    model_dir, model_year, input_file, output_file, reference_file = None, None, None, None, None
+    tolerance = 0.05
+    model_format = DEFAULT_MODEL_FORMAT
+    opts, args = getopt.getopt(sys.argv[1:], 'm:y:i:o:c:t:f:')
+    for name, value in opts:
+        if name == '-m':
+            model_dir = value
+        if name == '-y':
+            model_year = value
+        if name == '-i':
+            input_file = value
+        if name == '-o':
+            output_file = value
+        if name == '-c':
+            reference_file = value
+        if name == '-t':
+            tolerance = float(value)
+        if name == '-f':
+            model_format = value
+
+    if not model_dir or not model_year or not input_file or not (output_file or reference_file):
+        print("Error: -m, -y, -i and one of -o or -c are required.")
+        sys.exit(1)
+
+    if model_format not in MODEL_FORMATS:
+        print(f"Error: -f must be one of {', '.join(MODEL_FORMATS)}.")
+        sys.exit(1)
+
+    if model_year == ALL_YEARS:
+        evaluator = NaiveBayesEnsemble.load(model_dir, model_format=model_format)
+    else:
+        evaluator = NaiveBayesEvaluator.load(model_dir, model_year, model_format)
+    print(f"Loaded {evaluator.describe()}")
+
+    if output_file:
+        records = evaluator.evaluate(input_file, output_file)
+        print(f"Scored {len(records)} rows from {input_file} into {output_file}")
+    else:
+        records = evaluator.score_file(input_file)
+
+    if reference_file:
+        differences, ok = compare(reference_file, records, tolerance)
+        for column, difference in differences.items():
+            print(f"{column}: max abs difference {difference:.6g}")
+        print("Parity OK" if ok else f"Parity FAILED (tolerance {tolerance})")
+        sys.exit(0 if ok else 1)
+
+
+if __name__ == "__main__":
+    main()
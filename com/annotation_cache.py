@@ -0,0 +1,211 @@
+#!/usr/bin/env python3
+
+import bisect
+import collections
+import hashlib
+import os
+import re
+import threading
+
+# A section is a run of non-blank lines; MetaMap's sentences, and the negation
+# and temporality context it reads around a concept, do not cross blank lines.
+SECTION = re.compile(r'[^\n]*\S[^\n]*(?:\n[^\n]*\S[^\n]*)*')
+SECTION_SEPARATOR = '\n\n'
+
+
+def normalize_text(text):
+    """Report text as it is hashed: line endings unified, trailing spaces
+    and leading or trailing blank lines dropped.  The words, and the lines
+    MetaMap's negation and temporality context looks at, are unchanged."""
+    lines = [line.rstrip() for line in text.replace('\r\n', '\n').replace('\r', '\n').split('\n')]
+    return '\n'.join(lines).strip('\n')
+
+
+class AnnotationCache:
+    """Content-addressed store of MetaMap .ann output on disk.
+
+    Entries are keyed by a hash of the MetaMap configuration and the
+    normalized report text and kept as <directory>/<xx>/<key>.ann.  When
+    the entries exceed max_bytes the least recently used are deleted; use
+    is tracked in memory and recorded in each file's mtime, so the order
+    survives a restart.  Lookups are counted for hit_rate().
+    """
+
+    def __init__(self, directory, max_bytes, config=""):
+        self.directory = directory
+        self.max_bytes = max_bytes
+        self.config = config
+        self.lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+        self.entries = collections.OrderedDict()
+        self.size = 0
+        os.makedirs(directory, exist_ok=True)
+        found = []
+        for root, _, files in os.walk(directory):
+            for name in files:
+                if name.endswith('.ann'):
+                    stat = os.stat(os.path.join(root, name))
+                    found.append((stat.st_mtime, name[:-4], stat.st_size))
+        for _, key, size in sorted(found):
+            self.entries[key] = size
+            self.size += size
+
+    def key(self, text, normalize=True):
+        """The key of text; without normalize the text is hashed as it is, for
+        annotations whose offsets have to match it."""
+        digest = hashlib.blake2b(digest_size=20)
+        digest.update(self.config.encode('utf-8'))
+        digest.update(b'\0')
+        digest.update((normalize_text(text) if normalize else text).encode('utf-8'))
+        return digest.hexdigest()
+
+    def path(self, key): return os.path.join(self.directory, key[:2], f"{key}.ann")
+
+    def get(self, key):
+        """Return the cached .ann text for key, or None."""
+        with self.lock:
+            if key not in self.entries:
+                self.misses += 1
+                return None
+            self.entries.move_to_end(key)
+        try:
+            with open(self.path(key), 'r') as f:
+                annotation = f.read()
+            os.utime(self.path(key))
+        except OSError:
+            with self.lock:
+                self.size -= self.entries.pop(key, 0)
+                self.misses += 1
+            return None
+        with self.lock:
+            self.hits += 1
+        return annotation
+
+    def put(self, key, annotation):
+        """Store the .ann text for key and evict down to max_bytes."""
+        path = self.path(key)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        temporary = f"{path}.{os.getpid()}.{threading.get_ident()}.tmp"
+        with open(temporary, 'w') as f:
+            f.write(annotation)
+        os.replace(temporary, path)
+        size = os.path.getsize(path)
+        evicted = []
+        with self.lock:
+            self.size += size - self.entries.pop(key, 0)
+            self.entries[key] = size
+            while self.size > self.max_bytes and len(self.entries) > 1:
+                old_key, old_size = self.entries.popitem(last=False)
+                self.size -= old_size
+                evicted.append(old_key)
+        for old_key in evicted:
+            try:
+                os.remove(self.path(old_key))
+            except FileNotFoundError:
+                pass
+
+    def hit_rate(self):
+        lookups = self.hits + self.misses
+        return self.hits / lookups if lookups else 0.0
+
+    def stats(self):
+        with self.lock:
+            return {'hits': self.hits, 'misses': self.misses, 'hit_rate': self.hit_rate(),
+                    'entries': len(self.entries), 'bytes': self.size}
+
+
+def split_sections(text):
+    """(start, end) offsets of the sections of text."""
+    return [(m.start(), m.end()) for m in SECTION.finditer(text)]
+
+
+def _shift_location(location, shift):
+    kind, _, spans = location.partition(' ')
+    return kind + ' ' + ';'.join(' '.join(str(int(offset) + shift) for offset in span.split(' '))
+                                 for span in spans.split(';'))
+
+
+def _relabel(lines, shift, t, n):
+    """Number the T and N lines of one section from T<t + 1> and N<n + 1>,
+    pointing the N lines at the new T ids, and shift the T offsets."""
+    ids = {}
+    relabeled = []
+    for line in lines:
+        tokens = line.split('\t')
+        if len(tokens) > 1 and tokens[0][:1] == 'T':
+            t += 1
+            ids[tokens[0]] = f"T{t}"
+            tokens[0] = f"T{t}"
+            tokens[1] = _shift_location(tokens[1], shift)
+        elif len(tokens) > 1 and tokens[0][:1] == 'N':
+            n += 1
+            tokens[0] = f"N{n}"
+            words = tokens[1].split(' ', 2)
+            if len(words) > 1 and words[0] == 'Reference' and words[1] in ids:
+                words[1] = ids[words[1]]
+                tokens[1] = ' '.join(words)
+        relabeled.append('\t'.join(tokens))
+    return relabeled, t, n
+
+
+def _annotation_text(lines): return '\n'.join(lines) + '\n' if lines else ''
+
+
+def split_annotation(annotation, spans):
+    """Split the BRAT annotation of a text into one annotation per (start,
+    end) span, each numbered from T1 and N1 with offsets from the span
+    start.  A T line goes to the span its first offset falls in, and the
+    lines after it go with it, as ann2arff reads them."""
+    starts = [start for start, _ in spans]
+    groups = [[] for _ in spans]
+    current = None
+    for line in annotation.splitlines():
+        tokens = line.split('\t')
+        if len(tokens) > 1 and tokens[0][:1] == 'T':
+            offset = int(tokens[1].split(' ')[1].split(';')[0])
+            current = max(bisect.bisect_right(starts, offset) - 1, 0)
+        if current is not None:
+            groups[current].append(line)
+    return [_annotation_text(_relabel(lines, -start, 0, 0)[0]) for lines, start in zip(groups, starts)]
+
+
+def join_annotations(annotations, starts):
+    """The annotation of a whole text from the annotations of its sections,
+    which start at the given offsets, numbered on from one to the next."""
+    joined, t, n = [], 0, 0
+    for annotation, start in zip(annotations, starts):
+        lines, t, n = _relabel(annotation.splitlines(), start, t, n)
+        joined.extend(lines)
+    return _annotation_text(joined)
+
+
+class SectionAnnotation:
+    """A report split into sections, with the annotations the cache holds
+    for them.
+
+    novel_text holds the sections the cache does not know, separated by
+    blank lines, for MetaMap to annotate; complete() takes its annotation,
+    caches it per section and returns the annotation of the whole report,
+    as MetaMap would have written it.
+    """
+
+    def __init__(self, cache, text):
+        self.cache = cache
+        self.spans = split_sections(text)
+        self.keys = [cache.key(text[start:end], normalize=False) for start, end in self.spans]
+        self.annotations = [cache.get(key) for key in self.keys]
+        self.novel = [i for i, annotation in enumerate(self.annotations) if annotation is None]
+        self.novel_spans, pieces, offset = [], [], 0
+        for i in self.novel:
+            start, end = self.spans[i]
+            self.novel_spans.append((offset, offset + end - start))
+            pieces.append(text[start:end])
+            offset += end - start + len(SECTION_SEPARATOR)
+        self.novel_text = SECTION_SEPARATOR.join(pieces) + '\n' if pieces else ''
+
+    def complete(self, novel_annotation=''):
+        for i, annotation in zip(self.novel, split_annotation(novel_annotation, self.novel_spans)):
+            self.cache.put(self.keys[i], annotation)
+            self.annotations[i] = annotation
+        return join_annotations(self.annotations, [start for start, _ in self.spans])
@@ -5,10 +5,25 @@ import sys
 import time
 import subprocess
 import shutil
+import csv
+import tempfile
+import threading
 from watchdog.observers import Observer
+try:
+    from watchdog.observers.inotify import InotifyObserver
+except ImportError:
+    InotifyObserver = None
 from watchdog.events import FileSystemEventHandler, FileSystemEvent
+from stage_pool import StagePool
+from annotation_cache import AnnotationCache, SectionAnnotation
+import handoff
+import metrics
+from metrics import METRICS, run_process
+from warm_worker import WarmWorkerPool, WorkerError, brat2csv_stage, pds_stage
 
-BASE_PATH = "/opt"
+# Root of the installation and its mailboxes; benchmarks/bench_pipeline.py
+# points it at a temporary tree
+BASE_PATH = os.environ.get("PDS_BASE_PATH", "/opt")
 
 METAMAP_CMD = f"{BASE_PATH}/public_mm_lite/metamaplite.sh"
 METAMAP_WORKING_DIR = f"{BASE_PATH}/public_mm_lite"
@@ -16,9 +31,19 @@ BRAT2CSV_CMD = f"{BASE_PATH}/brat2csv/ann2arff.py"
 CDS_JAR = f"{BASE_PATH}/cds/cds-1.0-SNAPSHOT.jar"
 WEKA_JAR = f"{BASE_PATH}/cds/weka-stable-3.8.6.jar"
 CDS_CMD = "edu.pitt.rods.cds.NaiveBayesEvaluator"
+CDS_PY_DIR = f"{BASE_PATH}/cds"
+CDS_ENGINE = os.environ.get("PDS_CDS_ENGINE", "python")  # "python" scores in-process from the models (MODEL_FORMAT), "java" runs CDS_CMD
+# brat2csv -> CDS hand-off, without the 26,008-attribute ARFF header in every document: "jsonl" rows for the python
+# engine, sparse ARFF "rows" for the java engine, which get ARFF_HEADER once per batch; or "dense"/"sparse" ARFF
+BRAT2CSV_FORMAT = "jsonl" if CDS_ENGINE == "python" else "rows"
+ARFF_HEADER = f"{BASE_PATH}/brat2csv/big-blank.arff"
 MODEL_DIR = f"{BASE_PATH}/models"
-MODEL_YEAR = "2020"
+MODEL_YEAR = "2020"  # last training year of the models, or "all" (python engine) for every window and their ensemble
+# "compiled" loads the .nbm artifacts of cds/compile_models.py (full precision, as the Java engine's .model files) and
+# fails if they are missing or out of date; "csv" scores from the .csv tables rounded to 4 decimals (python engine)
+MODEL_FORMAT = os.environ.get("PDS_MODEL_FORMAT", "compiled")
 PDS_CMD = f"{BASE_PATH}/PDS/Run_ILI_Tracker.py"
+WORKER_MODE = os.environ.get("PDS_WORKER_MODE", "warm")  # "warm" keeps brat2csv and PDS loaded in long-lived workers, "cold" starts a process per file
 
 METAMAP_INBOX = f"{BASE_PATH}/mailboxes/metamap_inbox"
 METAMAP_ARCHIVE = f"{BASE_PATH}/mailboxes/metamap_archive"
@@ -29,6 +54,74 @@ CDS_ARCHIVE = f"{BASE_PATH}/mailboxes/cds_archive"
 PDS_INBOX = f"{BASE_PATH}/mailboxes/pds_inbox"
 PDS_ARCHIVE = f"{BASE_PATH}/mailboxes/pds_archive"
 PDS_OUTBOX = f"{BASE_PATH}/mailboxes/pds_outbox"
+# Every CDS output file is appended to the history the tracker runs over; the
+# checkpoint lets each run recompute only new days and days with late rows, and
+# the history's .cache directory lets it parse only the rows appended since.
+PDS_HISTORY = f"{PDS_ARCHIVE}/cds_history.csv"
+PDS_CHECKPOINT = f"{PDS_HISTORY}.checkpoint.json"
+PDS_HISTORY_CACHE = f"{PDS_HISTORY}.cache"
+
+# Worker threads per stage and the length of each stage's queue.  Raise the
+# worker counts to use more cores on the ingest host.  PDS files all extend
+# the same history, so they are tracked one at a time.
+METAMAP_WORKERS = int(os.environ.get("PDS_METAMAP_WORKERS", 2))
+BRAT2CSV_WORKERS = int(os.environ.get("PDS_BRAT2CSV_WORKERS", 2))
+CDS_WORKERS = int(os.environ.get("PDS_CDS_WORKERS", 2))
+PDS_WORKERS = int(os.environ.get("PDS_PDS_WORKERS", 1))
+STAGE_QUEUE_SIZE = int(os.environ.get("PDS_STAGE_QUEUE_SIZE", 100))
+
+# MetaMap Lite pays its JVM start and index open once per run, so reports are
+# annotated in batches: a worker takes up to METAMAP_BATCH_SIZE queued reports,
+# waiting up to METAMAP_BATCH_WAIT seconds for more, and runs MetaMap once on
+# all of them in a private directory.  A batch size of 1 pipes each report
+# through stdin as before.
+METAMAP_BATCH_SIZE = int(os.environ.get("PDS_METAMAP_BATCH_SIZE", 16))
+METAMAP_BATCH_WAIT = float(os.environ.get("PDS_METAMAP_BATCH_WAIT", 1.0))
+METAMAP_BATCH_DIR = f"{BASE_PATH}/mailboxes/metamap_batch"
+# Reports whose normalized text was annotated before skip MetaMap: their .ann
+# is kept in METAMAP_CACHE_DIR, up to PDS_METAMAP_CACHE_MB (0 turns it off),
+# under a key that includes METAMAP_CACHE_CONFIG.  Change the configuration
+# string when MetaMap, its options or its data release change.
+METAMAP_CACHE_DIR = f"{BASE_PATH}/mailboxes/metamap_cache"
+METAMAP_CACHE_MB = float(os.environ.get("PDS_METAMAP_CACHE_MB", 256))
+METAMAP_CACHE_CONFIG = os.environ.get("PDS_METAMAP_CACHE_CONFIG", f"{METAMAP_CMD} --brat --usecontext")
+# Templated reports share most of their sections (runs of non-blank lines).
+# The annotation of every section is kept in METAMAP_SECTION_CACHE_DIR, up to
+# PDS_METAMAP_SECTION_CACHE_MB (0 turns it off), and only the sections not seen
+# before are sent to MetaMap; the .ann is put back together with its offsets.
+METAMAP_SECTION_CACHE_DIR = f"{BASE_PATH}/mailboxes/metamap_section_cache"
+METAMAP_SECTION_CACHE_MB = float(os.environ.get("PDS_METAMAP_SECTION_CACHE_MB", 256))
+
+# CDS scores the rows of every file that arrives within PDS_CDS_BATCH_WAIT
+# seconds of the first, up to PDS_CDS_BATCH_SIZE files, with one evaluator
+# call, and writes them, with the document of each row, as a new segment of
+# the day's output.  The java engine runs on one ARFF file merged in
+# CDS_BATCH_DIR.
+CDS_BATCH_SIZE = int(os.environ.get("PDS_CDS_BATCH_SIZE", 32))
+CDS_BATCH_WAIT = float(os.environ.get("PDS_CDS_BATCH_WAIT", 0.5))
+CDS_BATCH_DIR = f"{BASE_PATH}/mailboxes/cds_batch"
+
+# PDS appends every CDS output segment queued when it starts to the history
+# and tracks it once, up to PDS_PDS_BATCH_SIZE segments.
+PDS_BATCH_SIZE = int(os.environ.get("PDS_PDS_BATCH_SIZE", 64))
+PDS_BATCH_WAIT = float(os.environ.get("PDS_PDS_BATCH_WAIT", 0.0))
+
+# Metrics in the Prometheus text format are served on
+# http://PDS_METRICS_HOST:PDS_METRICS_PORT/metrics (port 0 turns it off) and,
+# with PDS_METRICS_FILE, written to that file every METRICS_FILE_INTERVAL
+# seconds.  Every document each stage handles is traced as one JSON line in
+# PDS_TRACE_FILE (empty turns it off), keyed by the name of its report.
+METRICS_HOST = os.environ.get("PDS_METRICS_HOST", "127.0.0.1")
+METRICS_PORT = int(os.environ.get("PDS_METRICS_PORT", 9108))
+METRICS_FILE = os.environ.get("PDS_METRICS_FILE", "")
+METRICS_FILE_INTERVAL = 10
+TRACE_FILE = os.environ.get("PDS_TRACE_FILE", f"{BASE_PATH}/mailboxes/pipeline_trace.jsonl")
+
+# Writers that close and reopen a file before it is complete should set
+# PDS_DONE_MARKERS=1 and create an empty <name>.done next to the file when done.
+DONE_MARKERS = os.environ.get("PDS_DONE_MARKERS", "0") == "1"
+DONE_SUFFIX = ".done"
+TEMP_SUFFIXES = (".tmp", ".part")
 
 
 
@@ -52,30 +145,257 @@ def wait_for_file_stabilization(file_path):
     log_console(f"STABILIZER - File size stabilized: {file_path}")
     return True
 
-def unsafe_move(src_path, dest_path):
-    """Move a file, overwriting if it exists and showing a warning."""
-    if os.path.exists(dest_path):
-        print(f"WARNING: File already exists at destination, deleting: {src_path}")
-        # Remove the existing file to avoid permission issues on some systems
-        os.remove(src_path)
-    else:
-        os.rename(src_path, dest_path)
+def make_observer():
+    """Create an observer that reports close-after-write events and renames into the inbox, when the platform has inotify."""
+    if InotifyObserver is not None:
+        return InotifyObserver(generate_full_events=True)
+    return Observer()
+
+def reports_close_events(observer):
+    return InotifyObserver is not None and isinstance(observer, InotifyObserver)
+
+def csv_header(file_path):
+    """The first line of a CSV file without its line ending, or None if the file is missing or empty."""
+    try:
+        with open(file_path, 'rb') as f:
+            return f.readline().rstrip(b"\r\n") or None
+    except FileNotFoundError:
+        return None
+
+def append_csv(src_paths, dest_path):
+    """Append the rows of CSV files to another in one synced write, keeping a single header line.
+    Raises ValueError, appending nothing, if their headers differ from each other or from the file's."""
+    header, rows = csv_header(dest_path), []
+    for src_path in src_paths:
+        with open(src_path, 'rb') as src:
+            src_header = src.readline()
+            if header is not None and src_header.rstrip(b"\r\n") != header:
+                raise ValueError(f"{src_path} has different columns from {dest_path}")
+            header = src_header.rstrip(b"\r\n")
+            rows.append(src.read())
+            if rows[-1] and not rows[-1].endswith(b"\n"):
+                rows[-1] += b"\n"
+    handoff.append_lines(dest_path, header + b"\n" if header else b"", b"".join(rows))
+
+def header_runs(file_paths):
+    """Split CSV files into runs of consecutive files with the same header."""
+    runs = []
+    for file_path in file_paths:
+        header = csv_header(file_path)
+        if runs and runs[-1][0] == header:
+            runs[-1][1].append(file_path)
+        else:
+            runs.append((header, [file_path]))
+    return runs
+
+def rotate_history():
+    """Move the history, its checkpoint and its parsed cache aside under the current time, so the next rows start a
+    new history.  Returns the history's new path."""
+    stem, ext = os.path.splitext(PDS_HISTORY)
+    rotated = handoff.move(PDS_HISTORY, f"{stem}.{time.strftime('%Y%m%d%H%M%S')}{ext}")
+    for path, suffix in ((PDS_CHECKPOINT, ".checkpoint.json"), (PDS_HISTORY_CACHE, ".cache")):
+        if os.path.lexists(path):
+            handoff.move(path, rotated + suffix)
+    return rotated
+
+def split_arff(file_path):
+    """The header of an ARFF file, up to its @data line, and its data lines."""
+    with open(file_path, 'r') as f:
+        text = f.read()
+    at = text.lower().find('\n@data')
+    if at < 0:
+        raise ValueError(f"No @data section in {file_path}")
+    end = text.find('\n', at + 1)
+    end = len(text) if end < 0 else end + 1
+    rows = [line for line in text[end:].splitlines() if line.strip() and not line.startswith('%')]
+    return text[:end], rows
+
+def add_documents(src_path, dest_path, documents):
+    """Copy a CDS output CSV with a DOC column naming the document of each row."""
+    with open(src_path, 'r', newline='') as src:
+        rows = list(csv.reader(src))
+    if len(rows) - 1 != len(documents):
+        raise ValueError(f"{src_path} has {len(rows) - 1} rows for {len(documents)} input rows")
+    add = rows[0][-1:] != ["DOC"]
+    with open(dest_path, 'w', newline='') as dest:
+        writer = csv.writer(dest)
+        writer.writerow(rows[0] + ["DOC"] if add else rows[0])
+        writer.writerows(row + [document] if add else row for row, document in zip(rows[1:], documents))
+
+def ann_output_path(file_path):
+    """The BRAT2CSV_INBOX path of the annotation of a report."""
+    return BRAT2CSV_INBOX + "/" + file_path.split('/')[-1].replace('.txt', '.ann').replace('.text', '.ann')
+
+def write_annotation(annotation, output_file_path):
+    """Hand an annotation to brat2csv; returns the path it was given."""
+    return handoff.write_file(output_file_path, annotation)
+
+def remove_batch_dir(batch_dir):
+    """Remove a MetaMap batch directory, leaving it for inspection if a report failed."""
+    try:
+        os.rmdir(batch_dir)
+    except OSError:
+        log_console(f"METAMAP - Reports that failed are left in {batch_dir}")
+
+def register_metrics(handlers, caches, workers):
+    """Report the stage queues, the mailboxes and the warm workers' memory as
+    gauges and the annotation caches' lookups as counters."""
+    for handler in handlers:
+        METRICS.gauge('pds_stage_queue_depth', handler.pool.depth, stage=handler.stage)
+    for mailbox in (METAMAP_INBOX, BRAT2CSV_INBOX, CDS_INBOX, PDS_INBOX, PDS_ARCHIVE, PDS_OUTBOX):
+        METRICS.gauge('pds_mailbox_files', lambda mailbox=mailbox: len(os.listdir(mailbox)),
+                      mailbox=os.path.basename(mailbox))
+    for name, cache in caches.items():
+        if cache:
+            METRICS.counter('pds_annotation_cache_lookups_total', lambda cache=cache: cache.hits, cache=name, result='hit')
+            METRICS.counter('pds_annotation_cache_lookups_total', lambda cache=cache: cache.misses, cache=name, result='miss')
+    for pool in workers:
+        for worker in pool.workers if pool else ():
+            METRICS.gauge('pds_worker_rss_bytes', lambda worker=worker: metrics.process_rss(worker.process.pid),
+                          worker=worker.name)
 
 def log_console(message):
     """Log a message to the console with a timestamp."""
     print(f"{time.strftime('%Y-%m-%d %H:%M:%S')} - {message}")
 
-class MetamapEventHandler(FileSystemEventHandler):
-    """Handler for file system events."""
+class StageEventHandler(FileSystemEventHandler):
+    """Base handler that passes a file on once it is complete.
 
-    def on_created(self, event):
-        """Handle file creation events."""
-        # print("Create event")
+    A file is complete when its writer closes it (inotify IN_CLOSE_WRITE),
+    when it is renamed into the inbox from a temporary name, or, with
+    DONE_MARKERS, when its <name>.done marker appears.  Observers without
+    close events fall back to waiting for the file size to settle.
+    """
+
+    pool = None
+    close_events = True
+    stage = None
+
+    def on_closed(self, event):
         if not event.is_directory:
-            self.process_file(event.src_path)
+            self.file_complete(event.src_path)
 
+    def on_moved(self, event):
+        if not event.is_directory and event.dest_path:
+            self.file_complete(event.dest_path)
 
-    def process_file(self, file_path):
+    def on_created(self, event):
+        # with close events a marker is handled when it is closed, not also when it is created
+        if not event.is_directory and not self.close_events:
+            self.file_complete(event.src_path)
+
+    def on_modified(self, event):
+        if not event.is_directory and not self.close_events and not event.src_path.endswith(DONE_SUFFIX):
+            self.file_complete(event.src_path)
+
+    def file_complete(self, file_path):
+        """Pass a complete file on.  Runs in the observer's thread, which an
+        exception would stop, so every error is logged here."""
+        try:
+            self.complete(file_path)
+        except Exception as e:
+            log_console(f"{self.stage.upper() if self.stage else 'WATCHER'} - Error handling {file_path}: {e}")
+
+    def complete(self, file_path):
+        name = os.path.basename(file_path)
+        if name.startswith('.') or name.endswith(TEMP_SUFFIXES):
+            return
+        if name.endswith(DONE_SUFFIX):
+            data_path = file_path[:-len(DONE_SUFFIX)]
+            try:
+                os.remove(file_path)
+            except FileNotFoundError:
+                return  # another event for the same marker removed it and passed the file on
+            if os.path.exists(data_path):
+                self.dispatch_file(data_path)
+            return
+        if DONE_MARKERS:
+            return
+        self.dispatch_file(file_path)
+
+    def dispatch_file(self, file_path):
+        if self.pool:
+            self.pool.submit(file_path)
+        else:
+            self.handle_file(file_path)
+
+    def handle_file(self, file_path):
+        if not self.close_events and not wait_for_file_stabilization(file_path):
+            return
+        with METRICS.span(self.stage, file_path):
+            self.process_file(file_path)
+
+    def handle_batch(self, file_paths):
+        """Handle a batch of files from a StagePool with batch_size > 1."""
+        if not self.close_events:
+            file_paths = [f for f in file_paths if wait_for_file_stabilization(f)]
+        if file_paths:
+            with METRICS.span(self.stage, file_paths, len(file_paths)):
+                self.process_batch(file_paths)
+
+    def process_batch(self, file_paths):
+        for file_path in file_paths:
+            self.process_file(file_path)
+
+
+class MetamapEventHandler(StageEventHandler):
+    """Handler for file system events."""
+
+    stage = "metamap"
+
+    def __init__(self, cache=None, sections=None):
+        super().__init__()
+        self.cache = cache
+        self.sections = sections
+
+    def cache_key(self, file_path):
+        """The annotation cache key of a report, or None without a cache."""
+        if self.cache is None:
+            return None
+        with open(file_path, 'r') as f:
+            return self.cache.key(f.read())
+
+    def annotate_from_cache(self, file_path, key):
+        """Write the cached annotation of a report to BRAT2CSV_INBOX and delete
+        the report.  Returns False if the report has to go through MetaMap."""
+        annotation = self.cache.get(key) if key else None
+        if annotation is None:
+            return False
+        output_file_path = ann_output_path(file_path)
+        output_file_path = write_annotation(annotation, output_file_path)
+        metrics.output(output_file_path)
+        os.remove(file_path)
+        log_console(f"METAMAP - Cache hit for {file_path}, output written to '{output_file_path}' "
+                    f"(hit rate {self.cache.hit_rate():.1%})")
+        return True
+
+    def remember_annotation(self, key, annotation, output_file_path):
+        """Cache an annotation before it is handed to brat2csv, which may move it at once."""
+        if key:
+            self.cache.put(key, annotation)
+            log_console(f"METAMAP - Cached annotation of {output_file_path} (hit rate {self.cache.hit_rate():.1%})")
+
+    def read_sections(self, file_path):
+        """Split a report into sections and look them up in the section cache."""
+        with open(file_path, 'r', newline='') as f:
+            report = SectionAnnotation(self.sections, f.read())
+        log_console(f"METAMAP - {len(report.novel)} of {len(report.spans)} sections of {file_path} to annotate "
+                    f"(section hit rate {self.sections.hit_rate():.1%})")
+        return report
+
+    def annotate_sections(self, file_path, command):
+        """Run MetaMap on the sections of a report the section cache does not
+        hold and return the annotation of the whole report."""
+        report = self.read_sections(file_path)
+        novel_annotation = ''
+        if report.novel_text:
+            result = run_process(command, self.stage, input=report.novel_text, cwd=METAMAP_WORKING_DIR)
+            novel_annotation = result.stdout
+            log_console(f"METAMAP - Command '{' '.join(command)}' executed successfully.")
+            log_console(f"METAMAP - Stderr: {result.stderr}")
+        return report.complete(novel_annotation)
+
+    def process_file(self, file_path, check_cache=True):
         # output date and time for debugging
         log_console(f"METAMAP - Processing: {file_path}")
 
@@ -88,28 +408,34 @@ class MetamapEventHandler(FileSystemEventHandler):
 
         # Define the input and output file paths
         input_file_path = file_path
-        output_file_path = BRAT2CSV_INBOX + "/" + file_path.split('/')[-1].replace('.txt', '.ann').replace('.text', '.ann')
+        output_file_path = ann_output_path(file_path)
 
         command = [METAMAP_CMD, "--brat", "--usecontext", "--"]
 
         try:
-            with open(input_file_path, 'r') as infile, \
-                    open(output_file_path, 'w') as outfile:
-
-                # Execute the command with STDIN from infile and STDOUT to outfile
-                result = subprocess.run(
-                    command,
-                    stdin=infile,
-                    stdout=outfile,
-                    stderr=subprocess.PIPE,
-                    cwd=METAMAP_WORKING_DIR,
-                    check=True,  # Raise an exception for non-zero exit codes
-                    text=True    # Treat stdin/stdout as text (universal newlines)
-                )
-            log_console(f"METAMAP - Command '{' '.join(command)}' executed successfully.")
+            key = self.cache_key(input_file_path)
+            if check_cache and self.annotate_from_cache(input_file_path, key):
+                return
+            if self.sections is not None:
+                annotation = self.annotate_sections(input_file_path, command)
+            else:
+                with open(input_file_path, 'r') as infile:
+
+                    # Execute the command with STDIN from infile, keeping STDOUT for the cache
+                    result = run_process(
+                        command,
+                        self.stage,
+                        stdin=infile,
+                        cwd=METAMAP_WORKING_DIR,
+                    )
+                annotation = result.stdout
+                log_console(f"METAMAP - Command '{' '.join(command)}' executed successfully.")
+                log_console(f"METAMAP - Stderr: {result.stderr}")
+            self.remember_annotation(key, annotation, output_file_path)
+            output_file_path = write_annotation(annotation, output_file_path)
             log_console(f"METAMAP - Input read from '{input_file_path}'.")
             log_console(f"METAMAP - Output written to '{output_file_path}'.")
-            log_console(f"METAMAP - Stderr: {result.stderr}")
+            metrics.output(output_file_path, len(annotation.encode('utf-8')))
 
             # delete the original file
             os.remove(input_file_path)
@@ -117,23 +443,124 @@ class MetamapEventHandler(FileSystemEventHandler):
 
 
 
-        except FileNotFoundError:
+        except FileNotFoundError as e:
             log_console(f"METAMAP - Error: One of the files ('{input_file_path}' or '{output_file_path}') not found.")
+            metrics.fail(e)
         except subprocess.CalledProcessError as e:
             log_console(f"METAMAP - Error executing command: {e}")
+            metrics.fail(e)
         except Exception as e:
             log_console(f"METAMAP - An unexpected error occurred: {e}")
+            metrics.fail(e)
+
+    def process_batch(self, file_paths):
+        """Annotate several reports with one MetaMap Lite run.
+
+        The reports are moved into a private directory under
+        METAMAP_BATCH_DIR and named on the command line; MetaMap writes a
+        <name>.ann next to each, which is renamed into BRAT2CSV_INBOX.  With
+        the section cache, MetaMap gets a file of each report's new sections
+        in novel/ instead, and the .ann of the report is put together from
+        its output.  If the run fails, the reports are annotated one by one.
+        """
+        reports = [f for f in file_paths if os.path.splitext(f)[1].lower() in ['.txt', '.text']]
+        for file_path in file_paths:
+            if file_path not in reports:
+                log_console(f"METAMAP - Skipping file with unsupported extension: {file_path}")
+        keys = {}
+        for file_path in list(reports):
+            try:
+                keys[file_path] = self.cache_key(file_path)
+                if self.annotate_from_cache(file_path, keys[file_path]):
+                    reports.remove(file_path)
+            except (OSError, ValueError) as e:
+                log_console(f"METAMAP - Error reading the cache for {file_path}: {e}")
+        if len(reports) <= 1:
+            for file_path in reports:
+                self.process_file(file_path, check_cache=False)
+            return
+
+        os.makedirs(METAMAP_BATCH_DIR, exist_ok=True)
+        batch_dir = tempfile.mkdtemp(prefix="batch-", dir=METAMAP_BATCH_DIR)
+        novel_dir = os.path.join(batch_dir, "novel")
+        os.makedirs(novel_dir)
+        moved, sections, inputs = {}, {}, []
+        for file_path in reports:
+            batch_path = os.path.join(batch_dir, os.path.basename(file_path))
+            try:
+                os.rename(file_path, batch_path)
+            except FileNotFoundError:
+                log_console(f"METAMAP - Error: Input file not found: {file_path}")
+                continue
+            moved[batch_path] = file_path
+            if self.sections is None:
+                inputs.append(batch_path)
+                continue
+            try:
+                sections[batch_path] = self.read_sections(batch_path)
+            except (OSError, ValueError) as e:
+                log_console(f"METAMAP - Error splitting {file_path} into sections: {e}")
+                inputs.append(batch_path)
+                continue
+            if sections[batch_path].novel_text:
+                novel_path = os.path.join(novel_dir, os.path.basename(batch_path))
+                with open(novel_path, 'w', newline='') as f:
+                    f.write(sections[batch_path].novel_text)
+                inputs.append(novel_path)
+        log_console(f"METAMAP - Processing batch of {len(moved)} files in {batch_dir}")
+
+        if inputs:
+            command = [METAMAP_CMD, "--brat", "--usecontext"] + inputs
+            try:
+                result = run_process(command, self.stage, cwd=METAMAP_WORKING_DIR)
+                log_console(f"METAMAP - Batch of {len(inputs)} files executed successfully.")
+                log_console(f"METAMAP - Stderr: {result.stderr}")
+            except (OSError, subprocess.CalledProcessError) as e:
+                log_console(f"METAMAP - Error executing batch, annotating its files one by one: {e}")
+                for batch_path in moved:
+                    self.process_file(batch_path, check_cache=False)
+                shutil.rmtree(novel_dir, ignore_errors=True)
+                remove_batch_dir(batch_dir)
+                return
+
+        for batch_path, file_path in moved.items():
+            report = sections.get(batch_path)
+            ann_dir = novel_dir if report is not None else batch_dir
+            ann_path = os.path.join(ann_dir, os.path.splitext(os.path.basename(batch_path))[0] + '.ann')
+            output_file_path = os.path.join(BRAT2CSV_INBOX, os.path.basename(ann_path))
+            if report is not None and not report.novel_text:
+                annotation = report.complete()
+            elif not os.path.exists(ann_path):
+                log_console(f"METAMAP - Error: No output for {file_path}, annotating it alone")
+                self.process_file(batch_path, check_cache=False)
+                continue
+            else:
+                with open(ann_path, 'r') as f:
+                    annotation = f.read()
+                if report is not None:
+                    annotation = report.complete(annotation)
+            self.remember_annotation(keys.get(file_path), annotation, output_file_path)
+            if report is not None:
+                output_file_path = write_annotation(annotation, output_file_path)
+            else:
+                output_file_path = handoff.publish(ann_path, output_file_path)
+            log_console(f"METAMAP - Output written to '{output_file_path}'.")
+            metrics.output(output_file_path, len(annotation.encode('utf-8')))
+            os.remove(batch_path)
+            log_console(f"METAMAP - Deleted original file: {file_path}")
+        shutil.rmtree(novel_dir, ignore_errors=True)
+        remove_batch_dir(batch_dir)
 
 
 
-class Brat2CsvEventHandler(FileSystemEventHandler):
+class Brat2CsvEventHandler(StageEventHandler):
     """Handler for file system events."""
 
+    stage = "brat2csv"
 
-    def on_modified(self, event):
-        # log_console(f"BRAT2CSV - Modified event: {event}")
-        if not event.is_directory:
-            self.process_file(event.src_path)
+    def __init__(self, worker=None):
+        super().__init__()
+        self.worker = worker
 
 
     def process_file(self, file_path):
@@ -145,157 +572,345 @@ class Brat2CsvEventHandler(FileSystemEventHandler):
             log_console(f"BRAT2CSV - Skipping file with unsupported extension: {file_path}")
             return
 
-        output_file_path = f"{CDS_INBOX}/{os.path.basename(file_path).replace('.ann', '.arff')}"
+        output_ext = {'jsonl': '.jsonl', 'rows': '.rows'}.get(BRAT2CSV_FORMAT, '.arff')
+        output_file_path = f"{CDS_INBOX}/{os.path.basename(file_path).replace('.ann', output_ext)}"
 
 
-        # Execute MetaMap processing
+        # Convert into a private file and hand it to CDS once it is complete
+        temporary = handoff.temporary_path(output_file_path)
         try:
-            subprocess.run(["python3", BRAT2CSV_CMD, "-i", file_path, "-o", output_file_path],
-                           check=True)
+            if self.worker:
+                self.worker.call(file_path, temporary, BRAT2CSV_FORMAT)
+            else:
+                run_process(["python3", BRAT2CSV_CMD, "-i", file_path, "-o", temporary, "-f", BRAT2CSV_FORMAT],
+                            self.stage, stdout=None, stderr=None)
+            output_file_path = handoff.publish(temporary, output_file_path)
             log_console(f"BRAT2CSV - .ann file processing completed for {file_path}")
+            metrics.output(output_file_path)
 
             # Move processed file to archive
             basename = os.path.basename(file_path)
-            archive_path = os.path.join(BRAT2CSV_ARCHIVE, basename)
-            unsafe_move(file_path, archive_path)
+            archive_path = handoff.move(file_path, os.path.join(BRAT2CSV_ARCHIVE, basename))
             log_console(f"BRAT2CSV - Moved processed file to: {archive_path}")
 
-        except subprocess.CalledProcessError as e:
+        except (subprocess.CalledProcessError, WorkerError, OSError) as e:
             log_console(f"BRAT2CSV - Error processing file: {e}")
+            handoff.remove_quietly(temporary)
+            metrics.fail(e)
+
+
+class CdsEventHandler(StageEventHandler):
 
+    stage = "cds"
 
-class CdsEventHandler(FileSystemEventHandler):
+    def __init__(self):
+        super().__init__()
+        self.evaluator = None
+        self.arff_header = None
+
+    def load_evaluator(self):
+        """Load the model tables once and keep them for every later file."""
+        if self.evaluator is None:
+            sys.path.insert(0, CDS_PY_DIR)
+            from naive_bayes_evaluator import NaiveBayesEvaluator, NaiveBayesEnsemble, ALL_YEARS
+            if MODEL_YEAR == ALL_YEARS:
+                self.evaluator = NaiveBayesEnsemble.load(MODEL_DIR, model_format=MODEL_FORMAT)
+            else:
+                self.evaluator = NaiveBayesEvaluator.load(MODEL_DIR, MODEL_YEAR, MODEL_FORMAT)
+            log_console(f"CDS - Loaded {self.evaluator.describe()}")
+        return self.evaluator
 
     # def on_any_event(self, event):
     #     log_console(f"CDS - Event detected: {event}")
 
-    def on_modified(self, event):
-        # log_console(f"CDS - Modified event: {event}")
-        if not event.is_directory:
-            self.process_file(event.src_path)
-
     def process_file(self, file_path):
-        log_console(f"CDS - Processing: {file_path}")
-
-        wait_for_file_stabilization(file_path)
+        self.process_batch([file_path])
 
-        # Only process files with extensions we care about
-        _, ext = os.path.splitext(file_path)
-        if ext.lower() not in ['.arff']:
-            log_console(f"CDS - Skipping file with unsupported extension: {file_path}")
+    def score_python(self, file_paths, cds_output):
+        evaluator = self.load_evaluator()
+        records = evaluator.score_files(file_paths)
+        temporary = handoff.temporary_path(cds_output)
+        try:
+            evaluator.write(temporary, records)
+            cds_output = handoff.publish(temporary, cds_output)
+        finally:
+            handoff.remove_quietly(temporary)
+        metrics.output(cds_output)
+        return len(records)
+
+    def read_rows(self, file_path):
+        """The ARFF header and data lines of an .arff file, or of a .rows file
+        of data lines under ARFF_HEADER, which is read once."""
+        if not file_path.endswith('.rows'):
+            return split_arff(file_path)
+        if self.arff_header is None:
+            self.arff_header, _ = split_arff(ARFF_HEADER)
+        with open(file_path, 'r') as f:
+            return self.arff_header, [line for line in f.read().splitlines() if line.strip()]
+
+    def score_java(self, file_paths, cds_output):
+        """Run the Java evaluator once on the rows of every file, merged into
+        one ARFF file with one header when there are several or when they
+        have no header of their own, and name each row's document."""
+        os.makedirs(CDS_BATCH_DIR, exist_ok=True)
+        batch_dir = tempfile.mkdtemp(prefix="batch-", dir=CDS_BATCH_DIR)
+        try:
+            header, documents = None, []
+            single = len(file_paths) == 1 and file_paths[0].endswith('.arff')
+            batch_input = file_paths[0] if single else os.path.join(batch_dir, "batch.arff")
+            for file_path in file_paths:
+                file_header, rows = self.read_rows(file_path)
+                documents += [metrics.document_id(file_path)] * len(rows)
+                if batch_input == file_path:
+                    continue
+                if header is None:
+                    header = file_header
+                    with open(batch_input, 'w') as f:
+                        f.write(header)
+                elif file_header != header:
+                    raise ValueError(f"{file_path} has a different ARFF header")
+                with open(batch_input, 'a') as f:
+                    f.writelines(row + '\n' for row in rows)
+            part_output = os.path.join(batch_dir, "output.csv")
+            run_process(["java", "-cp", f"{CDS_JAR}:{WEKA_JAR}", CDS_CMD, MODEL_DIR, MODEL_YEAR, batch_input, part_output],
+                        self.stage, stdout=None, stderr=None)
+            segment = os.path.join(batch_dir, "segment.csv")
+            add_documents(part_output, segment, documents)
+            cds_output = handoff.publish(segment, cds_output)
+            metrics.output(cds_output)
+        finally:
+            shutil.rmtree(batch_dir, ignore_errors=True)
+        return len(documents)
+
+    def process_batch(self, file_paths):
+        """Score the rows of several files with one evaluator run.  If the
+        run fails, the files are scored one by one."""
+        inputs = []
+        for file_path in file_paths:
+            log_console(f"CDS - Processing: {file_path}")
+
+            # Only process files with extensions we care about
+            _, ext = os.path.splitext(file_path)
+            if ext.lower() not in (['.arff', '.jsonl'] if CDS_ENGINE == "python" else ['.arff', '.rows']):
+                log_console(f"CDS - Skipping file with unsupported extension: {file_path}")
+                continue
+            inputs.append(file_path)
+        if not inputs:
             return
 
-        # output filename uses the current date as the base filename
-        cds_output = os.path.join(PDS_INBOX, f"cds_output_{time.strftime('%Y%m%d')}.csv")
-
+        # each batch is a new segment of the day's output, named after the current date
+        cds_output = handoff.segment_path(PDS_INBOX, f"cds_output_{time.strftime('%Y%m%d')}", ".csv")
 
         try:
-            subprocess.run(["java", "-cp", f"{CDS_JAR}:{WEKA_JAR}", CDS_CMD, MODEL_DIR, MODEL_YEAR, file_path, cds_output],
-                           check=True)
-            log_console(f"CDS - .arff file processing completed for {file_path}")
+            if CDS_ENGINE == "python":
+                rows = self.score_python(inputs, cds_output)
+            else:
+                rows = self.score_java(inputs, cds_output)
             log_console(f"CDS - Output saved to {cds_output}")
+        except (subprocess.CalledProcessError, OSError, ValueError) as e:
+            if len(inputs) > 1:
+                log_console(f"CDS - Error scoring batch, scoring its files one by one: {e}")
+                for file_path in inputs:
+                    self.process_batch([file_path])
+                return
+            log_console(f"CDS - Error scoring file: {e}")
+            metrics.fail(e)
+            return
+        log_console(f"CDS - Scored {rows} rows from {len(inputs)} files in one run")
 
+        for file_path in inputs:
             os.remove(file_path)
             log_console(f"CDS - Deleted original file: {file_path}")
 
 
-        except subprocess.CalledProcessError as e:
-            log_console(f"CDS - Error processing file with MetaMap: {e}")
-
-
-class PdsEventHandler(FileSystemEventHandler):
+class PdsEventHandler(StageEventHandler):
     # """Handler for file system events."""
-    # def on_any_event(self, event):
-    #     log_console(f"PDS - Event detected: {event}")
-
-    def on_modified(self, event):
-        """Handle file creation events."""
-        # print("Create event")
-        if not event.is_directory:
-            if event.src_path.endswith('.csv'):
-                self.process_file(event.src_path)
-            if event.src_path.endswith('.png'):
-                destPath = os.path.join(PDS_OUTBOX, os.path.basename(event.src_path))
-                unsafe_move(event.src_path, destPath)
-                log_console(f"PDS - Moved .png file: {destPath}")
 
+    stage = "pds"
 
-    def process_file(self, file_path):
-        log_console(f"PDS - Processing: {file_path}")
+    def __init__(self, worker=None):
+        super().__init__()
+        self.worker = worker
+        self.history_lock = threading.Lock()
 
-        wait_for_file_stabilization(file_path)
+    # def on_any_event(self, event):
+    #     log_console(f"PDS - Event detected: {event}")
 
-        # move png files to pds_outbox
+    def dispatch_file(self, file_path):
+        """Move finished plots straight to the outbox and queue data files."""
         if file_path.endswith('.png'):
-            log_console(f"PDS - Moving .png file to {PDS_OUTBOX}")
-            unsafe_move(file_path, os.path.join(PDS_OUTBOX, os.path.basename(file_path)))
-            return
+            destPath = handoff.move(file_path, os.path.join(PDS_OUTBOX, os.path.basename(file_path)))
+            log_console(f"PDS - Moved .png file: {destPath}")
+        elif file_path.endswith('.csv'):
+            super().dispatch_file(file_path)
 
-        # Only process files with extensions we care about
-        _, ext = os.path.splitext(file_path)
-        if ext.lower() not in ['.csv']:
-            log_console(f"PDS - Skipping file with unsupported extension: {file_path}")
+    def process_file(self, file_path):
+        self.process_batch([file_path])
+
+    def process_batch(self, file_paths):
+        """Compact CDS output segments into the history and track it once."""
+        segments = []
+        for file_path in file_paths:
+            log_console(f"PDS - Processing: {file_path}")
+
+            # Only process files with extensions we care about
+            _, ext = os.path.splitext(file_path)
+            if ext.lower() not in ['.csv']:
+                log_console(f"PDS - Skipping file with unsupported extension: {file_path}")
+                continue
+            segments.append(file_path)
+        if not segments:
             return
 
-
-
-        # Execute PDS processing
+        # Add the rows to the history and archive the segments, then track the history from the last checkpoint.
+        # The plot is named after the day of the last segment and replaces the day's earlier plot in the outbox.
+        day = os.path.basename(segments[-1]).split('.')[0]
+        output_png = os.path.join(PDS_OUTBOX, f"{day}.csv.png")
+        # Segments with other columns than the history (a new MODEL_YEAR, MODEL_FORMAT or CDS_ENGINE) start a new
+        # history, so no row lands under another column and the checkpoint and cache are not reused.
+        with self.history_lock:
+            appended = False
+            for header, run in header_runs(segments):
+                try:
+                    if header is None:
+                        raise ValueError(f"{run[0]} has no header")
+                    history_header = csv_header(PDS_HISTORY)
+                    if history_header is not None and history_header != header:
+                        if appended:
+                            self.track(output_png)
+                            appended = False
+                        rotated = rotate_history()
+                        log_console(f"PDS - {os.path.basename(run[0])} has different columns from the history; "
+                                    f"moved the history, its checkpoint and cache to {rotated} and started a new one")
+                    append_csv(run, PDS_HISTORY)
+                except (OSError, ValueError) as e:
+                    log_console(f"PDS - Error adding {', '.join(run)} to the history: {e}")
+                    metrics.fail(e)
+                    continue
+                appended = True
+                for file_path in run:
+                    archive_path = handoff.move(file_path, os.path.join(PDS_ARCHIVE, os.path.basename(file_path)))
+                    log_console(f"PDS - Moved processed file: {archive_path}")
+            if appended and self.track(output_png):
+                log_console(f"PDS - .csv file processing completed for {', '.join(segments)}")
+
+    def track(self, output_png):
+        """Track the history from its checkpoint and publish the plot.  Returns whether it succeeded."""
+        temporary_png = handoff.temporary_path(output_png)
         try:
-            subprocess.run(["python3", PDS_CMD, "--data_directory", PDS_INBOX, "--data_file", os.path.basename(file_path)],
-                           check=True)
-            log_console(f"PDS - .csv file processing completed for {file_path}")
-        except subprocess.CalledProcessError as e:
+            if self.worker:
+                self.worker.call(os.path.dirname(PDS_HISTORY), os.path.basename(PDS_HISTORY), PDS_CHECKPOINT, temporary_png, True)
+            else:
+                run_process(["python3", PDS_CMD, "--data_directory", os.path.dirname(PDS_HISTORY),
+                             "--data_file", os.path.basename(PDS_HISTORY), "--checkpoint", PDS_CHECKPOINT,
+                             "--output_png", temporary_png, "--cache", "--quiet"], self.stage, stdout=None, stderr=None)
+            if os.path.exists(temporary_png):
+                handoff.publish(temporary_png, output_png, replace=True)
+                metrics.output(output_png)
+            return True
+        except (subprocess.CalledProcessError, WorkerError, OSError) as e:
             log_console(f"PDS - Error processing file with PDS: {e}")
-            return
-
-        # Move processed file to archive
-        basename = os.path.basename(file_path)
-        archive_path = os.path.join(PDS_ARCHIVE, basename)
-        unsafe_move(file_path, archive_path)
-        log_console(f"PDS - Moved processed file: {archive_path}")
+            handoff.remove_quietly(temporary_png)
+            metrics.fail(e)
+            return False
 
 
 
 def start_monitoring():
 
+    brat2csv_worker, pds_worker = None, None
+    if WORKER_MODE == "warm":
+        brat2csv_worker = WarmWorkerPool("brat2csv", BRAT2CSV_WORKERS, brat2csv_stage, os.path.dirname(BRAT2CSV_CMD))
+        pds_worker = WarmWorkerPool("pds", PDS_WORKERS, pds_stage, os.path.dirname(PDS_CMD))
+        log_console("MAIN - Warm workers started for brat2csv and PDS.")
+
     # Create an observer and event handler
-    event_handler = MetamapEventHandler()
-    observer = Observer()
+    cache = None
+    if METAMAP_CACHE_MB > 0:
+        cache = AnnotationCache(METAMAP_CACHE_DIR, int(METAMAP_CACHE_MB * 1024 * 1024), METAMAP_CACHE_CONFIG)
+        log_console(f"MAIN - Annotation cache {METAMAP_CACHE_DIR}: {len(cache.entries)} entries, {cache.size} bytes.")
+    sections = None
+    if METAMAP_SECTION_CACHE_MB > 0:
+        sections = AnnotationCache(METAMAP_SECTION_CACHE_DIR, int(METAMAP_SECTION_CACHE_MB * 1024 * 1024),
+                                   METAMAP_CACHE_CONFIG)
+        log_console(f"MAIN - Section cache {METAMAP_SECTION_CACHE_DIR}: {len(sections.entries)} entries.")
+    event_handler = MetamapEventHandler(cache, sections)
+    if METAMAP_BATCH_SIZE > 1:
+        event_handler.pool = StagePool("METAMAP", event_handler.handle_batch, METAMAP_WORKERS, STAGE_QUEUE_SIZE,
+                                       log_console, METAMAP_BATCH_SIZE, METAMAP_BATCH_WAIT)
+    else:
+        event_handler.pool = StagePool("METAMAP", event_handler.handle_file, METAMAP_WORKERS, STAGE_QUEUE_SIZE,
+                                       log_console)
+    observer = make_observer()
+    event_handler.close_events = reports_close_events(observer)
     observer.schedule(event_handler, METAMAP_INBOX, recursive=False)
     observer.start()
     log_console(f"MAIN - Monitoring started on {METAMAP_INBOX} for new files.")
 
     # Create observer and handler for brat2csv_inbox
-    brat2csv_handler = Brat2CsvEventHandler()
-    brat2csv_observer = Observer()
+    brat2csv_handler = Brat2CsvEventHandler(brat2csv_worker)
+    brat2csv_handler.pool = StagePool("BRAT2CSV", brat2csv_handler.handle_file, BRAT2CSV_WORKERS, STAGE_QUEUE_SIZE, log_console)
+    brat2csv_observer = make_observer()
+    brat2csv_handler.close_events = reports_close_events(brat2csv_observer)
     brat2csv_observer.schedule(brat2csv_handler, BRAT2CSV_INBOX, recursive=False)
     brat2csv_observer.start()
     log_console(f"MAIN - Monitoring started on {BRAT2CSV_INBOX} for .ann files.")
 
     # Create observer and handler for cds_inbox
     cds_handler = CdsEventHandler()
-    cds_observer = Observer()
+    if WORKER_MODE == "warm" and CDS_ENGINE == "python":
+        cds_handler.load_evaluator()
+    if CDS_BATCH_SIZE > 1:
+        cds_handler.pool = StagePool("CDS", cds_handler.handle_batch, CDS_WORKERS, STAGE_QUEUE_SIZE, log_console,
+                                     CDS_BATCH_SIZE, CDS_BATCH_WAIT)
+    else:
+        cds_handler.pool = StagePool("CDS", cds_handler.handle_file, CDS_WORKERS, STAGE_QUEUE_SIZE, log_console)
+    cds_observer = make_observer()
+    cds_handler.close_events = reports_close_events(cds_observer)
     cds_observer.schedule(cds_handler, CDS_INBOX, recursive=False)
     cds_observer.start()
     log_console(f"MAIN - Monitoring started on {CDS_INBOX} for new files.")
 
     # Create observer and handler for pds_inbox
-    pds_handler = PdsEventHandler()
-    pds_observer = Observer()
+    pds_handler = PdsEventHandler(pds_worker)
+    if PDS_BATCH_SIZE > 1:
+        pds_handler.pool = StagePool("PDS", pds_handler.handle_batch, PDS_WORKERS, STAGE_QUEUE_SIZE, log_console,
+                                     PDS_BATCH_SIZE, PDS_BATCH_WAIT)
+    else:
+        pds_handler.pool = StagePool("PDS", pds_handler.handle_file, PDS_WORKERS, STAGE_QUEUE_SIZE, log_console)
+    pds_observer = make_observer()
+    pds_handler.close_events = reports_close_events(pds_observer)
     pds_observer.schedule(pds_handler, PDS_INBOX, recursive=False)
     pds_observer.start()
     log_console(f"MAIN - Monitoring started on {PDS_INBOX} for new files.")
 
-
-
+    METRICS.trace_file = TRACE_FILE or None
+    register_metrics((event_handler, brat2csv_handler, cds_handler, pds_handler),
+                     {'document': cache, 'section': sections}, (brat2csv_worker, pds_worker))
+    metrics_server = None
+    if METRICS_PORT:
+        metrics_server = metrics.serve(METRICS_HOST, METRICS_PORT)
+        log_console(f"MAIN - Metrics served on http://{METRICS_HOST}:{METRICS_PORT}/metrics")
 
     try:
         # Keep the script running
+        written = time.monotonic()
         while True:
             time.sleep(1)
+            if METRICS_FILE and time.monotonic() - written >= METRICS_FILE_INTERVAL:
+                METRICS.write_file(METRICS_FILE)
+                written = time.monotonic()
     except KeyboardInterrupt:
         observer.stop()
     observer.join()
+    if metrics_server:
+        metrics_server.shutdown()
+
+    for handler in (event_handler, brat2csv_handler, cds_handler, pds_handler):
+        handler.pool.stop()
+    for worker in (brat2csv_worker, pds_worker):
+        if worker:
+            worker.close()
 
 
 if __name__ == "__main__":
@@ -0,0 +1,122 @@
+#!/usr/bin/env python3
+
+import itertools
+import os
+import threading
+import time
+
+# Bytes read back from the end of an append-only file to find its last
+# complete line
+TAIL_BYTES = 1 << 16
+
+_lock = threading.Lock()
+_sequence = itertools.count()
+
+
+def temporary_path(path):
+    """A private name to write path under before publish().  It is a
+    dot-file in the same directory, which the mailbox handlers ignore; the
+    extension is kept for writers that go by it."""
+    directory, name = os.path.split(path)
+    stem, ext = os.path.splitext(name)
+    return os.path.join(directory, f".{stem}.{os.getpid()}.{threading.get_ident()}.tmp{ext}")
+
+
+def segment_path(directory, prefix, suffix):
+    """A name no other segment of this process has used:
+    <prefix>.<nanoseconds>.<sequence><suffix>."""
+    return os.path.join(directory, f"{prefix}.{time.time_ns()}.{next(_sequence)}{suffix}")
+
+
+def _free_path(path):
+    stem, ext = os.path.splitext(path)
+    for n in itertools.count():
+        candidate = path if n == 0 else f"{stem}.{n}{ext}"
+        if not os.path.lexists(candidate):
+            return candidate
+
+
+def sync(path):
+    fd = os.open(path, os.O_RDONLY)
+    try:
+        os.fsync(fd)
+    finally:
+        os.close(fd)
+
+
+def publish(temporary, path, replace=False):
+    """Sync a finished file and rename it to path, so the next stage sees it
+    once, complete.  Unless replace is set an existing file is never
+    overwritten: the file gets a numbered name next to it instead.  Returns
+    the path the file was given."""
+    sync(temporary)
+    return move(temporary, path, replace)
+
+
+def move(src_path, dest_path, replace=False):
+    """Rename a file to dest_path, or to a numbered name next to it if
+    dest_path exists (unless replace is set).  Returns the new path."""
+    if replace:
+        os.replace(src_path, dest_path)
+        return dest_path
+    with _lock:
+        dest_path = _free_path(dest_path)
+        os.rename(src_path, dest_path)
+    return dest_path
+
+
+def write_file(path, text, replace=False):
+    """Write text to path through a temporary file and publish it."""
+    temporary = temporary_path(path)
+    try:
+        with open(temporary, 'w', newline='') as f:
+            f.write(text)
+        return publish(temporary, path, replace)
+    except BaseException:
+        remove_quietly(temporary)
+        raise
+
+
+def remove_quietly(path):
+    try:
+        os.remove(path)
+    except FileNotFoundError:
+        pass
+
+
+def _complete_size(fd, size):
+    """The size of an append-only file without a partial last line."""
+    start = max(size - TAIL_BYTES, 0)
+    while size:
+        tail = os.pread(fd, size - start, start)
+        if tail.endswith(b'\n'):
+            return size
+        newline = tail.rfind(b'\n')
+        if newline >= 0:
+            return start + newline + 1
+        if start == 0:
+            return 0
+        start = max(start - TAIL_BYTES, 0)
+    return 0
+
+
+def append_lines(path, header, lines):
+    """Append lines (bytes) to an append-only file with one write and sync
+    it.  header is written first when the file is empty.  A partial line
+    left at the end by a crash is cut off first, so the file only ever
+    holds whole lines."""
+    if lines and not lines.endswith(b'\n'):
+        lines += b'\n'
+    fd = os.open(path, os.O_RDWR | os.O_CREAT | os.O_APPEND, 0o644)
+    try:
+        size = os.fstat(fd).st_size
+        complete = _complete_size(fd, size)
+        if complete != size:
+            os.ftruncate(fd, complete)
+        data = lines if complete else header + lines
+        written = 0
+        while written < len(data):
+            written += os.write(fd, data[written:])
+        os.fsync(fd)
+    finally:
+        os.close(fd)
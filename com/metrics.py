@@ -0,0 +1,339 @@
+#!/usr/bin/env python3
+
+import bisect
+import http.server
+import json
+import os
+import subprocess
+import threading
+import time
+
+# Upper bounds of the histogram buckets, in seconds or bytes
+SECONDS_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60, 120, 300)
+BYTES_BUCKETS = tuple(1 << k for k in range(10, 36, 2))
+# Extensions the stages add to a report's name, stripped to get its document ID
+DOCUMENT_SUFFIXES = ('.tmp', '.part', '.done', '.png', '.txt', '.text', '.ann', '.arff', '.jsonl', '.rows', '.csv')
+
+_local = threading.local()
+
+
+def document_id(file_path):
+    """The correlation ID of a file: the name of the report it came from,
+    which every stage keeps in the names of the files it writes."""
+    name = os.path.basename(file_path)
+    while name.endswith(DOCUMENT_SUFFIXES):
+        name = os.path.splitext(name)[0]
+    return name
+
+
+def _label_value(value):
+    return str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+
+
+def _label_text(labels):
+    if not labels:
+        return ''
+    return '{' + ','.join(f'{k}="{_label_value(v)}"' for k, v in labels) + '}'
+
+
+class Metrics:
+    """Counters, gauges and histograms in the Prometheus text format, and a
+    JSON lines trace of every document each stage handles.
+
+    Counters and histograms are keyed by name and a tuple of (label, value)
+    pairs.  Gauges, and counters kept by other objects, are callables read
+    when the metrics are rendered.
+    """
+
+    def __init__(self, trace_file=None):
+        self.lock = threading.Lock()
+        self.trace_file = trace_file
+        self.help = {}
+        self.counters = {}
+        self.histograms = {}
+        self.callbacks = []
+
+    def describe(self, name, kind, text): self.help[name] = (kind, text)
+
+    def inc(self, name, value=1, **labels):
+        key = (name, tuple(sorted(labels.items())))
+        with self.lock:
+            self.counters[key] = self.counters.get(key, 0) + value
+
+    def observe(self, name, value, buckets=SECONDS_BUCKETS, **labels):
+        key = (name, tuple(sorted(labels.items())))
+        with self.lock:
+            histogram = self.histograms.get(key)
+            if histogram is None:
+                histogram = self.histograms[key] = [buckets, [0] * (len(buckets) + 1), 0.0]
+            histogram[1][bisect.bisect_left(buckets, value)] += 1
+            histogram[2] += value
+
+    def gauge(self, name, read, **labels):
+        """Register a callable whose value is reported as name{labels}."""
+        self._callback('gauge', name, read, labels)
+
+    def counter(self, name, read, **labels):
+        """Register a callable returning a count that only grows, reported
+        as the counter name{labels}."""
+        self._callback('counter', name, read, labels)
+
+    def _callback(self, kind, name, read, labels):
+        described = self.help.get(name, (kind,))[0]
+        if described != kind:
+            raise ValueError(f"{name} is described as a {described}, not a {kind}")
+        with self.lock:
+            self.callbacks.append((name, tuple(sorted(labels.items())), read))
+
+    def render(self):
+        """The metrics in the Prometheus text exposition format."""
+        lines = []
+        described = set()
+
+        def header(name):
+            if name not in described and name in self.help:
+                kind, text = self.help[name]
+                lines.append(f"# HELP {name} {text}")
+                lines.append(f"# TYPE {name} {kind}")
+            described.add(name)
+
+        with self.lock:
+            counters = sorted(self.counters.items())
+            histograms = sorted((k, [v[0], list(v[1]), v[2]]) for k, v in self.histograms.items())
+            callbacks = list(self.callbacks)
+        for (name, labels), value in counters:
+            header(name)
+            lines.append(f"{name}{_label_text(labels)} {value}")
+        for (name, labels), (buckets, counts, total) in histograms:
+            header(name)
+            cumulative = 0
+            for bound, count in zip(buckets, counts):
+                cumulative += count
+                lines.append(f"{name}_bucket{_label_text(labels + (('le', bound),))} {cumulative}")
+            cumulative += counts[-1]
+            lines.append(f"{name}_bucket{_label_text(labels + (('le', '+Inf'),))} {cumulative}")
+            lines.append(f"{name}_sum{_label_text(labels)} {total}")
+            lines.append(f"{name}_count{_label_text(labels)} {cumulative}")
+        for name, labels, read in sorted(callbacks, key=lambda g: (g[0], g[1])):
+            try:
+                value = read()
+            except Exception:
+                continue
+            header(name)
+            lines.append(f"{name}{_label_text(labels)} {value}")
+        return '\n'.join(lines) + '\n'
+
+    def write_file(self, filename):
+        """Write the rendered metrics to filename, e.g. for a node exporter's
+        textfile collector."""
+        temporary = f"{filename}.tmp"
+        with open(temporary, 'w') as f:
+            f.write(self.render())
+        os.replace(temporary, filename)
+
+    def trace(self, record):
+        if not self.trace_file:
+            return
+        line = json.dumps(record, separators=(',', ':')) + '\n'
+        with self.lock:
+            with open(self.trace_file, 'a') as f:
+                f.write(line)
+
+    def span(self, stage, file_paths, batch=1):
+        return Span(self, stage, file_paths, batch)
+
+
+METRICS = Metrics()
+METRICS.describe('pds_stage_documents_total', 'counter', 'Documents handled per stage and status.')
+METRICS.describe('pds_stage_run_seconds', 'histogram', 'Time a stage spent on a document or batch.')
+METRICS.describe('pds_stage_queue_wait_seconds', 'histogram', 'Time a document waited in the stage queue.')
+METRICS.describe('pds_stage_bytes_in_total', 'counter', 'Bytes of the files a stage read.')
+METRICS.describe('pds_stage_bytes_out_total', 'counter', 'Bytes of the files a stage wrote.')
+METRICS.describe('pds_subprocess_spawn_seconds', 'histogram', 'Time to start a stage subprocess.')
+METRICS.describe('pds_subprocess_seconds', 'histogram', 'Wall time of a stage subprocess.')
+METRICS.describe('pds_subprocess_max_rss_bytes', 'histogram', 'Peak resident set size of a stage subprocess.')
+METRICS.describe('pds_stage_queue_depth', 'gauge', 'Files waiting in a stage queue.')
+METRICS.describe('pds_mailbox_files', 'gauge', 'Files in a mailbox directory.')
+METRICS.describe('pds_annotation_cache_lookups_total', 'counter', 'MetaMap annotation cache lookups by result.')
+METRICS.describe('pds_worker_rss_bytes', 'gauge', 'Resident set size of a warm worker process.')
+
+
+def set_queue_wait(seconds):
+    """Record how long the path the current thread is about to process
+    waited in its queue (called by StagePool)."""
+    _local.queue_wait = seconds
+
+
+def current_span(): return getattr(_local, 'span', None)
+
+
+def output(file_path, size=None):
+    """Count a file written for the document(s) of the current span."""
+    span = current_span()
+    if span is not None:
+        span.output(file_path, size)
+
+
+def fail(error):
+    """Mark the document(s) of the current span as failed."""
+    span = current_span()
+    if span is not None:
+        span.failed = str(error)
+
+
+class Span:
+    """The handling of one document, or one batch of them, by a stage.
+
+    Used as a context manager around a stage's work.  On exit it observes the
+    run time, queue wait and bytes in and out of the stage and writes one
+    trace record per document.
+    """
+
+    def __init__(self, metrics, stage, file_paths, batch):
+        self.metrics = metrics
+        self.stage = stage
+        self.file_paths = [file_paths] if isinstance(file_paths, str) else list(file_paths)
+        self.batch = batch
+        self.bytes_out = 0
+        self.outputs = []
+        self.subprocesses = []
+        self.failed = None
+
+    def output(self, file_path, size=None):
+        try:
+            self.bytes_out += os.path.getsize(file_path) if size is None else size
+        except OSError:
+            pass
+        self.outputs.append(os.path.basename(file_path))
+
+    def __enter__(self):
+        self.queue_wait = getattr(_local, 'queue_wait', None)
+        _local.queue_wait = None
+        self.bytes_in = 0
+        for file_path in self.file_paths:
+            try:
+                self.bytes_in += os.path.getsize(file_path)
+            except OSError:
+                pass
+        self.parent = current_span()
+        _local.span = self
+        self.started = time.time()
+        self.start = time.perf_counter()
+        return self
+
+    def __exit__(self, kind, value, traceback):
+        seconds = time.perf_counter() - self.start
+        _local.span = self.parent
+        if value is not None:
+            self.failed = f"{kind.__name__}: {value}"
+        status = 'error' if self.failed else 'ok'
+        metrics = self.metrics
+        metrics.inc('pds_stage_documents_total', len(self.file_paths), stage=self.stage, status=status)
+        metrics.observe('pds_stage_run_seconds', seconds, stage=self.stage)
+        if self.queue_wait is not None:
+            metrics.observe('pds_stage_queue_wait_seconds', self.queue_wait, stage=self.stage)
+        metrics.inc('pds_stage_bytes_in_total', self.bytes_in, stage=self.stage)
+        metrics.inc('pds_stage_bytes_out_total', self.bytes_out, stage=self.stage)
+        for file_path in self.file_paths:
+            record = {'time': round(self.started, 6), 'doc': document_id(file_path), 'stage': self.stage,
+                      'status': status, 'run_seconds': round(seconds, 6), 'bytes_in': self.bytes_in,
+                      'bytes_out': self.bytes_out}
+            if self.queue_wait is not None:
+                record['queue_wait_seconds'] = round(self.queue_wait, 6)
+            if self.batch > 1:
+                record['batch'] = self.batch
+            if self.subprocesses:
+                record['subprocesses'] = self.subprocesses
+            if self.outputs:
+                record['outputs'] = self.outputs
+            if self.failed:
+                record['error'] = self.failed
+            metrics.trace(record)
+        return False
+
+
+def process_rss(pid):
+    """Resident set size of a running process in bytes, from /proc."""
+    with open(f"/proc/{pid}/statm", 'r') as f:
+        return int(f.read().split()[1]) * os.sysconf('SC_PAGE_SIZE')
+
+
+def _read(stream, into):
+    into.append(stream.read())
+    stream.close()
+
+
+def _write(stream, data):
+    try:
+        stream.write(data)
+        stream.close()
+    except (BrokenPipeError, OSError):
+        pass
+
+
+def run_process(command, stage, input=None, stdin=None, stdout=subprocess.PIPE, stderr=subprocess.PIPE, cwd=None,
+                text=True, check=True):
+    """subprocess.run() that also measures the child: the time to start it,
+    its wall time and, from wait4(), its peak RSS and CPU time.  These are
+    observed for stage and added to the current span."""
+    start = time.perf_counter()
+    process = subprocess.Popen(command, stdin=subprocess.PIPE if input is not None else stdin, stdout=stdout,
+                               stderr=stderr, cwd=cwd, text=text)
+    spawn = time.perf_counter() - start
+    threads, outputs = [], {}
+    if input is not None:
+        threads.append(threading.Thread(target=_write, args=(process.stdin, input), daemon=True))
+    for name, stream in (('stdout', process.stdout), ('stderr', process.stderr)):
+        if stream is not None:
+            outputs[name] = []
+            threads.append(threading.Thread(target=_read, args=(stream, outputs[name]), daemon=True))
+    for thread in threads:
+        thread.start()
+    _, status, usage = os.wait4(process.pid, 0)
+    process.returncode = os.waitstatus_to_exitcode(status)
+    for thread in threads:
+        thread.join()
+    seconds = time.perf_counter() - start
+
+    max_rss = usage.ru_maxrss * 1024
+    METRICS.observe('pds_subprocess_spawn_seconds', spawn, stage=stage)
+    METRICS.observe('pds_subprocess_seconds', seconds, stage=stage)
+    METRICS.observe('pds_subprocess_max_rss_bytes', max_rss, BYTES_BUCKETS, stage=stage)
+    span = current_span()
+    if span is not None:
+        span.subprocesses.append({'spawn_seconds': round(spawn, 6), 'seconds': round(seconds, 6),
+                                  'cpu_seconds': round(usage.ru_utime + usage.ru_stime, 6), 'max_rss': max_rss})
+
+    result = subprocess.CompletedProcess(command, process.returncode,
+                                         outputs['stdout'][0] if 'stdout' in outputs else None,
+                                         outputs['stderr'][0] if 'stderr' in outputs else None)
+    if check:
+        result.check_returncode()
+    return result
+
+
+class _MetricsHandler(http.server.BaseHTTPRequestHandler):
+    metrics = METRICS
+
+    def do_GET(self):
+        if self.path.split('?', 1)[0] not in ('/metrics', '/'):
+            self.send_error(404)
+            return
+        body = self.metrics.render().encode('utf-8')
+        self.send_response(200)
+        self.send_header('Content-Type', 'text/plain; version=0.0.4; charset=utf-8')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        pass
+
+
+def serve(host, port, metrics=METRICS):
+    """Serve /metrics from a daemon thread and return the server."""
+    handler = type('MetricsHandler', (_MetricsHandler,), {'metrics': metrics})
+    server = http.server.ThreadingHTTPServer((host, port), handler)
+    server.daemon_threads = True
+    threading.Thread(target=server.serve_forever, name='metrics', daemon=True).start()
+    return server
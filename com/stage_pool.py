@@ -0,0 +1,96 @@
+#!/usr/bin/env python3
+
+import queue
+import threading
+import time
+
+from metrics import set_queue_wait
+
+
+class StagePool:
+    """A bounded queue of file paths drained by a pool of worker threads.
+
+    submit() blocks while the queue is full, which pushes back on the
+    watchdog observer that feeds it instead of letting events pile up.
+    A path that is already waiting in the queue is not queued again, since
+    one write usually fires several modified events.
+
+    With batch_size > 1, process is called with a list of up to batch_size
+    paths: a worker takes the paths already queued and waits up to
+    batch_wait seconds for more before it processes the batch.
+    """
+
+    def __init__(self, name, process, workers=1, queue_size=100, log=print, batch_size=1, batch_wait=0.0):
+        self.name = name
+        self.process = process
+        self.log = log
+        self.batch_size = batch_size
+        self.batch_wait = batch_wait
+        self.queue = queue.Queue(maxsize=queue_size)
+        self.waiting = {}
+        self.lock = threading.Lock()
+        self.threads = [threading.Thread(target=self._run, name=f"{name}-{i}", daemon=True)
+                        for i in range(workers)]
+        for thread in self.threads:
+            thread.start()
+
+    def submit(self, path):
+        """Queue a path for processing, waiting while the queue is full."""
+        with self.lock:
+            if path in self.waiting:
+                return False
+            self.waiting[path] = time.monotonic()
+        if self.queue.full():
+            self.log(f"{self.name} - Queue full ({self.queue.maxsize}), waiting to queue {path}")
+        self.queue.put(path)
+        return True
+
+    def depth(self): return self.queue.qsize()
+
+    def _next_batch(self, path):
+        """Collect up to batch_size paths, starting with path.  Returns the
+        batch and whether the stop marker was taken from the queue."""
+        batch = [path]
+        deadline = time.monotonic() + self.batch_wait
+        while len(batch) < self.batch_size:
+            try:
+                path = self.queue.get(timeout=max(deadline - time.monotonic(), 0.0))
+            except queue.Empty:
+                break
+            if path is None:
+                self.queue.task_done()
+                return batch, True
+            batch.append(path)
+        return batch, False
+
+    def _run(self):
+        while True:
+            path = self.queue.get()
+            if path is None:
+                self.queue.task_done()
+                break
+            stopping = False
+            if self.batch_size > 1:
+                batch, stopping = self._next_batch(path)
+            else:
+                batch = [path]
+            with self.lock:
+                queued = [self.waiting.pop(p, None) for p in batch]
+            queued = [t for t in queued if t is not None]
+            set_queue_wait(time.monotonic() - min(queued) if queued else None)
+            try:
+                self.process(batch if self.batch_size > 1 else path)
+            except Exception as e:
+                self.log(f"{self.name} - Unexpected error processing {', '.join(batch)}: {e}")
+            finally:
+                for _ in batch:
+                    self.queue.task_done()
+            if stopping:
+                break
+
+    def stop(self):
+        """Let the workers finish the queued paths, then end them."""
+        for _ in self.threads:
+            self.queue.put(None)
+        for thread in self.threads:
+            thread.join()
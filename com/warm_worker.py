@@ -0,0 +1,118 @@
+#!/usr/bin/env python3
+
+import multiprocessing
+import queue
+import sys
+import threading
+
+
+class WorkerError(Exception):
+    """A job or the setup of a warm worker failed."""
+
+
+def brat2csv_stage(brat2csv_dir):
+    """Keep the parsed header and the ARFF template of ann2arff.py loaded."""
+    sys.path.insert(0, brat2csv_dir)
+    import ann2arff
+    header_array = ann2arff.read_header()
+    header_index = ann2arff.index_header(header_array)
+    arff_template = ann2arff.read_arff_template()
+    defaults = ann2arff.attribute_defaults(arff_template)
+
+    def job(input_file, output_file, output_format='dense'):
+        ann2arff.outputCSV(input_file, output_file, header_array, arff_template, header_index, output_format, defaults)
+    return job
+
+
+def pds_stage(pds_dir):
+    """Keep Run_ILI_Tracker.py and the plotting stack it imports loaded."""
+    sys.path.insert(0, pds_dir)
+    import Run_ILI_Tracker
+    Run_ILI_Tracker.pyplot()
+
+    def job(data_directory, data_file, checkpoint_file=None, output_png_file=None, cache=False):
+        Run_ILI_Tracker.run_ili_tracker(data_directory, data_file, Run_ILI_Tracker.diseases, checkpoint_file, output_png_file,
+                                        cache=cache)
+    return job
+
+
+def _serve(connection, setup, setup_args):
+    try:
+        job = setup(*setup_args)
+    except Exception as e:
+        connection.send(('error', f"{type(e).__name__}: {e}"))
+        return
+    connection.send(('ok', None))
+    while True:
+        try:
+            args = connection.recv()
+        except EOFError:
+            break
+        if args is None:
+            break
+        try:
+            connection.send(('ok', job(*args)))
+        except Exception as e:
+            connection.send(('error', f"{type(e).__name__}: {e}"))
+
+
+class WarmWorker:
+    """A long-lived process that sets up one stage's expensive state once and
+    then runs the jobs sent to it over a pipe, one at a time."""
+
+    def __init__(self, name, setup, *setup_args):
+        self.name = name
+        self.lock = threading.Lock()
+        self.connection, child_connection = multiprocessing.Pipe()
+        self.process = multiprocessing.Process(target=_serve, args=(child_connection, setup, setup_args),
+                                               name=name, daemon=True)
+        self.process.start()
+        child_connection.close()
+        self._receive()
+
+    def _receive(self):
+        try:
+            status, result = self.connection.recv()
+        except EOFError:
+            raise WorkerError(f"{self.name}: worker process exited with code {self.process.exitcode}")
+        if status == 'error':
+            raise WorkerError(f"{self.name}: {result}")
+        return result
+
+    def call(self, *args):
+        """Run one job in the worker and return its result."""
+        with self.lock:
+            self.connection.send(args)
+            return self._receive()
+
+    def close(self):
+        with self.lock:
+            try:
+                self.connection.send(None)
+            except OSError:
+                pass
+            self.connection.close()
+        self.process.join(timeout=5)
+
+
+class WarmWorkerPool:
+    """Several warm workers for the same stage, so jobs from a StagePool's
+    threads run in parallel.  Has the same call()/close() interface as a
+    single WarmWorker."""
+
+    def __init__(self, name, size, setup, *setup_args):
+        self.workers = [WarmWorker(f"{name}-{i}", setup, *setup_args) for i in range(size)]
+        self.idle = queue.Queue()
+        for worker in self.workers:
+            self.idle.put(worker)
+
+    def call(self, *args):
+        worker = self.idle.get()
+        try:
+            return worker.call(*args)
+        finally:
+            self.idle.put(worker)
+
+    def close(self):
+        for worker in self.workers:
+            worker.close()